@@ -0,0 +1,305 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+Offline scan for the certificates Device Defender Audit flags as expiring or revoked.
+
+Walks directories of PEM or DER certificates and CRLs, such as the one --pki-dir
+publishes to, and credential packs written by provision_thing.py. Files are parsed
+in a process pool, and each worker hands back only what the checks need: a
+certificate's issuer, serial number, expiry and whether it is a CA, or a CRL's
+issuer and revoked serials. Revoked serials go into a set per issuer, so once
+everything is parsed, whether a certificate is revoked is one hash lookup.
+
+    python audit_scan.py ./pki ../../certificates/fleet.pack
+
+prints a JSON line for each finding, named after the audit check that would report
+it. CRL signatures aren't verified, and the cloud revocation checks only report
+certificates still active in AWS IoT, which a local scan can't tell.
+'''
+
+import argparse
+import calendar
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from collections import OrderedDict
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.x509.oid import NameOID
+
+# Credential packs are read with the workshop scripts' helper
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, 'scripts'))
+
+from credpack import PackReader
+from pki import get_validity
+
+CERTIFICATE_SUFFIXES = ('.pem', '.crt', '.cer', '.der')
+CRL_SUFFIXES = ('.crl',)
+PACK_SUFFIXES = ('.pack',)
+
+PEM_BEGIN = b'-----BEGIN '
+
+one_day = 24 * 60 * 60
+
+def not_valid_after(certificate):
+    return calendar.timegm(get_validity(certificate)[1].utctimetuple())
+
+def is_ca_certificate(certificate):
+    try:
+        return certificate.extensions.get_extension_for_class(
+            x509.BasicConstraints).value.ca
+    except x509.ExtensionNotFound:
+        return False
+
+def common_name(name):
+    attributes = name.get_attributes_for_oid(NameOID.COMMON_NAME)
+    return attributes[0].value if attributes else None
+
+def certificate_entry(certificate, source):
+    return ('certificate', source,
+        certificate.issuer.public_bytes(default_backend()),
+        certificate.serial_number, not_valid_after(certificate),
+        common_name(certificate.subject), is_ca_certificate(certificate))
+
+def crl_entry(crl, source):
+    return ('crl', source, crl.issuer.public_bytes(default_backend()),
+        common_name(crl.issuer), [revoked.serial_number for revoked in crl])
+
+def parse(data, source):
+    '''Returns an entry for every certificate and CRL in data, PEM or DER'''
+
+    backend = default_backend()
+
+    # Exceptions are returned rather than raised, so one bad file doesn't end the scan
+    try:
+        if PEM_BEGIN not in data:
+            try:
+                return [certificate_entry(
+                    x509.load_der_x509_certificate(data, backend), source)]
+            except ValueError:
+                return [crl_entry(x509.load_der_x509_crl(data, backend), source)]
+
+        # A file can hold a chain, or a certificate and its private key
+        entries = []
+        for block in data.split(PEM_BEGIN)[1:]:
+            block = PEM_BEGIN + block
+            if block.startswith(PEM_BEGIN + b'CERTIFICATE-----'):
+                entries.append(certificate_entry(
+                    x509.load_pem_x509_certificate(block, backend), source))
+            elif block.startswith(PEM_BEGIN + b'X509 CRL-----'):
+                entries.append(crl_entry(
+                    x509.load_pem_x509_crl(block, backend), source))
+        return entries
+    except Exception as e:
+        return [('error', source, str(e))]
+
+def parse_batch(batch):
+    '''Parses a list of files, or a range of a credential pack's records'''
+
+    if batch[0] == 'pack':
+        source, start, stop = batch[1:]
+        entries = []
+        try:
+            with PackReader(source) as pack:
+                for record in pack.records(start, stop):
+                    if 'certificatePem' in record:
+                        entries.extend(parse(record['certificatePem'].encode('ascii'),
+                            source + '#' + record['name']))
+        except Exception as e:
+            entries.append(('error', source, str(e)))
+        return entries
+
+    entries = []
+    for path in batch[1]:
+        try:
+            with open(path, 'rb') as scanned_file:
+                data = scanned_file.read()
+        except (IOError, OSError) as e:
+            entries.append(('error', path, str(e)))
+            continue
+        entries.extend(parse(data, path))
+    return entries
+
+def find_batches(paths, batch_size):
+    '''Yields batches of the certificate, CRL and pack files under paths'''
+
+    batch = []
+    for path in paths:
+        if os.path.isdir(path):
+            walked = (os.path.join(directory, name)
+                for directory, _, names in os.walk(path) for name in sorted(names))
+        else:
+            walked = [path]
+
+        for file_path in walked:
+            suffix = os.path.splitext(file_path)[1].lower()
+            if suffix in PACK_SUFFIXES:
+                try:
+                    with PackReader(file_path) as pack:
+                        count = len(pack)
+                except (IOError, OSError, ValueError):
+                    # Left for a worker to fail on, so it's reported like any other error
+                    count = 1
+                for start in range(0, count, batch_size):
+                    yield ('pack', file_path, start, start + batch_size)
+            elif suffix in CERTIFICATE_SUFFIXES + CRL_SUFFIXES or file_path == path:
+                batch.append(file_path)
+                if len(batch) == batch_size:
+                    yield ('files', batch)
+                    batch = []
+
+    if batch:
+        yield ('files', batch)
+
+class RevocationIndex():
+    '''The serials revoked by every CRL scanned, as a set per issuer'''
+
+    def __init__(self):
+        # DER encoded issuer name -> revoked serials
+        self.revoked = {}
+        self.issuer_names = {}
+
+    def add(self, issuer, issuer_name, serial_numbers):
+        self.revoked.setdefault(issuer, set()).update(serial_numbers)
+        self.issuer_names[issuer] = issuer_name
+
+    def is_revoked(self, issuer, serial_number):
+        serial_numbers = self.revoked.get(issuer)
+        return serial_numbers is not None and serial_number in serial_numbers
+
+    def __len__(self):
+        return sum(len(serial_numbers) for serial_numbers in self.revoked.values())
+
+class ScanReport():
+
+    def __init__(self):
+        self.findings = []
+        self.errors = []
+        self.certificates = 0
+        self.crls = 0
+        self.revocation_index = RevocationIndex()
+        self.elapsed = 0.0
+
+    def add_finding(self, check_name, source, name, serial_number, not_after, now,
+        issuer_name = None):
+
+        finding = OrderedDict([
+            ('checkName', check_name),
+            ('source', source),
+            ('commonName', name),
+            ('serialNumber', '%x' % serial_number),
+            ('notAfter', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(not_after))),
+            ('daysLeft', round((not_after - now) / float(one_day), 1))])
+        if issuer_name is not None:
+            finding['issuer'] = issuer_name
+        self.findings.append(finding)
+
+    def summary(self):
+        return '%d certificates and %d CRLs (%d revoked serials from %d issuers) ' \
+            'in %.2fs: %d findings, %d errors' % (self.certificates, self.crls,
+            len(self.revocation_index), len(self.revocation_index.revoked),
+            self.elapsed, len(self.findings), len(self.errors))
+
+def scan(paths, expiring_days = 30, processes = None, batch_size = 256, now = None):
+    '''
+    Parses every certificate and CRL under paths in one pass, returning a
+    ScanReport of the certificates expiring within expiring_days, or already
+    expired, and of those revoked by a CRL from their issuer.
+    '''
+
+    start = time.time()
+    now = start if now is None else now
+    expiring_before = now + expiring_days * one_day
+    report = ScanReport()
+    issuers = {}
+
+    # Certificates are only checked for revocation once every CRL has been
+    # indexed, as a CRL can turn up after the certificates it revokes
+    unchecked = []
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        for entries in pool.imap_unordered(parse_batch,
+                find_batches(paths, batch_size)):
+            for entry in entries:
+                if entry[0] == 'error':
+                    report.errors.append(entry[1:])
+                    continue
+
+                # Share one copy of each issuer name between its certificates
+                issuer = issuers.setdefault(entry[2], entry[2])
+
+                if entry[0] == 'crl':
+                    report.crls += 1
+                    report.revocation_index.add(issuer, entry[3], entry[4])
+                    continue
+
+                source, _, serial_number, not_after, name, is_ca = entry[1:]
+                report.certificates += 1
+                if not_after < expiring_before:
+                    report.add_finding(
+                        'CA_CERTIFICATE_EXPIRING_CHECK' if is_ca else 'DEVICE_CERTIFICATE_EXPIRING_CHECK',
+                        source, name, serial_number, not_after, now)
+                unchecked.append((issuer, serial_number, source, name, not_after, is_ca))
+    finally:
+        pool.close()
+        pool.join()
+
+    revocation_index = report.revocation_index
+    for issuer, serial_number, source, name, not_after, is_ca in unchecked:
+        if revocation_index.is_revoked(issuer, serial_number):
+            report.add_finding(
+                'REVOKED_CA_CERTIFICATE_STILL_ACTIVE_CHECK' if is_ca else 'REVOKED_DEVICE_CERTIFICATE_STILL_ACTIVE_CHECK',
+                source, name, serial_number, not_after, now,
+                issuer_name = revocation_index.issuer_names[issuer])
+
+    report.elapsed = time.time() - start
+    return report
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description = 'Scan certificates and CRLs for expiring and revoked certificates')
+    parser.add_argument('paths', nargs = '+', metavar = 'PATH',
+        help = 'Directory, certificate, CRL or credential pack to scan')
+    parser.add_argument('--expiring-days', type = int, default = 30,
+        help = 'Report certificates expiring within this many days')
+    parser.add_argument('--processes', type = int,
+        help = 'Number of parsing processes, by default one per CPU')
+    parser.add_argument('--batch-size', type = int, default = 256,
+        help = 'Number of files, or pack records, handed to a process at a time')
+    parser.add_argument('--output',
+        help = 'Write findings to this file instead of stdout')
+    args = parser.parse_args()
+
+    report = scan(args.paths, args.expiring_days, args.processes, args.batch_size)
+
+    output_file = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for finding in sorted(report.findings,
+                key = lambda finding: (finding['checkName'], finding['source'])):
+            output_file.write(json.dumps(finding) + '\n')
+    finally:
+        if args.output:
+            output_file.close()
+
+    for source, error in report.errors:
+        sys.stderr.write('Failed parsing %s: %s\n' % (source, error))
+    sys.stderr.write('Scanned ' + report.summary() + '\n')
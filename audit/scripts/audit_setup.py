@@ -0,0 +1,1024 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Creates the AWS resources the Device Defender audit checks flag.
+
+Importing this module has no side effects. boto3 and cryptography are only imported,
+and clients, the PKI bucket and the key pool only created, once a scenario needs them:
+
+    python iot-device-defender-audit-resources-setup.py --region us-east-1 cert-revoked
+
+Given several regions, e.g. --region us-east-1,eu-west-1, scenarios are set up in all
+of them at once, each region with clients of its own.
+"""
+
+import argparse
+import atexit
+import json
+import logging
+import os
+import random
+import re
+import string
+import sys
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timedelta
+
+# Helpers shared with the workshop scripts
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, 'scripts'))
+
+logger = logging.getLogger('aws-iot-device-defender-demo')
+logger.setLevel(logging.INFO)
+
+ch = logging.StreamHandler(sys.stdout)
+ch.setLevel(logging.INFO)
+
+logger.addHandler(ch)
+
+IOT_ROOT_CA_PATH = './resources/AWSIoTRootCA.pem'
+
+# Kept in step with keypool.KEY_TYPES, which can't be imported without cryptography
+KEY_TYPES = ('rsa', 'ec')
+
+# Kept in step with profiling.MODES
+PROFILE_MODES = ('timers', 'cprofile', 'sample')
+
+# Names are get_rand_string(demo_id), so resources left by earlier runs can be found
+DEMO_NAME = re.compile(r'^(demo_[a-z_]+)-[a-z]{8}$')
+
+one_day = timedelta(1, 0, 0)
+one_year = timedelta(365, 0, 0)
+
+# Set by main(), or by whoever imports this module
+args = None
+api_stats = None
+client_factory = None
+
+clients_lock = threading.Lock()
+pki_publisher = None
+pki_publisher_lock = threading.Lock()
+key_pool = None
+sign_pool = None
+pki_cache = None
+# By CA certificate id, each CA's CRLStore and the lock to hold while using it
+crl_stores = {}
+crl_stores_lock = threading.Lock()
+account_id = None
+account_id_lock = threading.Lock()
+# By region
+registration_codes = {}
+registration_code_lock = threading.Lock()
+
+# Every resource created is journaled under this run's id, so cleanup can tell
+# this run's resources from those earlier runs left behind
+run_id = None
+journal = None
+
+cleanup_required = False
+logging_options_lock = threading.Lock()
+
+# Journaled resource type removed by each kind of teardown call
+DELETE_CALLS = {
+    'delete_certificate': 'certificate',
+    'delete_ca_certificate': 'ca_certificate',
+    'delete_policy': 'policy',
+}
+
+
+def get_region():
+    '''The region the calling thread is setting up or cleaning up, by default the
+    first of --region'''
+
+    from clients import current_region
+
+    return current_region() or args.regions[0]
+
+def get_client(service, region = None):
+    return client_factory.client(service, region or get_region())
+
+def get_journal():
+    '''Returns the journal, adding the calling thread's region to every resource
+    created through it'''
+
+    global journal
+
+    from journal import Journal, ScopedJournal
+
+    with clients_lock:
+        if not journal:
+            journal = Journal(args.journal, run = run_id)
+            atexit.register(journal.close)
+    return ScopedJournal(journal, region = get_region())
+
+def get_iot_client():
+    return get_client('iot')
+
+def get_s3_client():
+    # The PKI bucket is shared by every region, so lives in the first
+    return get_client('s3', args.regions[0])
+
+def get_pki_publisher():
+    global pki_publisher
+
+    # Held throughout, so concurrent scenarios don't each create a bucket
+    with pki_publisher_lock:
+        if pki_publisher:
+            return pki_publisher
+
+        from publish import ArtifactPublisher, LocalBackend, S3Backend
+
+        if args.pki_dir:
+            pki_publisher = ArtifactPublisher(LocalBackend(args.pki_dir))
+        else:
+            pki_bucket = args.pki_bucket
+            if not pki_bucket:
+                pki_bucket = 'device-defender-audit-demo-' + str(uuid.uuid4())
+                # Anywhere but us-east-1, a bucket has to be told its region
+                location = {} if args.regions[0] == 'us-east-1' else {
+                    'CreateBucketConfiguration': {'LocationConstraint': args.regions[0]}}
+                get_s3_client().create_bucket(Bucket=pki_bucket, **location)
+            pki_publisher = ArtifactPublisher(S3Backend(get_s3_client(), pki_bucket))
+
+        return pki_publisher
+
+def get_key_pool():
+    global key_pool
+
+    if args.key_pool_size <= 0:
+        return None
+
+    with clients_lock:
+        if not key_pool:
+            from keypool import KeyPool
+
+            key_pool = KeyPool(key_type = args.key_type, size = args.key_pool_size)
+            atexit.register(key_pool.close)
+        return key_pool
+
+def get_sign_pool():
+    '''The processes bulk minting signs certificates in, shared by every bulk run'''
+    global sign_pool
+
+    with clients_lock:
+        if not sign_pool:
+            import multiprocessing
+
+            sign_pool = multiprocessing.Pool()
+            atexit.register(sign_pool.terminate)
+        return sign_pool
+
+def get_pki_cache():
+    global pki_cache
+
+    if not args.pki_cache:
+        return None
+
+    with clients_lock:
+        if not pki_cache:
+            from pkicache import PKICache
+
+            pki_cache = PKICache(args.pki_cache)
+        return pki_cache
+
+def get_account_id():
+    global account_id
+
+    with account_id_lock:
+        if not account_id:
+            account_id = get_client('sts').get_caller_identity()['Account']
+        return account_id
+
+
+def get_crl_store(ca_private_key, ca_certificate, freshest_crl):
+    """Returns the CRLStore of a CA, and the lock to hold while using it. A CA
+    has one store a run, which starts from the revocations the PKI cache has
+    for it, as a cached CA can be used again"""
+
+    from crl import CRLStore
+    from pki import get_certificate_id
+
+    certificate_id = get_certificate_id(ca_certificate)
+    with crl_stores_lock:
+        if certificate_id not in crl_stores:
+            crl_store = CRLStore(ca_private_key, ca_certificate,
+                next_update = one_year, freshest_crl = freshest_crl)
+            cache = get_pki_cache()
+            document = cache and cache.revocations(certificate_id)
+            if document:
+                crl_store.load(document)
+            crl_stores[certificate_id] = (crl_store, threading.Lock())
+        return crl_stores[certificate_id]
+
+class CRLS3Publisher():
+
+    def __init__(self, pki_publisher, issuer_private_key, issuer_certificate):
+        from pki import get_certificate_id
+
+        # The URL goes into certificates before the CRL exists, so the key has
+        # to be fixed up front. It is the issuing CA's, and each CRL it issues
+        # replaces the last, holding every revocation so far
+        self.certificate_id = get_certificate_id(issuer_certificate)
+        self.s3_key = self.certificate_id + '.crl'
+        self.delta_s3_key = self.certificate_id + '-delta.crl'
+        self.issuer_private_key = issuer_private_key
+        self.issuer_certificate = issuer_certificate
+        self.pki_publisher = pki_publisher
+
+    def get_url(self):
+        return self.pki_publisher.get_url(self.s3_key)
+
+    def publish_revocations(self, certificates, artifacts = ()):
+        """Revokes certificates, and publishes the CA's next CRL along with
+        artifacts. That is a delta CRL, which the full CRLs point to, while
+        few revocations were added since the last full CRL"""
+
+        from cryptography.hazmat.primitives import serialization
+
+        crl_store, lock = get_crl_store(self.issuer_private_key,
+            self.issuer_certificate, self.pki_publisher.get_url(self.delta_s3_key))
+        with lock:
+            crl_store.revoke_certificates(certificates)
+            crl, delta = crl_store.build_next_crl()
+            self.pki_publisher.publish_batch(list(artifacts) + [(
+                self.delta_s3_key if delta else self.s3_key,
+                crl.public_bytes(serialization.Encoding.PEM))])
+
+            # Only once published, so no delta is issued against a full CRL
+            # that never made it out
+            cache = get_pki_cache()
+            if cache:
+                cache.store_revocations(self.certificate_id, crl_store.dump())
+
+class CAS3Publisher():
+
+    def __init__(self, pki_publisher):
+        self.s3_key = None
+        self.pki_publisher = pki_publisher
+
+    def get_url(self):
+        if not self.s3_key:
+            raise ValueError('The CA certificate has not been published yet')
+
+        return self.pki_publisher.get_url(self.s3_key)
+
+    def artifact(self, ca_certificate):
+        from pki import cert_to_pem
+        from publish import content_digest
+
+        # Keyed by content, so publishing the same CA again is a no-op
+        body = cert_to_pem(ca_certificate)
+        self.s3_key = content_digest(body) + '.crt'
+        return self.s3_key, body
+
+    def publish(self, ca_certificate):
+        self.pki_publisher.publish(*self.artifact(ca_certificate))
+
+def get_rand_string(prefix = None, length = 8,
+    join_char = "-", characters = string.ascii_lowercase):
+
+    str = ''.join(random.choice(characters) for x in range(length))
+    if prefix:
+        str = prefix + join_char + str
+
+    return str
+
+def new_private_key():
+    pool = get_key_pool()
+    if pool:
+        return pool.get()
+
+    from keypool import generate_private_key
+
+    return generate_private_key(args.key_type)
+
+def create_certificate(**kwargs):
+    import pki
+
+    return pki.create_certificate(private_key = new_private_key(), **kwargs)
+
+def get_ca_registration_code():
+
+    # The code is per account and region, so it's fetched once a run, or once
+    # ever with the PKI cache
+    region = get_region()
+    with registration_code_lock:
+        if region not in registration_codes:
+            fetch = lambda: get_iot_client().get_registration_code()['registrationCode']
+            cache = get_pki_cache()
+            registration_codes[region] = cache.registration_code(
+                get_account_id(), region, fetch) if cache else fetch()
+        return registration_codes[region]
+
+def checkout_cached_ca(kind, common_name, not_valid_before, not_valid_after,
+    in_use = None):
+    """Returns a CA from the PKI cache for these parameters, or None, along with
+    where to cache a new one. Without --pki-cache, there is never one"""
+
+    cache = get_pki_cache()
+    if not cache:
+        return None, None
+
+    # Demo names are random, so their CAs are cached by the name's prefix, and
+    # validity is cached relative to now, to the hour
+    demo_name = DEMO_NAME.match(common_name)
+    now = datetime.today()
+    params = {
+        'kind': kind,
+        'name': demo_name.group(1) if demo_name else common_name,
+        'keyType': args.key_type,
+        'validSinceHours': int(round((now - not_valid_before).total_seconds() / 3600)),
+        'validForHours': int(round((not_valid_after - now).total_seconds() / 3600)),
+    }
+    if kind == 'iot_ca':
+        params.update(account = get_account_id(), region = get_region())
+
+    return cache.checkout(params, not_valid_after, in_use)
+
+def create_ca_certificate(common_name, not_valid_before, not_valid_after):
+    """Creates a CA that isn't registered with AWS IoT, or takes one from the PKI cache"""
+
+    cached, cache_slot = checkout_cached_ca(
+        'ca', common_name, not_valid_before, not_valid_after)
+    if cached:
+        return cached['private_key'], cached['certificate']
+
+    private_key, certificate = create_certificate(
+        common_name = common_name,
+        not_valid_before = not_valid_before,
+        not_valid_after = not_valid_after)
+
+    if cache_slot:
+        get_pki_cache().store(cache_slot, private_key, certificate)
+    return private_key, certificate
+
+def create_iot_ca_certificate(common_name,
+    not_valid_before, not_valid_after,
+    crl_distribution_point = None,
+    authority_info_uri = None,
+    issuer_common_name = None,
+    issuer_private_key = None):
+
+    from pki import cert_to_pem, get_certificate_id, get_common_name
+
+    registration_code = get_ca_registration_code()
+
+    # A CA pointing at this run's CRL and issuer URLs, or signed by this run's
+    # root, isn't the same from one run to the next, so isn't cached. A cached
+    # CA still registered, by a run that skipped cleanup, is left to that run
+    cached, cache_slot = None, None
+    if not (crl_distribution_point or authority_info_uri or issuer_private_key):
+        cached, cache_slot = checkout_cached_ca(
+            'iot_ca', common_name, not_valid_before, not_valid_after,
+            in_use = lambda certificate: get_journal().live('ca_certificate',
+                commonName = get_common_name(certificate)))
+
+    if cached:
+        ca_private_key, ca_certificate = cached['private_key'], cached['certificate']
+        common_name = get_common_name(ca_certificate)
+    else:
+        ca_private_key, ca_certificate = \
+            create_certificate(
+                common_name = common_name,
+                not_valid_before = not_valid_before,
+                not_valid_after = not_valid_after,
+                crl_distribution_point = crl_distribution_point,
+                authority_info_uri = authority_info_uri,
+                issuer_common_name = issuer_common_name,
+                issuer_private_key = issuer_private_key,
+                is_ca_certificate = True)
+
+    if cached and cached['registration_code'] == registration_code:
+        ca_check_certificate = cached['verification_certificate']
+    else:
+        ca_check_private_key, ca_check_certificate = \
+            create_certificate(
+                common_name = registration_code,
+                not_valid_before = not_valid_before,
+                not_valid_after = not_valid_after,
+                issuer_common_name =  common_name,
+                issuer_private_key = ca_private_key)
+
+        if cache_slot:
+            get_pki_cache().store(cache_slot, ca_private_key, ca_certificate,
+                ca_check_certificate, registration_code)
+
+    key = get_journal().creating('ca_certificate',
+        get_certificate_id(ca_certificate), commonName = common_name)
+
+    ca_certificate_id = \
+        get_iot_client().register_ca_certificate(
+            caCertificate = cert_to_pem(ca_certificate),
+            verificationCertificate = cert_to_pem(ca_check_certificate),
+            setAsActive = True)['certificateId']
+
+    get_journal().created(key, ca_certificate_id)
+    return ca_private_key, ca_certificate
+
+def create_iot_certificate(common_name,
+    issuer_certificate, issuer_private_key,
+    not_valid_before, not_valid_after,
+    crl_distribution_point = None):
+
+    from pki import cert_to_pem, get_certificate_id, get_common_name
+
+    private_key, certificate = create_certificate(
+        common_name = common_name,
+        not_valid_before = not_valid_before,
+        not_valid_after = not_valid_after,
+        issuer_common_name =  get_common_name(issuer_certificate),
+        issuer_private_key = issuer_private_key,
+        crl_distribution_point = crl_distribution_point)
+
+    key = get_journal().creating('certificate',
+        get_certificate_id(certificate), commonName = common_name)
+
+    registered_certificate = get_iot_client().register_certificate(
+        certificatePem = cert_to_pem(certificate),
+        caCertificatePem = cert_to_pem(issuer_certificate),
+        setAsActive = True)
+
+    get_journal().created(key, registered_certificate['certificateId'])
+    return private_key, certificate, registered_certificate['certificateArn']
+
+def create_iot_policy(policy_name, policy_document):
+
+    key = get_journal().creating('policy', policy_name)
+
+    get_iot_client().create_policy(
+        policyName = policy_name,
+        policyDocument = json.dumps(policy_document))
+
+    get_journal().created(key)
+
+    return policy_name
+
+def attach_iot_policy(certificate_arn, policy_name, policy_document):
+
+    policy_name = create_iot_policy(
+        policy_name = policy_name,
+        policy_document = policy_document)
+
+    get_iot_client().attach_policy(
+        policyName = policy_name, target = certificate_arn)
+
+    return policy_name
+
+def demo_iot_ca_expiring_soon(
+    demo_id = 'demo_iot_ca_expiring_soon'):
+
+    logger.info(demo_id)
+
+    not_valid_before = datetime.today() - one_day
+    not_valid_after = datetime.today() + one_day
+
+    create_iot_ca_certificate(
+        common_name = get_rand_string(demo_id),
+        not_valid_before = not_valid_before,
+        not_valid_after = not_valid_after)
+
+def demo_iot_ca_revoked(
+    demo_id = 'demo_iot_ca_revoked'):
+
+    from pki import get_common_name
+
+    logger.info(demo_id)
+
+    ca_s3_publisher = CAS3Publisher(get_pki_publisher())
+
+    root_ca_private_key, root_ca_certificate = \
+        create_ca_certificate(
+            common_name = get_rand_string(demo_id),
+            not_valid_before = datetime.today() - one_year,
+            not_valid_after = datetime.today() + one_year)
+
+    # Published along with the CRL, once the CA it revokes exists
+    ca_artifact = ca_s3_publisher.artifact(root_ca_certificate)
+
+    crl_s3_publisher = CRLS3Publisher(
+        get_pki_publisher(), root_ca_private_key, root_ca_certificate)
+
+    ca_private_key, ca_certificate = \
+        create_iot_ca_certificate(
+            common_name = get_rand_string(demo_id),
+            not_valid_before = datetime.today() - one_day,
+            not_valid_after = datetime.today() + one_year,
+            issuer_common_name = get_common_name(root_ca_certificate),
+            issuer_private_key = root_ca_private_key,
+            crl_distribution_point = crl_s3_publisher.get_url(),
+            authority_info_uri = ca_s3_publisher.get_url())
+
+    crl_s3_publisher.publish_revocations([ca_certificate], [ca_artifact])
+
+def demo_iot_cert_expiring_soon(
+    demo_id = 'demo_iot_cert_expiring_soon'):
+
+    logger.info(demo_id)
+
+    ca_private_key, ca_certificate = \
+        create_iot_ca_certificate(
+            common_name = get_rand_string(demo_id),
+            not_valid_before = datetime.today() - one_day,
+            not_valid_after = datetime.today() + one_year)
+
+    create_iot_certificate(
+        common_name = get_rand_string(demo_id),
+        issuer_certificate = ca_certificate,
+        issuer_private_key = ca_private_key,
+        not_valid_before = datetime.today() - one_day,
+        not_valid_after = datetime.today() + one_day)
+
+def demo_iot_cert_revoked(
+    demo_id = 'demo_iot_cert_revoked'):
+
+    logger.info(demo_id)
+
+    ca_private_key, ca_certificate = \
+        create_iot_ca_certificate(
+            common_name = get_rand_string(demo_id),
+            not_valid_before = datetime.today() - one_day,
+            not_valid_after = datetime.today() + one_year)
+
+    crl_s3_publisher = CRLS3Publisher(
+        get_pki_publisher(), ca_private_key, ca_certificate)
+
+    private_key, certificate, certificate_arn = \
+        create_iot_certificate(
+            common_name = get_rand_string(demo_id),
+            issuer_certificate = ca_certificate,
+            issuer_private_key = ca_private_key,
+            not_valid_before = datetime.today() - one_day,
+            not_valid_after = datetime.today() + one_year,
+            crl_distribution_point = crl_s3_publisher.get_url())
+
+    crl_s3_publisher.publish_revocations([certificate])
+
+def get_bulk_output():
+    '''--bulk-output, or with several regions, a file of its own for each'''
+
+    if len(args.regions) == 1:
+        return args.bulk_output
+    root, extension = os.path.splitext(args.bulk_output)
+    return '%s.%s%s' % (root, get_region(), extension)
+
+def demo_bulk_device_certificates(
+    count = None, output_path = None, demo_id = 'demo_bulk_device_certificates'):
+
+    from bulkmint import mint_device_certificates
+
+    logger.info(demo_id)
+
+    ca_private_key, ca_certificate = \
+        create_iot_ca_certificate(
+            common_name = get_rand_string(demo_id),
+            not_valid_before = datetime.today() - one_day,
+            not_valid_after = datetime.today() + one_year)
+
+    common_names = (get_rand_string(demo_id)
+        for _ in range(count or args.bulk_device_certificates))
+
+    mint_device_certificates(
+        iot_client = get_iot_client(),
+        issuer_private_key = ca_private_key,
+        issuer_certificate = ca_certificate,
+        common_names = common_names,
+        not_valid_before = datetime.today() - one_day,
+        not_valid_after = datetime.today() + one_year,
+        output_path = output_path or get_bulk_output(),
+        key_type = args.key_type,
+        workers = args.workers,
+        journal = get_journal(),
+        sign_pool = get_sign_pool())
+
+def demo_iot_permissive_policy(
+    demo_id = 'demo_iot_permissive_policy'):
+
+    logger.info(demo_id)
+
+    create_iot_policy(
+        policy_name = get_rand_string(demo_id),
+        policy_document = {
+            "Version": "2012-10-17",
+            "Statement": [{
+                "Effect": "Allow",
+                "Action": "iot:*",
+                "Resource": "*"
+            }]
+        })
+
+def demo_disable_iot_logging(
+    demo_id = 'demo_disable_iot_logging'):
+
+    logger.info(demo_id)
+
+    # Copies run one at a time, so only the first one to find logging enabled
+    # journals the level cleanup restores
+    with logging_options_lock:
+        try:
+            default_log_level = \
+                get_iot_client().get_v2_logging_options()['defaultLogLevel']
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') == 'NotConfiguredException':
+                default_log_level = 'DISABLED'
+            else:
+                logger.error('Unexpected error: %s' % e)
+                return
+
+        if default_log_level != 'DISABLED':
+            # Logging options are per region, so journaled by region
+            key = get_journal().creating('v2_logging_options', get_region(),
+                defaultLogLevel = default_log_level)
+
+            get_iot_client().set_v2_logging_options(
+                defaultLogLevel = 'DISABLED', disableAllLogs = True)
+
+            get_journal().created(key)
+
+# One subcommand per scenario, in the order "all" runs them
+SCENARIOS = OrderedDict([
+    ('cert-expiring-soon', demo_iot_cert_expiring_soon),
+    ('cert-revoked', demo_iot_cert_revoked),
+    ('ca-expiring-soon', demo_iot_ca_expiring_soon),
+    ('ca-revoked', demo_iot_ca_revoked),
+    ('permissive-policy', demo_iot_permissive_policy),
+    ('disable-logging', demo_disable_iot_logging),
+    ('bulk-device-certificates', demo_bulk_device_certificates),
+])
+
+def run_scenario(region, name, copy):
+
+    from clients import in_region
+    from profiling import phase
+
+    start = time.time()
+    try:
+        with phase('scenario:' + name):
+            in_region(region, SCENARIOS[name])
+        return region, name, copy, time.time() - start, None
+    except Exception as e:
+        seconds = time.time() - start
+        # Logged here, where the traceback is still at hand
+        logger.exception('Scenario %s (copy %d) failed in %s after %.1fs: %s' % (
+            name, copy + 1, region, seconds, e))
+        return region, name, copy, seconds, e
+
+def run_scenarios(names, copies = 1, workers = 1, regions = None):
+    """Runs copies of each scenario in each region on worker threads, workers for
+    every region, and returns a (region, name, copy, seconds, error) tuple per run.
+    Scenarios share no state, and the crypto they do runs with the GIL released (or
+    in the key pool's processes), so key generation overlaps as well as the API calls"""
+
+    from multiprocessing.pool import ThreadPool
+
+    regions = regions or [get_region()]
+    pool = ThreadPool(max(1, workers) * len(regions))
+    try:
+        # First copies of every scenario first, so a few workers still cover them all early
+        runs = [pool.apply_async(run_scenario, (region, name, copy))
+            for copy in range(copies) for name in names for region in regions]
+    finally:
+        pool.close()
+        pool.join()
+
+    return [run.get() for run in runs]
+
+def cleanup():
+
+    if cleanup_required:
+        from clients import fan_out
+
+        # Every region is cleaned up at once, each with a teardown plan of its own
+        for region, (_, seconds, error) in fan_out(args.regions, cleanup_region).items():
+            if error:
+                logger.error('Cleanup in %s failed after %.1fs: %s' % (region, seconds, error))
+
+def cleanup_region():
+
+    from profiling import phase
+
+    with phase('cleanup'):
+        cleanup_region_resources()
+
+def cleanup_region_resources():
+
+    from teardown import TeardownPlan
+
+    # The cleanup command removes everything journaled, a run only what it created
+    match = {} if args.command == 'cleanup' else {'run': run_id}
+    journal = get_journal()
+    region = get_region()
+
+    def live(resource_type):
+        # Resources journaled before regions were are taken to be in the first region
+        return [entry for entry in journal.live(resource_type, **match)
+            if entry.get('region', args.regions[0]) == region]
+
+    def on_done(key):
+        if key[0] in DELETE_CALLS:
+            journal.deleted(DELETE_CALLS[key[0]], key[1])
+
+    plan = TeardownPlan(on_done)
+    cert_deletes = cleanup_iot_certs(plan, live('certificate'))
+    cleanup_iot_cas(plan, cert_deletes, live('ca_certificate'))
+    cleanup_iot_policies(plan, live('policy'))
+
+    for key, error in plan.run(workers = args.workers):
+        logger.error('Failed %s in %s: %s' % (' '.join(key), region, error))
+
+    cleanup_iot_logging_changes(live('v2_logging_options'))
+    journal.sync()
+
+def cleanup_iot_cas(plan, cert_deletes, cas):
+
+    logger.info('Cleaning up IoT CAs')
+    iot_client = get_iot_client()
+    for ca in cas:
+        ca_cert_id = ca['id']
+        deactivate = plan.add(('update_ca_certificate', ca_cert_id),
+            iot_client.update_ca_certificate,
+            certificateId = ca_cert_id,
+            newStatus = 'INACTIVE')
+
+        # A CA can't be deleted while certificates registered under it remain
+        plan.add(('delete_ca_certificate', ca_cert_id),
+            iot_client.delete_ca_certificate,
+            after = [deactivate] + cert_deletes,
+            certificateId = ca_cert_id)
+
+def cleanup_iot_certs(plan, certificates):
+
+    logger.info('Cleaning up IoT certificates')
+    iot_client = get_iot_client()
+    cert_deletes = []
+    for certificate in certificates:
+        cert_id = certificate['id']
+        deactivate = plan.add(('update_certificate', cert_id),
+            iot_client.update_certificate,
+            certificateId = cert_id,
+            newStatus = 'INACTIVE')
+
+        cert_deletes.append(plan.add(('delete_certificate', cert_id),
+            iot_client.delete_certificate,
+            after = [deactivate],
+            certificateId = cert_id,
+            forceDelete = True))
+
+    return cert_deletes
+
+def cleanup_iot_policies(plan, policies):
+
+    logger.info('Cleaning up IoT policies')
+    iot_client = get_iot_client()
+    for policy in policies:
+        policy_name = policy['id']
+        list_targets = ('list_targets_for_policy', policy_name)
+        delete_policy = ('delete_policy', policy_name)
+
+        def detach_targets(policyName, plan = plan, delete_policy = delete_policy):
+            # Targets are only known once listed, so the detaches join the plan here
+            targets = iot_client.list_targets_for_policy(
+                policyName = policyName)['targets']
+
+            for target in targets:
+                plan.add_dependency(delete_policy, plan.add(
+                    ('detach_policy', policyName, target),
+                    iot_client.detach_policy,
+                    policyName = policyName, target = target))
+
+        plan.add(list_targets, detach_targets, policyName = policy_name)
+        plan.add(delete_policy, iot_client.delete_policy,
+            after = [list_targets], policyName = policy_name)
+
+def cleanup_iot_logging_changes(logging_options):
+
+    logger.info('Cleaning up IoT logging changes')
+    for options in logging_options:
+        get_iot_client().set_v2_logging_options(
+            defaultLogLevel = options['defaultLogLevel'],
+            disableAllLogs = False)
+
+        get_journal().deleted('v2_logging_options', options['id'])
+
+def find_demo_resources():
+    """Journals every CA, certificate and policy found in the account with a demo
+    name, for resources left by runs that predate the journal or used another one"""
+
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from pki import get_common_name
+
+    logger.info('Finding IoT resources left by earlier runs')
+    iot_client = get_iot_client()
+    journal = get_journal()
+
+    def found(resource_type, resource_id):
+        if not journal.get(resource_type, resource_id):
+            journal.created(journal.creating(resource_type, resource_id))
+
+    for page in iot_client.get_paginator('list_policies').paginate():
+        for policy in page['policies']:
+            if DEMO_NAME.match(policy['policyName']):
+                found('policy', policy['policyName'])
+
+    for page in iot_client.get_paginator('list_ca_certificates').paginate():
+        for ca in page['certificates']:
+            ca_certificate = x509.load_pem_x509_certificate(
+                iot_client.describe_ca_certificate(certificateId = ca['certificateId'])
+                    ['certificateDescription']['certificatePem'].encode('ascii'),
+                default_backend())
+
+            if not DEMO_NAME.match(get_common_name(ca_certificate)):
+                continue
+
+            found('ca_certificate', ca['certificateId'])
+            for cert_page in iot_client.get_paginator('list_certificates_by_ca').paginate(
+                    caCertificateId = ca['certificateId']):
+                for cert in cert_page['certificates']:
+                    found('certificate', cert['certificateId'])
+
+def add_options(parser, required = True):
+
+    parser.add_argument('--region', required = required, action = 'append', dest = 'regions',
+        help = 'Region to set up or clean up in. May be repeated, or a comma separated list, to work in every region at once')
+    parser.add_argument('--skip-cleanup', default = False, action = 'store_true',
+        help = 'Accepted for compatibility: the resources set up are left for the audit to find')
+    parser.add_argument('--cleanup-on-exit', default = False, action = 'store_true',
+        help = 'Once set up, wait for enter, then remove what this run created. Also removes it if the run fails')
+    parser.add_argument('--workers', type = int, default = 16,
+        help = 'Number of API calls made concurrently during bulk minting and cleanup, in each region')
+    parser.add_argument('--key-type', choices = KEY_TYPES, default = 'rsa',
+        help = 'Type of private key generated for CA and device certificates')
+    parser.add_argument('--key-pool-size', type = int, default = 0,
+        help = 'Number of private keys to generate ahead of time in worker processes (0 disables the pool)')
+    parser.add_argument('--bulk-device-certificates', type = int, default = 0,
+        help = 'Number of device certificates to mint and register under one extra CA')
+    parser.add_argument('--bulk-output', default = 'bulk-device-certificates.jsonl',
+        help = 'File each bulk minted certificate and private key is appended to')
+    parser.add_argument('--pki-bucket',
+        help = 'Existing S3 bucket to publish CA certificates and CRLs to, instead of creating a new one')
+    parser.add_argument('--pki-dir',
+        help = 'Publish CA certificates and CRLs to this local directory instead of S3')
+    parser.add_argument('--pki-cache',
+        help = 'Directory CAs and verification certificates are cached in, for later runs to reuse')
+    parser.add_argument('--api-stats', default = False, action = 'store_true',
+        help = 'Print call counts, latencies, retries and throttling per API operation at exit')
+    parser.add_argument('--api-report',
+        help = 'Also write the API call stats to this file, as JSON if it ends in .json, Prometheus text otherwise')
+    parser.add_argument('--copies', type = int, default = 1,
+        help = 'Number of times each scenario is set up, to seed a large audit test account')
+    parser.add_argument('--scenario-workers', type = int, default = 6,
+        help = 'Number of scenarios set up concurrently in each region')
+    parser.add_argument('--journal', default = 'audit-resources.journal',
+        help = 'File every resource created is journaled to, for cleanup to replay')
+    parser.add_argument('--rate-limit', action = 'append', default = [],
+        dest = 'rate_limits', metavar = '[OPERATION=]RATE',
+        help = 'Limit IoT API calls to RATE per second, for every operation or just OPERATION (e.g. RegisterCertificate=10). May be repeated')
+    parser.add_argument('--profile', nargs = '?', const = 'timers',
+        choices = PROFILE_MODES,
+        help = 'Print how wall and CPU time split between scenarios, cleanup stages, key generation, signing, PEM serialization and API calls at exit. cprofile also runs cProfile in each scenario, sample also samples stacks for flame graphs')
+    parser.add_argument('--profile-output', metavar = 'PREFIX',
+        help = 'Also write the profile to PREFIX.json, and the cProfile statistics or sampled stacks next to it')
+
+def parse_args(argv = None):
+
+    parser = argparse.ArgumentParser(
+        description = 'AWS IoT Device Defender Demo')
+    add_options(parser)
+    commands = parser.add_subparsers(dest = 'command', metavar = 'COMMAND',
+        help = 'Scenario to set up, "all" (the default) for every one of them, or "cleanup" '
+               'to remove the resources earlier runs left behind')
+    commands.add_parser('all',
+        help = 'Set up every scenario, plus bulk device certificates if --bulk-device-certificates is set')
+    for name, demo in SCENARIOS.items():
+        command = commands.add_parser(name, help = 'Set up only the %s scenario' % name)
+        if name == 'bulk-device-certificates':
+            command.add_argument('bulk_device_certificates', metavar = 'COUNT', type = int,
+                help = 'Number of device certificates to mint')
+    command = commands.add_parser('cleanup',
+        help = 'Remove every resource in the journal, resuming where an earlier cleanup stopped')
+    command.add_argument('--scan', default = False, action = 'store_true',
+        help = 'First search the account for resources with demo names that are missing from the journal')
+
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # The scenario used to be implied, so runs without one keep setting up everything.
+    # The options are parsed first, so an option's value is never taken for a command
+    options = argparse.ArgumentParser(add_help = False)
+    add_options(options, required = False)
+    _, rest = options.parse_known_args(argv)
+    positionals = [arg for arg in rest if not arg.startswith('-')]
+    if not positionals or positionals[0] not in commands.choices:
+        argv.append('all')
+
+    return parser.parse_args(argv)
+
+def configure(parsed_args):
+    """Sets the module up for parsed_args. Clients are created on first use"""
+
+    global args, api_stats, client_factory, cleanup_required, run_id
+
+    from clients import ClientFactory, parse_regions
+
+    args = parsed_args
+    args.regions = parse_regions(args.regions)
+    run_id = str(uuid.uuid4())
+    # Setup leaves what it creates for the audit to find, unless asked to remove it
+    cleanup_required = args.command == 'cleanup' or args.cleanup_on_exit
+
+    if args.api_stats or args.api_report:
+        from instrumentation import ApiCallStats
+
+        api_stats = ApiCallStats()
+        atexit.register(api_stats.print_summary)
+        if args.api_report:
+            atexit.register(api_stats.write_report, args.api_report)
+
+    profiler = None
+    if args.profile or args.profile_output:
+        from profiling import PhaseProfiler, enable
+        # Loaded first, so their helpers are timed too
+        import keypool
+        import pki
+
+        profiler = enable(PhaseProfiler(args.profile or 'timers'))
+        profiler.wrap_crypto()
+        atexit.register(profiler.print_summary)
+        if args.profile_output:
+            atexit.register(profiler.write_report, args.profile_output)
+
+    # A region's clients are shared by its scenarios and all of their workers
+    client_factory = ClientFactory(
+        max_pool_connections = max(args.workers, args.scenario_workers),
+        rate_limits = args.rate_limits,
+        api_stats = api_stats,
+        profiler = profiler)
+
+def main(argv = None):
+
+    global cleanup_required
+
+    configure(parse_args(argv))
+
+    try:
+        if args.command == 'cleanup':
+            if args.scan:
+                from clients import fan_out
+
+                for region, (_, seconds, error) in fan_out(args.regions, find_demo_resources).items():
+                    if error:
+                        logger.error('Scan of %s failed after %.1fs: %s' % (region, seconds, error))
+            return
+
+        logger.info('Setting up device defender demo...')
+
+        if args.command == 'all':
+            names = [name for name in SCENARIOS
+                if name != 'bulk-device-certificates' or args.bulk_device_certificates > 0]
+        else:
+            names = [args.command]
+
+        # Any key pool and signing processes are forked before the scenario threads start
+        get_key_pool()
+        if 'bulk-device-certificates' in names:
+            get_sign_pool()
+
+        start = time.time()
+        results = run_scenarios(names, args.copies, args.scenario_workers, args.regions)
+        if len(args.regions) > 1:
+            for region in args.regions:
+                region_results = [result for result in results if result[0] == region]
+                logger.info('%s: set up %d of %d scenario runs' % (region,
+                    sum(1 for result in region_results if not result[4]), len(region_results)))
+        logger.info('Set up %d of %d scenario runs in %.1fs' % (
+            sum(1 for result in results if not result[4]), len(results), time.time() - start))
+
+        if pki_publisher:
+            logger.info('Published PKI artifacts: ' + pki_publisher.summary())
+
+        if cleanup_required:
+            from six.moves import input
+
+            try:
+                input('\nPress enter to exit and cleanup...')
+            except EOFError:
+                # Nobody to press enter, e.g. stdin closed: leave the resources to be audited
+                cleanup_required = False
+                logger.info('No input, leaving the resources set up. Remove them with the cleanup command')
+    finally:
+        cleanup()
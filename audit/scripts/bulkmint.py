@@ -0,0 +1,191 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+Streaming pipeline minting many device certificates under one CA.
+
+Key generation and signing run in a process pool, registration with AWS IoT
+runs in a thread pool, and each registered certificate is written to the
+output file as a JSON line as soon as it completes. A bounded number of
+certificates are in flight at any time, so memory use doesn't grow with the
+number of certificates minted. The process pool can be shared by several runs,
+and is best started before the process starts any threads: a child forked while
+another thread holds a lock can deadlock.
+'''
+
+import json
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+from keypool import generate_private_key
+from pki import cert_to_pem, privkey_to_pem, get_certificate_id, get_common_name, create_certificate
+
+logger = logging.getLogger('aws-iot-device-defender-demo')
+
+# Issuer private key and common name by issuer key, loaded once in each worker process
+signers = {}
+
+def get_signer(issuer_private_key_der, issuer_certificate_pem):
+
+    if issuer_private_key_der not in signers:
+        issuer_certificate = x509.load_pem_x509_certificate(
+            issuer_certificate_pem, default_backend())
+        signers[issuer_private_key_der] = (
+            serialization.load_der_private_key(
+                issuer_private_key_der, password = None, backend = default_backend()),
+            get_common_name(issuer_certificate))
+    return signers[issuer_private_key_der]
+
+def sign_device_certificate(issuer, common_name, not_valid_before, not_valid_after,
+    crl_distribution_point):
+
+    # Exceptions are returned rather than raised so the pipeline always hears
+    # back about every certificate it has in flight. That is all there is on
+    # Python 2, whose pool has no error_callback for a task that fails outside
+    # of this, such as one whose result can't be pickled
+    try:
+        issuer_private_key_der, issuer_certificate_pem, key_type = issuer
+        issuer_private_key, issuer_common_name = get_signer(
+            issuer_private_key_der, issuer_certificate_pem)
+        private_key, certificate = create_certificate(
+            common_name = common_name,
+            not_valid_before = not_valid_before,
+            not_valid_after = not_valid_after,
+            issuer_common_name = issuer_common_name,
+            issuer_private_key = issuer_private_key,
+            crl_distribution_point = crl_distribution_point,
+            private_key = generate_private_key(key_type))
+
+        return common_name, get_certificate_id(certificate), \
+            cert_to_pem(certificate), privkey_to_pem(private_key), None
+    except Exception as e:
+        return common_name, None, None, None, str(e)
+
+def mint_device_certificates(iot_client, issuer_private_key, issuer_certificate,
+    common_names, not_valid_before, not_valid_after, output_path,
+    crl_distribution_point = None, key_type = 'rsa', processes = None,
+    workers = 16, max_in_flight = None, journal = None, sign_pool = None):
+    '''
+    Signs and registers a certificate for every common name, appending
+    {commonName, certificateId, certificateArn, certificatePem, privateKey}
+    to output_path for each one, and journaling each registration in journal,
+    if given. Certificates are signed in sign_pool, a multiprocessing.Pool
+    left open for its owner, or else in a pool of processes started here.
+    Returns the number of certificates registered.
+    '''
+
+    max_in_flight = max_in_flight or 2 * workers
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    output_lock = threading.Lock()
+    registered = [0]
+
+    issuer_private_key_der = issuer_private_key.private_bytes(
+        encoding = serialization.Encoding.DER,
+        format = serialization.PrivateFormat.PKCS8,
+        encryption_algorithm = serialization.NoEncryption())
+    issuer_certificate_pem = cert_to_pem(issuer_certificate)
+    issuer = (issuer_private_key_der, issuer_certificate_pem, key_type)
+
+    def register(signed):
+        common_name, certificate_id, certificate_pem, private_key_pem, error = signed
+        try:
+            if error:
+                logger.error('Failed signing certificate %s: %s' % (common_name, error))
+                return
+
+            if journal:
+                key = journal.creating('certificate', certificate_id, commonName = common_name)
+
+            response = iot_client.register_certificate(
+                certificatePem = certificate_pem,
+                caCertificatePem = issuer_certificate_pem,
+                setAsActive = True)
+
+            if journal:
+                journal.created(key, response['certificateId'])
+
+            line = json.dumps({
+                'commonName': common_name,
+                'certificateId': response['certificateId'],
+                'certificateArn': response['certificateArn'],
+                'certificatePem': certificate_pem.decode('ascii'),
+                'privateKey': private_key_pem.decode('ascii')})
+
+            with output_lock:
+                output_file.write(line + '\n')
+                output_file.flush()
+                registered[0] += 1
+        except Exception as e:
+            logger.error('Failed registering certificate %s: %s' % (common_name, e))
+        finally:
+            in_flight.release()
+
+    def signed(result):
+        # Runs in the pool's result thread, which stops for good if this raises
+        try:
+            register_pool.apply_async(register, (result,))
+        except Exception as e:
+            logger.error('Failed registering certificate %s: %s' % (result[0], e))
+            in_flight.release()
+
+    def sign_failed(common_name):
+        return lambda e: signed((common_name, None, None, None, str(e)))
+
+    own_pool = sign_pool is None
+    if own_pool:
+        sign_pool = multiprocessing.Pool(processes)
+    register_pool = ThreadPool(workers)
+
+    start = time.time()
+    with open(output_path, 'a') as output_file:
+        try:
+            for common_name in common_names:
+                # Stop handing out work until a registration has finished
+                in_flight.acquire()
+                callbacks = {'callback': signed}
+                if sys.version_info[0] > 2:
+                    callbacks['error_callback'] = sign_failed(common_name)
+                try:
+                    sign_pool.apply_async(sign_device_certificate,
+                        (issuer, common_name, not_valid_before, not_valid_after, crl_distribution_point),
+                        **callbacks)
+                except Exception:
+                    in_flight.release()
+                    raise
+        finally:
+            if own_pool:
+                sign_pool.close()
+                sign_pool.join()
+            else:
+                # A shared pool stays open, so this run is done once every certificate
+                # has been registered and given back its place in flight
+                for _ in range(max_in_flight):
+                    in_flight.acquire()
+            register_pool.close()
+            register_pool.join()
+
+    elapsed = time.time() - start
+    logger.info('Minted %d device certificates in %.2fs (%.1f certs/sec)' %
+        (registered[0], elapsed, registered[0] / elapsed if elapsed else 0.0))
+
+    return registered[0]
@@ -0,0 +1,144 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+Pool of private keys generated ahead of time in worker processes, so that
+minting a certificate doesn't have to wait on RSA key generation.
+
+    python keypool.py --count 50 --key-type rsa --pool-size 16
+
+compares certificates minted per second with and without the pool.
+'''
+
+import collections
+import multiprocessing
+import threading
+import time
+import uuid
+import argparse
+
+from datetime import datetime
+from datetime import timedelta
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+
+KEY_TYPES = ('rsa', 'ec')
+
+def generate_private_key(key_type = 'rsa'):
+
+    if key_type == 'ec':
+        return ec.generate_private_key(ec.SECP256R1(), default_backend())
+
+    return rsa.generate_private_key(
+        public_exponent = 65537,
+        key_size = 2048,
+        backend = default_backend())
+
+def generate_private_key_der(key_type):
+
+    # Key objects can't be pickled, so they travel back from the worker as DER
+    return generate_private_key(key_type).private_bytes(
+        encoding = serialization.Encoding.DER,
+        format = serialization.PrivateFormat.PKCS8,
+        encryption_algorithm = serialization.NoEncryption())
+
+class KeyPool():
+
+    def __init__(self, key_type = 'rsa', size = 16, processes = None):
+        if key_type not in KEY_TYPES:
+            raise ValueError('Unsupported key type: %s' % key_type)
+
+        self.key_type = key_type
+        self.pool = multiprocessing.Pool(processes)
+        self.pending = collections.deque()
+        self.lock = threading.Lock()
+
+        for _ in range(size):
+            self._refill()
+
+    def _refill(self):
+        self.pending.append(self.pool.apply_async(
+            generate_private_key_der, (self.key_type,)))
+
+    def get(self):
+        '''Returns the oldest pre-generated key and starts generating its replacement'''
+        # Taken under the lock, so concurrent callers never find the queue empty
+        with self.lock:
+            pending = self.pending.popleft()
+            self._refill()
+
+        der = pending.get()
+        return serialization.load_der_private_key(
+            der, password = None, backend = default_backend())
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+def mint_certificate(private_key):
+
+    name = x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, u'keypool-benchmark')])
+
+    builder = x509.CertificateBuilder()
+    builder = builder.subject_name(name)
+    builder = builder.issuer_name(name)
+    builder = builder.not_valid_before(datetime.today() - timedelta(1))
+    builder = builder.not_valid_after(datetime.today() + timedelta(1))
+    builder = builder.serial_number(int(uuid.uuid4()))
+    builder = builder.public_key(private_key.public_key())
+
+    return builder.sign(
+        private_key = private_key,
+        algorithm = hashes.SHA256(),
+        backend = default_backend())
+
+def benchmark(count, key_type, pool_size):
+
+    start = time.time()
+    for _ in range(count):
+        mint_certificate(generate_private_key(key_type))
+    unpooled = count / (time.time() - start)
+
+    key_pool = KeyPool(key_type = key_type, size = pool_size)
+    try:
+        start = time.time()
+        for _ in range(count):
+            mint_certificate(key_pool.get())
+        pooled = count / (time.time() - start)
+    finally:
+        key_pool.close()
+
+    print('%s keys, %d certificates' % (key_type, count))
+    print('  without pool: %8.1f certs/sec' % unpooled)
+    print('  with pool:    %8.1f certs/sec (%d keys ahead, %d processes)' %
+        (pooled, pool_size, multiprocessing.cpu_count()))
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description = 'Benchmark certificate minting with and without a key pool')
+    parser.add_argument('--count', type = int, default = 50,
+        help = 'Number of certificates to mint in each run')
+    parser.add_argument('--key-type', choices = KEY_TYPES, default = 'rsa',
+        help = 'Type of private key to generate')
+    parser.add_argument('--pool-size', type = int, default = 16,
+        help = 'Number of keys the pool generates ahead of time')
+    args = parser.parse_args()
+
+    benchmark(args.count, args.key_type, args.pool_size)
@@ -0,0 +1,327 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+Offline analysis of the AWSIotLogsV2 logs AWS IoT writes once logging is enabled,
+as exported from CloudWatch Logs, for the things and clients failing most often.
+
+Connect and publish events that failed, and disconnects the client didn't ask for,
+are counted by event, by failure reason, and by client id and thing. Plain files
+are memory mapped and cut into ranges of whole lines, which a process pool parses
+in parallel; gzipped exports are each streamed by one process. Only lines that can
+be failures are parsed as JSON at all. There can be millions of client ids, so the
+ones failing most are kept in fixed size Space-Saving sketches, which the workers'
+results are merged into, and whose counts are exact unless more distinct ids fail
+than a sketch holds:
+
+    python log_analyze.py exported-logs/ --journal ../../certificates/resources.journal
+
+prints a JSON report. Thing names come from each event's thingName or, given the
+journals provision_thing.py keeps, from the certificate the client connected with.
+'''
+
+import argparse
+import gzip
+import json
+import mmap
+import multiprocessing
+import os
+import sys
+import time
+
+from collections import OrderedDict
+
+# Thing names are looked up in the provisioning scripts' journals
+sys.path.append(os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), os.pardir, os.pardir, 'scripts'))
+
+# The failures counted, by the eventType of the events counted as each
+CATEGORIES = OrderedDict([
+    ('Connect', 'connect'),
+    ('Disconnect', 'disconnect'),
+    ('Publish-In', 'publish'),
+    ('Publish-Out', 'publish'),
+])
+
+CLIENT_DISCONNECT = 'CLIENT_INITIATED_DISCONNECT'
+
+# Every failure line has one of these in it, so lines without either aren't parsed
+FAILURE_MARKER = b'Failure'
+DISCONNECT_MARKER = b'Disconnect'
+CLIENT_DISCONNECT_MARKER = CLIENT_DISCONNECT.encode('ascii')
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Certificate id -> thing name, set before the pool forks so workers share it
+certificate_things = {}
+
+class TopK():
+    '''
+    A Space-Saving sketch of the keys counted most, holding at most capacity of
+    them. A key first counted after others were dropped may have been among them,
+    so it starts at the highest count dropped, which is its error: its count is
+    never low, and never high by more than the error. Keys are dropped in batches,
+    once twice capacity are held, so counting one costs O(1) amortized.
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Key -> [count, error]
+        self.counters = {}
+        self.floor = 0
+
+    def add(self, key, count = 1):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += count
+            return
+        self.counters[key] = [self.floor + count, self.floor]
+        if len(self.counters) >= 2 * self.capacity:
+            self._prune()
+
+    def _prune(self):
+        ranked = sorted(self.counters.items(), key = lambda item: item[1][0], reverse = True)
+        if len(ranked) > self.capacity:
+            self.floor = max(self.floor, ranked[self.capacity][1][0])
+        self.counters = dict(ranked[:self.capacity])
+
+    def merge(self, other):
+        '''Adds the counts of another sketch. A key one of them doesn't hold may
+        have been dropped by it, so it could have up to that sketch's floor more'''
+
+        for key, (count, error) in other.counters.items():
+            counter = self.counters.get(key)
+            if counter is None:
+                self.counters[key] = [count + self.floor, error + self.floor]
+            else:
+                counter[0] += count
+                counter[1] += error
+        for key, counter in self.counters.items():
+            if key not in other.counters:
+                counter[0] += other.floor
+                counter[1] += other.floor
+        self.floor += other.floor
+        self._prune()
+
+    def top(self, k = None):
+        '''Returns the k keys counted most, as (key, count, error), most first'''
+
+        ranked = sorted(self.counters.items(), key = lambda item: (-item[1][0], item[0]))
+        return [(key, count, error) for key, (count, error) in ranked[:k or self.capacity]]
+
+class LogSummary():
+
+    def __init__(self, capacity):
+        self.lines = 0
+        self.bytes = 0
+        self.parsed = 0
+        self.errors = 0
+        self.failures = OrderedDict((category, 0) for category in CATEGORIES.values())
+        self.reasons = dict((category, {}) for category in CATEGORIES.values())
+        self.by_client = dict((category, TopK(capacity)) for category in CATEGORIES.values())
+        self.by_thing = dict((category, TopK(capacity)) for category in CATEGORIES.values())
+
+    def add_lines(self, lines):
+        for line in lines:
+            if not line:
+                continue
+            self.lines += 1
+            if FAILURE_MARKER in line or (
+                    DISCONNECT_MARKER in line and CLIENT_DISCONNECT_MARKER not in line):
+                self.add_event(line)
+
+    def add_event(self, line):
+        # CloudWatch exports put a timestamp in front of each event
+        start = line.find(b'{')
+        if start < 0:
+            return
+        try:
+            event = json.loads(line[start:].decode('utf-8'))
+            category = CATEGORIES.get(event.get('eventType'))
+        except (AttributeError, ValueError):
+            self.errors += 1
+            return
+        self.parsed += 1
+        if category is None:
+            return
+
+        if category == 'disconnect':
+            reason = event.get('disconnectReason')
+            if event.get('status') != 'Failure' and reason in (None, CLIENT_DISCONNECT):
+                return
+        elif event.get('status') != 'Failure':
+            return
+        else:
+            reason = event.get('reason')
+
+        self.failures[category] += 1
+        reasons = self.reasons[category]
+        reason = reason or 'UNKNOWN'
+        reasons[reason] = reasons.get(reason, 0) + 1
+        client_id = event.get('clientId')
+        if client_id:
+            self.by_client[category].add(client_id)
+        thing_name = event.get('thingName') or certificate_things.get(event.get('principalId'))
+        if thing_name:
+            self.by_thing[category].add(thing_name)
+
+    def merge(self, other):
+        self.lines += other.lines
+        self.bytes += other.bytes
+        self.parsed += other.parsed
+        self.errors += other.errors
+        for category in self.failures:
+            self.failures[category] += other.failures[category]
+            reasons = self.reasons[category]
+            for reason, count in other.reasons[category].items():
+                reasons[reason] = reasons.get(reason, 0) + count
+            self.by_client[category].merge(other.by_client[category])
+            self.by_thing[category].merge(other.by_thing[category])
+
+    def report(self, top):
+        def ranked(sketch, name):
+            return [OrderedDict([(name, key), ('failures', count), ('maxOvercount', error)])
+                for key, count, error in sketch.top(top)]
+
+        return OrderedDict([
+            ('lines', self.lines),
+            ('bytes', self.bytes),
+            ('parsed', self.parsed),
+            ('unparseable', self.errors),
+            ('failures', OrderedDict((category, OrderedDict([
+                ('count', count),
+                ('reasons', OrderedDict(sorted(self.reasons[category].items(),
+                    key = lambda item: -item[1]))),
+                ('topClients', ranked(self.by_client[category], 'clientId')),
+                ('topThings', ranked(self.by_thing[category], 'thingName'))]))
+                for category, count in self.failures.items()))])
+
+def analyze_range(task):
+    '''Summarizes a range of whole lines of a plain file, or a whole gzipped file'''
+
+    path, start, stop, capacity = task
+    summary = LogSummary(capacity)
+    if stop is None:
+        log_file = gzip.open(path, 'rb')
+        try:
+            for line in log_file:
+                summary.bytes += len(line)
+                summary.add_lines([line.rstrip(b'\n')])
+        finally:
+            log_file.close()
+        return summary
+
+    with open(path, 'rb') as log_file:
+        data = mmap.mmap(log_file.fileno(), 0, access = mmap.ACCESS_READ)
+    try:
+        summary.add_lines(data[start:stop].split(b'\n'))
+        summary.bytes = stop - start
+    finally:
+        data.close()
+    return summary
+
+def find_ranges(paths, chunk_size, capacity):
+    '''Yields a task for every chunk_size range of whole lines of the plain log files
+    under paths, and for every gzipped one'''
+
+    for path in paths:
+        if os.path.isdir(path):
+            walked = [os.path.join(directory, name)
+                for directory, _, names in os.walk(path) for name in sorted(names)]
+        else:
+            walked = [path]
+
+        for file_path in walked:
+            if file_path.endswith('.gz'):
+                yield file_path, 0, None, capacity
+                continue
+
+            size = os.path.getsize(file_path)
+            if size == 0:
+                continue
+            with open(file_path, 'rb') as log_file:
+                data = mmap.mmap(log_file.fileno(), 0, access = mmap.ACCESS_READ)
+            try:
+                start = 0
+                while start < size:
+                    # Each range ends just after a line does
+                    stop = data.find(b'\n', min(start + chunk_size, size) - 1) + 1 or size
+                    yield file_path, start, stop, capacity
+                    start = stop
+            finally:
+                data.close()
+
+def load_certificate_things(journal_paths):
+    # Replayed rather than opened, which would repair the journal under a running script
+    from journal import index, replay
+
+    for path in journal_paths:
+        for entry in index(replay(path)).get('certificate', {}).values():
+            if entry.get('thing'):
+                certificate_things[entry['id']] = entry['thing']
+
+def analyze(paths, capacity = 1000, processes = None, chunk_size = CHUNK_SIZE):
+    '''Summarizes every log file under paths, one range of each at a time per process'''
+
+    summary = LogSummary(capacity)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for partial in pool.imap_unordered(analyze_range,
+                find_ranges(paths, chunk_size, capacity)):
+            summary.merge(partial)
+    finally:
+        pool.close()
+        pool.join()
+    return summary
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description = 'Find the things and clients failing to connect or publish most in AWSIotLogsV2 logs')
+    parser.add_argument('paths', nargs = '+', metavar = 'PATH',
+        help = 'Directory or file of exported log events, one JSON event a line, optionally gzipped')
+    parser.add_argument('--journal', action = 'append', default = [],
+        help = 'Resource journal of provision_thing.py, naming the thing each certificate is for. May be repeated')
+    parser.add_argument('--top', type = int, default = 20,
+        help = 'Number of clients and things reported for each kind of failure')
+    parser.add_argument('--capacity', type = int, default = 1000,
+        help = 'Number of clients and things each sketch holds. Counts are exact while fewer fail')
+    parser.add_argument('--processes', type = int,
+        help = 'Number of parsing processes, by default one per CPU')
+    parser.add_argument('--chunk-mb', type = float, default = CHUNK_SIZE / (1024 * 1024),
+        help = 'Size of the ranges of a log file handed to a process at a time')
+    parser.add_argument('--output',
+        help = 'Write the report to this file instead of stdout')
+    args = parser.parse_args()
+
+    load_certificate_things(args.journal)
+
+    start = time.time()
+    summary = analyze(args.paths, max(args.capacity, args.top), args.processes,
+        int(args.chunk_mb * 1024 * 1024))
+    elapsed = time.time() - start
+
+    output_file = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        output_file.write(json.dumps(summary.report(args.top), indent = 2) + '\n')
+    finally:
+        if args.output:
+            output_file.close()
+
+    sys.stderr.write('Analyzed %d lines (%.1f MB) in %.2fs (%.1f MB/s): %s\n' % (
+        summary.lines, summary.bytes / 1e6, elapsed,
+        summary.bytes / 1e6 / elapsed if elapsed else 0.0,
+        ', '.join('%d %s failures' % (count, category)
+            for category, count in summary.failures.items())))
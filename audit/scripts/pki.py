@@ -0,0 +1,123 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+Certificate building helpers shared by the audit setup script and the
+bulk minting worker processes.
+'''
+
+import binascii
+import uuid
+import six
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.x509.oid import NameOID
+
+from keypool import generate_private_key
+
+def cert_to_pem(certificate):
+    return certificate.public_bytes(
+        encoding = serialization.Encoding.PEM)
+
+def privkey_to_pem(pkey):
+    return pkey.private_bytes(
+        encoding = serialization.Encoding.PEM,
+        format = serialization.PrivateFormat.PKCS8,
+        encryption_algorithm = serialization.NoEncryption())
+
+def get_certificate_id(certificate):
+    # AWS IoT identifies a certificate by its SHA-256 fingerprint
+    return binascii.hexlify(certificate.fingerprint(hashes.SHA256())).decode('ascii')
+
+def get_common_name(certificate):
+    return certificate.subject.get_attributes_for_oid(
+        NameOID.COMMON_NAME)[0].value
+
+def get_validity(certificate):
+    # Newer cryptography releases deprecate the naive UTC datetimes for aware ones
+    if hasattr(certificate, 'not_valid_after_utc'):
+        return certificate.not_valid_before_utc.replace(tzinfo = None), \
+            certificate.not_valid_after_utc.replace(tzinfo = None)
+
+    return certificate.not_valid_before, certificate.not_valid_after
+
+def create_certificate(common_name, not_valid_before, not_valid_after,
+    issuer_common_name = None, issuer_private_key = None,
+    crl_distribution_point = None, authority_info_uri = None,
+    is_ca_certificate = False, private_key = None):
+
+    if not private_key:
+        private_key = generate_private_key()
+
+    public_key = private_key.public_key()
+
+    if not issuer_common_name:
+        issuer_common_name = common_name
+
+    if not issuer_private_key:
+        issuer_private_key = private_key
+        is_ca_certificate = True
+
+    builder = x509.CertificateBuilder()
+    builder = builder.subject_name(x509.Name([
+        x509.NameAttribute(
+            NameOID.COMMON_NAME, six.text_type(common_name))]))
+
+    builder = builder.issuer_name(x509.Name([
+        x509.NameAttribute(
+            NameOID.COMMON_NAME, six.text_type(issuer_common_name))]))
+
+    builder = builder.not_valid_before(not_valid_before)
+    builder = builder.not_valid_after(not_valid_after)
+    builder = builder.serial_number(int(uuid.uuid4()))
+    builder = builder.public_key(public_key)
+    builder = builder.add_extension(
+        x509.BasicConstraints(ca = is_ca_certificate, path_length = None),
+        critical = True)
+
+    if crl_distribution_point:
+        builder = builder.add_extension(
+            x509.CRLDistributionPoints([
+                x509.DistributionPoint(
+                    full_name = [
+                        x509.UniformResourceIdentifier(
+                            six.text_type(crl_distribution_point))
+                    ],
+                    relative_name = None,
+                    reasons = None,
+                    crl_issuer = None)
+            ]),
+            critical = True)
+
+    if authority_info_uri:
+        builder = builder.add_extension(
+            x509.AuthorityInformationAccess([
+                x509.AccessDescription(
+                    access_method = \
+                        x509.oid.AuthorityInformationAccessOID.CA_ISSUERS,
+                    access_location = x509.UniformResourceIdentifier(
+                        six.text_type(authority_info_uri))
+                )
+            ]),
+            critical = True)
+
+    certificate = builder.sign(
+        private_key = issuer_private_key,
+        algorithm = hashes.SHA256(),
+        backend = default_backend())
+
+    return private_key, certificate
@@ -0,0 +1,163 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+On-disk cache of the CAs the audit setup script creates, so that later runs can
+register the same CAs again instead of generating new keys and certificates.
+
+CAs are cached by the parameters they were created with, such as key type,
+lifetime and issuer, plus the account and region for CAs registered with AWS
+IoT. Each set of parameters has numbered slots, one file each, since a run with
+--copies needs that many different CAs. A run checks slots out in order,
+skipping those it already has and those still registered in the account, and
+replaces a CA once less than half of the validity asked for is left. A CA made
+to expire soon is then still expiring soon when it is used again.
+
+The registration code verification certificates are made for is cached too, by
+account and region, as it doesn't change between runs. So are the revocations
+of each cached CA, by certificate id, so that a CA used again keeps revoking
+what earlier runs revoked, and numbers its CRLs on from theirs.
+'''
+
+import hashlib
+import json
+import os
+import threading
+
+from datetime import datetime
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+from pki import cert_to_pem, privkey_to_pem, get_validity
+
+REGISTRATION_CODES_FILE = 'registration-codes.json'
+REVOCATIONS_FILE = 'revocations-%s.json'
+
+def write_json(path, document):
+    # Write then rename, so a crash never leaves a partially written file behind
+    with open(path + '.tmp', 'w') as cache_file:
+        json.dump(document, cache_file, sort_keys = True)
+    os.rename(path + '.tmp', path)
+
+class PKICache():
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        # Slots checked out by this run
+        self.checked_out = set()
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.registration_codes = {}
+        path = os.path.join(directory, REGISTRATION_CODES_FILE)
+        if os.path.exists(path):
+            with open(path, 'r') as codes_file:
+                self.registration_codes = json.load(codes_file)
+
+    def registration_code(self, account, region, fetch):
+        '''Returns the CA registration code of account and region, calling fetch()
+        for it only if it isn't cached'''
+
+        key = '%s:%s' % (account, region)
+        with self.lock:
+            if key not in self.registration_codes:
+                self.registration_codes[key] = fetch()
+                write_json(os.path.join(self.directory, REGISTRATION_CODES_FILE),
+                    self.registration_codes)
+            return self.registration_codes[key]
+
+    def revocations(self, certificate_id):
+        '''Returns the CRLStore document stored for a CA, or None'''
+
+        path = os.path.join(self.directory, REVOCATIONS_FILE % certificate_id)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'r') as revocations_file:
+            return json.load(revocations_file)
+
+    def store_revocations(self, certificate_id, document):
+        write_json(os.path.join(self.directory, REVOCATIONS_FILE % certificate_id),
+            document)
+
+    def checkout(self, params, not_valid_after, in_use = None):
+        '''
+        Returns the first CA cached for params that this run hasn't checked out,
+        that in_use(certificate) doesn't report as still in use, and that has at
+        least half of the validity until not_valid_after left, as a dict of
+        private_key, certificate, verification_certificate and registration_code.
+        The slot is checked out either way, and returned for store() along with
+        None when there was no such CA.
+        '''
+
+        digest = hashlib.sha256(json.dumps(params, sort_keys = True)
+            .encode('utf-8')).hexdigest()[:16]
+        now = datetime.today()
+
+        with self.lock:
+            slot = 0
+            while True:
+                path = os.path.join(self.directory, '%s-%d.json' % (digest, slot))
+                slot += 1
+                if path in self.checked_out:
+                    continue
+                if not os.path.exists(path):
+                    self.checked_out.add(path)
+                    return None, path
+
+                cached = self._load(path)
+                if in_use and in_use(cached['certificate']):
+                    continue
+
+                self.checked_out.add(path)
+                cached_not_valid_before, cached_not_valid_after = \
+                    get_validity(cached['certificate'])
+                if cached_not_valid_before > now or \
+                        cached_not_valid_after - now < (not_valid_after - now) / 2:
+                    return None, path
+                return cached, path
+
+    def store(self, path, private_key, certificate,
+        verification_certificate = None, registration_code = None):
+
+        entry = {
+            'privateKey': privkey_to_pem(private_key).decode('ascii'),
+            'certificate': cert_to_pem(certificate).decode('ascii'),
+        }
+        if verification_certificate:
+            entry['verificationCertificate'] = \
+                cert_to_pem(verification_certificate).decode('ascii')
+            entry['registrationCode'] = registration_code
+
+        write_json(path, entry)
+
+    def _load(self, path):
+        with open(path, 'r') as cache_file:
+            entry = json.load(cache_file)
+
+        backend = default_backend()
+        verification_certificate = entry.get('verificationCertificate')
+        return {
+            'private_key': serialization.load_pem_private_key(
+                entry['privateKey'].encode('ascii'), password = None, backend = backend),
+            'certificate': x509.load_pem_x509_certificate(
+                entry['certificate'].encode('ascii'), backend),
+            'verification_certificate': verification_certificate and
+                x509.load_pem_x509_certificate(verification_certificate.encode('ascii'), backend),
+            'registration_code': entry.get('registrationCode'),
+        }
@@ -0,0 +1,293 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+Offline lint for IoT policies Device Defender Audit flags as overly permissive.
+
+A policy is flagged when it allows one of RULES' actions on any resource of the
+rule's type, such as publishing to any topic or connecting with any client id.
+That is tested by matching the policy's statements against a probe: a resource
+whose name no pattern without a wildcard would match. Action and resource
+patterns are compiled to regular expressions once and cached by pattern, and
+identical documents, however many policies share them, are only analyzed once.
+
+Policies are read from JSON files holding a policy document, or get-policy's
+output, and from JSON lines files of {policyName, policyDocument}, such as
+--export writes:
+
+    python policy_lint.py --export policies.jsonl --region us-east-1
+    python policy_lint.py policies.jsonl ../../scripts/iot_policy.json
+'''
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+# Action, resource type and what allowing it on every resource of the type grants
+RULES = [
+    ('iot:Connect', 'client', 'connect with any client id'),
+    ('iot:Publish', 'topic', 'publish to any topic'),
+    ('iot:Receive', 'topic', 'receive from any topic'),
+    ('iot:Subscribe', 'topicfilter', 'subscribe to any topic filter'),
+    ('iot:GetThingShadow', 'thing', 'read any thing shadow'),
+    ('iot:UpdateThingShadow', 'thing', 'update any thing shadow'),
+    ('iot:DeleteThingShadow', 'thing', 'delete any thing shadow'),
+    ('iot:UpdateCertificate', 'cert', 'revoke or deactivate any certificate'),
+    ('iot:AttachPolicy', 'cert', 'attach policies to any certificate'),
+    ('iot:DeleteThing', 'thing', 'delete any thing'),
+]
+
+# Stands in for an arbitrary resource name
+PROBE = u'\x00'
+
+# The region and account of an ARN pattern, when they are written out
+ARN = re.compile(r'^arn:[^:]*:[^:]*:([^:*?]+):([^:*?]+):')
+
+WILDCARDS = re.compile(r'([*?])')
+
+matchers = {}
+probes = {}
+
+def matcher(pattern, ignore_case = False):
+    '''Returns the match function of an IAM wildcard pattern, compiled once'''
+
+    key = (pattern, ignore_case)
+    match = matchers.get(key)
+    if match is None:
+        # Unlike fnmatch, IAM patterns have no character classes
+        regex = ''.join('.*' if part == '*' else '.' if part == '?' else re.escape(part)
+            for part in WILDCARDS.split(pattern))
+        match = matchers[key] = re.compile(regex + r'\Z',
+            (re.IGNORECASE if ignore_case else 0) | re.DOTALL).match
+    return match
+
+def probe(pattern, resource_type):
+    '''Returns an ARN of resource_type no specific resource pattern matches, in
+    the region and account pattern names, if it names any'''
+
+    key = (pattern, resource_type)
+    resource = probes.get(key)
+    if resource is None:
+        arn = ARN.match(pattern)
+        region, account = arn.groups() if arn else ('us-east-1', '123456789012')
+        resource = probes[key] = 'arn:aws:iot:%s:%s:%s/%s' % (
+            region, account, resource_type, PROBE)
+    return resource
+
+def as_list(value):
+    return value if isinstance(value, list) else [value]
+
+def grants(statement, action, resource_type):
+    '''Returns whether statement applies to action on any resource_type'''
+
+    if 'Action' in statement:
+        if not any(matcher(pattern, True)(action) for pattern in as_list(statement['Action'])):
+            return False
+    elif 'NotAction' in statement:
+        if any(matcher(pattern, True)(action) for pattern in as_list(statement['NotAction'])):
+            return False
+    else:
+        return False
+
+    if 'Resource' in statement:
+        return any(matcher(pattern)(probe(pattern, resource_type))
+            for pattern in as_list(statement['Resource']))
+    if 'NotResource' in statement:
+        return not any(matcher(pattern)(probe(pattern, resource_type))
+            for pattern in as_list(statement['NotResource']))
+    return False
+
+def analyze(document):
+    '''Returns what a policy document grants on every resource, and which of its
+    statements grant it. A statement denying the same leaves it out'''
+
+    statements = as_list(document.get('Statement', []))
+    permissive = []
+    for action, resource_type, description in RULES:
+        allowed = []
+        for i, statement in enumerate(statements):
+            if not grants(statement, action, resource_type):
+                continue
+            if statement.get('Effect') == 'Deny':
+                allowed = []
+                break
+            if statement.get('Effect') == 'Allow':
+                allowed.append(i)
+        if allowed:
+            permissive.append((description, allowed))
+    return permissive
+
+def document_digest(document):
+    return hashlib.sha256(json.dumps(document, sort_keys = True,
+        separators = (',', ':')).encode('utf-8')).hexdigest()
+
+class PolicyLinter():
+
+    def __init__(self):
+        # Document digest -> what analyze() made of it
+        self.analyses = {}
+        # Digest of a document's text -> its document digest
+        self.text_digests = {}
+        self.policies = 0
+        self.findings = []
+        self.errors = []
+
+    def lint(self, source, policy_name, document):
+        '''Lints one policy, whose document may still be JSON text'''
+
+        try:
+            if isinstance(document, dict):
+                digest = document_digest(document)
+            else:
+                # Exported documents are text, and the same text is the same document
+                text_digest = hashlib.sha256(document.encode('utf-8')).digest()
+                digest = self.text_digests.get(text_digest)
+                if digest is None:
+                    document = json.loads(document)
+                    digest = self.text_digests[text_digest] = document_digest(document)
+            permissive = self.analyses.get(digest)
+            if permissive is None:
+                permissive = self.analyses[digest] = analyze(document)
+        except (AttributeError, TypeError, ValueError) as e:
+            self.errors.append((source, policy_name, str(e)))
+            return
+
+        self.policies += 1
+        if permissive:
+            self.findings.append(OrderedDict([
+                ('checkName', 'IOT_POLICY_OVERLY_PERMISSIVE_CHECK'),
+                ('source', source),
+                ('policyName', policy_name),
+                ('documentDigest', digest),
+                ('permissions', [description for description, _ in permissive]),
+                ('statements', sorted(set(i for _, allowed in permissive for i in allowed)))]))
+
+    def summary(self):
+        return '%d policies (%d distinct documents): %d overly permissive, %d errors' % (
+            self.policies, len(self.analyses), len(self.findings), len(self.errors))
+
+def read_policies(paths):
+    '''Yields the source, name and document of every policy under paths'''
+
+    for path in paths:
+        if os.path.isdir(path):
+            walked = [os.path.join(directory, name)
+                for directory, _, names in os.walk(path) for name in sorted(names)
+                if name.endswith(('.json', '.jsonl'))]
+        else:
+            walked = [path]
+
+        for file_path in walked:
+            with open(file_path, 'r') as policy_file:
+                if file_path.endswith('.jsonl'):
+                    for line_number, line in enumerate(policy_file, 1):
+                        if not line.strip():
+                            continue
+                        source = '%s:%d' % (file_path, line_number)
+                        try:
+                            policy = json.loads(line)
+                            yield source, policy['policyName'], policy['policyDocument']
+                        except (KeyError, TypeError, ValueError):
+                            yield source, None, line
+                    continue
+
+                text = policy_file.read()
+
+            # A bare document is named after its file
+            try:
+                policies = as_list(json.loads(text))
+            except ValueError:
+                policies = [text]
+            for policy in policies:
+                if isinstance(policy, dict) and 'policyDocument' in policy:
+                    yield file_path, policy.get('policyName'), policy['policyDocument']
+                else:
+                    yield file_path, os.path.splitext(os.path.basename(file_path))[0], policy
+
+def export_policies(iot_client, path, workers = 16):
+    '''Writes every policy in the account, at its default version, to path as JSON
+    lines. Returns the number of policies written'''
+
+    policy_names = [policy['policyName']
+        for page in iot_client.get_paginator('list_policies').paginate()
+        for policy in page['policies']]
+
+    pool = ThreadPool(workers)
+    try:
+        with open(path, 'w') as export_file:
+            for policy in pool.imap(
+                    lambda policy_name: iot_client.get_policy(policyName = policy_name),
+                    policy_names):
+                export_file.write(json.dumps(OrderedDict([
+                    ('policyName', policy['policyName']),
+                    ('policyDocument', policy['policyDocument'])])) + '\n')
+    finally:
+        pool.close()
+        pool.join()
+
+    return len(policy_names)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description = 'Lint IoT policies for overly permissive statements')
+    parser.add_argument('paths', nargs = '*', metavar = 'PATH',
+        help = 'Directory, policy JSON or JSON lines file to lint')
+    parser.add_argument('--export', metavar = 'FILE',
+        help = 'First export every policy in the account to this JSON lines file, and lint it')
+    parser.add_argument('--region',
+        help = 'Region to export policies from')
+    parser.add_argument('--workers', type = int, default = 16,
+        help = 'Number of policies fetched concurrently by --export')
+    parser.add_argument('--output',
+        help = 'Write findings to this file instead of stdout')
+    args = parser.parse_args()
+
+    if not args.paths and not args.export:
+        parser.error('Nothing to lint: give a PATH or --export')
+
+    paths = list(args.paths)
+    if args.export:
+        import boto3
+
+        exported = export_policies(
+            boto3.client('iot', region_name = args.region), args.export, args.workers)
+        sys.stderr.write('Exported %d policies to %s\n' % (exported, args.export))
+        paths.append(args.export)
+
+    start = time.time()
+    linter = PolicyLinter()
+    for source, policy_name, document in read_policies(paths):
+        linter.lint(source, policy_name, document)
+    elapsed = time.time() - start
+
+    output_file = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for finding in linter.findings:
+            output_file.write(json.dumps(finding) + '\n')
+    finally:
+        if args.output:
+            output_file.close()
+
+    for source, policy_name, error in linter.errors:
+        sys.stderr.write('Failed linting %s (%s): %s\n' % (policy_name, source, error))
+    sys.stderr.write('Linted %s in %.2fs\n' % (linter.summary(), elapsed))
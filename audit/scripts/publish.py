@@ -0,0 +1,144 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+'''
+Publishing of PKI artifacts (CA certificates and CRLs) that skips uploads
+whose content is already stored under the same key.
+
+Stored content is identified by its MD5 digest, which is what S3 reports as
+the ETag of an object uploaded with a single put_object, so checking an
+artifact costs one HEAD request. Where the stored digest can't be read, e.g.
+without s3:GetObject, the artifact is uploaded as it always used to be.
+'''
+
+import hashlib
+import os
+import threading
+
+from botocore.exceptions import ClientError
+from multiprocessing.pool import ThreadPool
+
+def content_digest(body):
+    return hashlib.md5(body).hexdigest()
+
+class S3Backend():
+
+    def __init__(self, s3_client, s3_bucket):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+
+    def get_url(self, key):
+        # The global endpoint only serves buckets outside us-east-1 with a redirect
+        region = self.s3_client.meta.region_name
+        if region in (None, 'us-east-1'):
+            return 'http://s3.amazonaws.com/%s/%s' % (self.s3_bucket, key)
+        return 'http://s3.%s.amazonaws.com/%s/%s' % (region, self.s3_bucket, key)
+
+    def stored_digest(self, key):
+        try:
+            response = self.s3_client.head_object(
+                Bucket = self.s3_bucket, Key = key)
+        except ClientError as e:
+            # Without s3:ListBucket, a missing key is reported as 403 rather than 404
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound',
+                    '403', 'AccessDenied', 'Forbidden'):
+                return None
+            raise
+
+        return response['ETag'].strip('"')
+
+    def put(self, key, body, content_type):
+        self.s3_client.put_object(
+            Bucket = self.s3_bucket,
+            Key = key,
+            Body = body,
+            ContentType = content_type,
+            ACL = 'public-read')
+
+class LocalBackend():
+
+    def __init__(self, root_dir):
+        self.root_dir = os.path.realpath(root_dir)
+        if not os.path.exists(self.root_dir):
+            os.makedirs(self.root_dir)
+
+    def get_url(self, key):
+        return 'file://' + os.path.join(self.root_dir, key)
+
+    def stored_digest(self, key):
+        path = os.path.join(self.root_dir, key)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'rb') as stored_file:
+            return content_digest(stored_file.read())
+
+    def put(self, key, body, content_type):
+        path = os.path.join(self.root_dir, key)
+
+        # Write then rename, so a reader never sees a partially written artifact
+        with open(path + '.tmp', 'wb') as stored_file:
+            stored_file.write(body)
+        os.rename(path + '.tmp', path)
+
+class ArtifactPublisher():
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.uploads = 0
+        self.skipped = 0
+        self.bytes_uploaded = 0
+        self.bytes_skipped = 0
+
+    def get_url(self, key):
+        return self.backend.get_url(key)
+
+    def publish(self, key, body, content_type = 'text/plain', stored_digest = None):
+        '''Uploads body unless the same content is already stored under key.
+        Returns True if it was uploaded.'''
+
+        if stored_digest is None:
+            stored_digest = self.backend.stored_digest(key)
+
+        if stored_digest == content_digest(body):
+            with self.lock:
+                self.skipped += 1
+                self.bytes_skipped += len(body)
+            return False
+
+        self.backend.put(key, body, content_type)
+        with self.lock:
+            self.uploads += 1
+            self.bytes_uploaded += len(body)
+        return True
+
+    def publish_batch(self, artifacts, content_type = 'text/plain', workers = 8):
+        '''Publishes (key, body) pairs concurrently, checking only their own keys,
+        so a batch costs the same however much else the bucket holds'''
+
+        artifacts = list(artifacts)
+        pool = ThreadPool(max(1, min(workers, len(artifacts))))
+        try:
+            return pool.map(
+                lambda artifact: self.publish(artifact[0], artifact[1], content_type),
+                artifacts)
+        finally:
+            pool.close()
+            pool.join()
+
+    def summary(self):
+        return ('%d uploaded (%d bytes), %d unchanged and skipped (%d bytes)' %
+            (self.uploads, self.bytes_uploaded, self.skipped, self.bytes_skipped))
@@ -0,0 +1,82 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""An in-process stand-in for an MQTT broker, for benchmarking metrics_load.py offline.
+
+Needs Python 3.5 or later. It acknowledges connects, subscribes and QoS 1 publishes and,
+like Device Defender, answers a metrics report with a message on its accepted topic.
+"""
+
+import asyncio
+import json
+import struct
+
+from metrics_load import CONNACK, CONNECT, PUBACK, PUBLISH, SUBACK, SUBSCRIBE, DISCONNECT, encode_packet, \
+    encode_string
+
+
+class StubBroker(object):
+
+    def __init__(self):
+        self.server = None
+        self.port = None
+        self.published = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0, backlog=1024)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        subscriptions = set()
+        try:
+            while True:
+                first = (await reader.readexactly(1))[0]
+                length, shift = 0, 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length += (byte & 0x7f) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length)
+                packet_type = first & 0xf0
+
+                if packet_type == CONNECT:
+                    writer.write(encode_packet(CONNACK, b'\x00\x00'))
+                elif packet_type == SUBSCRIBE & 0xf0:
+                    topic_length = struct.unpack('>H', body[2:4])[0]
+                    subscriptions.add(body[4:4 + topic_length].decode('utf-8'))
+                    writer.write(encode_packet(SUBACK, body[:2] + b'\x00'))
+                elif packet_type == PUBLISH:
+                    self.published += 1
+                    topic_length = struct.unpack('>H', body[:2])[0]
+                    topic = body[2:2 + topic_length].decode('utf-8')
+                    packet_id = body[2 + topic_length:4 + topic_length]
+                    writer.write(encode_packet(PUBACK, packet_id))
+                    if topic + "/accepted" in subscriptions:
+                        report = json.loads(body[4 + topic_length:].decode('utf-8'))
+                        response = json.dumps({"reportId": report["header"]["report_id"], "status": "ACCEPTED"})
+                        writer.write(encode_packet(PUBLISH, encode_string(topic + "/accepted") +
+                                                   response.encode('utf-8')))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        writer.close()
@@ -0,0 +1,326 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Evaluates security profile behaviors locally, over the metrics reports devices publish.
+
+Takes a security profile in the shape create-security-profile does, and raises the same
+in-alarm and alarm-cleared violation events Device Defender would, in the shape of its
+SNS notifications. Needs NumPy.
+
+Every device is a row in arrays shared by the whole fleet, so each evaluation tick is a
+handful of array operations per behavior, however many devices there are. Counters, like
+packets out, are summed over each behavior's durationSeconds from per-device ring buffers
+of bucket_seconds wide time buckets; gauges, like established connections, use the last
+value reported within durationSeconds. A datapoint, for consecutiveDatapointsToAlarm
+and consecutiveDatapointsToClear, is one evaluation tick.
+
+    engine = BehaviorEngine(profile["securityProfileName"], profile["behaviors"])
+    engine.ingest([(thing_name, report, timestamp), ...])
+    for event in engine.evaluate():
+        print(json.dumps(event))
+
+Run on its own, it evaluates a profile over a JSON lines stream of
+{"thingName": ..., "timestamp": <seconds>, "report": <metrics report>}, ticking every
+--tick seconds of report time:
+
+    python ./behaviors.py security_profile.json reports.jsonl
+"""
+
+import argparse
+import json
+import math
+import sys
+import time
+import uuid
+
+import numpy as np
+
+SUM = "sum"
+LAST = "last"
+
+# Where each device-side metric is in a metrics report, and how it is aggregated
+METRICS = {
+    "aws:all-bytes-in": (("network_stats", "bytes_in"), SUM),
+    "aws:all-bytes-out": (("network_stats", "bytes_out"), SUM),
+    "aws:all-packets-in": (("network_stats", "packets_in"), SUM),
+    "aws:all-packets-out": (("network_stats", "packets_out"), SUM),
+    "aws:num-established-tcp-connections": (("tcp_connections", "established_connections", "total"), LAST),
+    "aws:num-listening-tcp-ports": (("listening_tcp_ports", "total"), LAST),
+    "aws:num-listening-udp-ports": (("listening_udp_ports", "total"), LAST),
+}
+
+# A behavior describes normal behavior, so devices violate it when these are false
+OPERATORS = {
+    "less-than": np.less,
+    "less-than-equals": np.less_equal,
+    "greater-than": np.greater,
+    "greater-than-equals": np.greater_equal,
+}
+
+IN_ALARM = "in-alarm"
+ALARM_CLEARED = "alarm-cleared"
+
+
+def metric_value(report, path):
+    value = report.get("metrics", {})
+    for key in path:
+        value = value.get(key)
+        if value is None:
+            return None
+    return value
+
+
+class Behavior(object):
+
+    def __init__(self, index, behavior):
+        criteria = behavior["criteria"]
+        if behavior["metric"] not in METRICS:
+            raise ValueError("%s: unsupported metric %s" % (behavior["name"], behavior["metric"]))
+        if criteria["comparisonOperator"] not in OPERATORS or "count" not in criteria.get("value", {}):
+            raise ValueError("%s: only count comparisons are supported" % behavior["name"])
+
+        self.index = index
+        self.name = behavior["name"]
+        self.metric = behavior["metric"]
+        self.description = {"name": self.name, "metric": self.metric, "criteria": criteria}
+        self.operator = OPERATORS[criteria["comparisonOperator"]]
+        self.threshold = criteria["value"]["count"]
+        self.duration = criteria.get("durationSeconds", 300)
+        self.to_alarm = criteria.get("consecutiveDatapointsToAlarm", 1)
+        self.to_clear = criteria.get("consecutiveDatapointsToClear", 1)
+
+
+class MetricStore(object):
+    """One metric's recent values for every device"""
+
+    def __init__(self, aggregation, buckets, capacity):
+        self.aggregation = aggregation
+        self.buckets = buckets
+        if aggregation == SUM:
+            self.sums = np.zeros((capacity, buckets))
+            # The time bucket each ring slot currently holds, -1 for none
+            self.epochs = np.full((capacity, buckets), -1, dtype=np.int64)
+        else:
+            self.values = np.zeros(capacity)
+            self.times = np.full(capacity, -np.inf)
+
+    def grow(self, capacity):
+        if self.aggregation == SUM:
+            self.sums = grown(self.sums, capacity, 0)
+            self.epochs = grown(self.epochs, capacity, -1)
+        else:
+            self.values = grown(self.values, capacity, 0)
+            self.times = grown(self.times, capacity, -np.inf)
+
+    def add(self, rows, values, times, bucket_seconds):
+        if self.aggregation == LAST:
+            # Reports for the same device can arrive out of order, and in the same batch
+            order = np.lexsort((times, rows))
+            rows, values, times = rows[order], values[order], times[order]
+            newer = times >= self.times[rows]
+            self.values[rows[newer]] = values[newer]
+            self.times[rows[newer]] = times[newer]
+            return
+
+        epochs = (times // bucket_seconds).astype(np.int64)
+        slots = epochs % self.buckets
+        # Reports older than the ring holds are dropped
+        current = self.epochs[rows, slots]
+        keep = epochs >= current
+        rows, slots, epochs, values = rows[keep], slots[keep], epochs[keep], values[keep]
+        stale = epochs > self.epochs[rows, slots]
+        self.sums[rows[stale], slots[stale]] = 0
+        self.epochs[rows, slots] = epochs
+        # A batch spanning more time than the ring can put two buckets in one slot
+        newest = self.epochs[rows, slots] == epochs
+        np.add.at(self.sums, (rows[newest], slots[newest]), values[newest])
+
+    def window(self, count, now, duration, bucket_seconds):
+        """Returns every device's value over duration seconds up to now, and whether it
+        reported anything in that time"""
+        if self.aggregation == LAST:
+            current = self.times[:count] > now - duration
+            return self.values[:count], current
+
+        latest = int(now // bucket_seconds)
+        oldest = latest - int(math.ceil(duration / float(bucket_seconds))) + 1
+        epochs = self.epochs[:count]
+        in_window = (epochs >= oldest) & (epochs <= latest)
+        return np.where(in_window, self.sums[:count], 0).sum(axis=1), in_window.any(axis=1)
+
+
+def grown(array, capacity, fill):
+    bigger = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+    bigger[:len(array)] = array
+    return bigger
+
+
+class BehaviorEngine(object):
+
+    def __init__(self, profile_name, behaviors, bucket_seconds=60, capacity=1024):
+        self.profile_name = profile_name
+        self.behaviors = [Behavior(i, behavior) for i, behavior in enumerate(behaviors)]
+        self.bucket_seconds = bucket_seconds
+        self.capacity = capacity
+        # Row of each device in every array, and the device in each row
+        self.rows = {}
+        self.names = []
+
+        durations = {}
+        for behavior in self.behaviors:
+            durations[behavior.metric] = max(durations.get(behavior.metric, 0), behavior.duration)
+        self.metrics = dict(
+            (metric, MetricStore(METRICS[metric][1], int(math.ceil(duration / float(bucket_seconds))) + 1,
+                                 capacity))
+            for metric, duration in durations.items())
+
+        # Consecutive datapoints each device has been violating, or not, each behavior
+        self.breaching = np.zeros((len(self.behaviors), capacity), dtype=np.int32)
+        self.clearing = np.zeros((len(self.behaviors), capacity), dtype=np.int32)
+        self.in_alarm = np.zeros((len(self.behaviors), capacity), dtype=bool)
+        self.violation_ids = {}
+
+    def row(self, thing_name):
+        row = self.rows.get(thing_name)
+        if row is None:
+            row = self.rows[thing_name] = len(self.names)
+            self.names.append(thing_name)
+            if row == self.capacity:
+                self._grow(2 * self.capacity)
+        return row
+
+    def _grow(self, capacity):
+        self.capacity = capacity
+        for store in self.metrics.values():
+            store.grow(capacity)
+        self.breaching = grown(self.breaching.T, capacity, 0).T
+        self.clearing = grown(self.clearing.T, capacity, 0).T
+        self.in_alarm = grown(self.in_alarm.T, capacity, False).T
+
+    def ingest(self, reports):
+        """Takes (thing name, metrics report, timestamp in seconds) tuples"""
+        columns = dict((metric, ([], [], [])) for metric in self.metrics)
+        paths = [(metric, METRICS[metric][0]) for metric in self.metrics]
+        for thing_name, report, timestamp in reports:
+            row = self.row(thing_name)
+            for metric, path in paths:
+                value = metric_value(report, path)
+                if value is not None:
+                    rows, values, times = columns[metric]
+                    rows.append(row)
+                    values.append(value)
+                    times.append(timestamp)
+
+        for metric, (rows, values, times) in columns.items():
+            if rows:
+                self.metrics[metric].add(np.array(rows), np.array(values, dtype=float), np.array(times, dtype=float),
+                                         self.bucket_seconds)
+
+    def evaluate(self, now=None):
+        """Evaluates every behavior for every device, and returns the violation events raised"""
+        if now is None:
+            now = time.time()
+        count = len(self.names)
+        events = []
+        windows = {}
+        for behavior in self.behaviors:
+            key = (behavior.metric, behavior.duration)
+            if key not in windows:
+                windows[key] = self.metrics[behavior.metric].window(count, now, behavior.duration,
+                                                                   self.bucket_seconds)
+            values, reported = windows[key]
+
+            # Devices that reported nothing in the window are left as they were
+            violating = reported & ~behavior.operator(values, behavior.threshold)
+            normal = reported & ~violating
+            breaching = self.breaching[behavior.index, :count]
+            clearing = self.clearing[behavior.index, :count]
+            breaching[:] = np.where(violating, breaching + 1, np.where(normal, 0, breaching))
+            clearing[:] = np.where(normal, clearing + 1, np.where(violating, 0, clearing))
+
+            in_alarm = self.in_alarm[behavior.index, :count]
+            raised = np.flatnonzero(~in_alarm & (breaching >= behavior.to_alarm))
+            cleared = np.flatnonzero(in_alarm & (clearing >= behavior.to_clear))
+            in_alarm[raised] = True
+            in_alarm[cleared] = False
+
+            for row in raised:
+                self.violation_ids[(behavior.index, row)] = uuid.uuid4().hex
+                events.append(self._event(behavior, row, IN_ALARM, values[row], now))
+            for row in cleared:
+                events.append(self._event(behavior, row, ALARM_CLEARED, values[row], now))
+                del self.violation_ids[(behavior.index, row)]
+        return events
+
+    def _event(self, behavior, row, event_type, value, now):
+        return {
+            "violationEventTime": int(now * 1000),
+            "thingName": self.names[row],
+            "behavior": behavior.description,
+            "violationEventType": event_type,
+            "metricValue": {"count": int(value)},
+            "violationId": self.violation_ids[(behavior.index, row)],
+            "securityProfileName": self.profile_name,
+        }
+
+    def alarms(self):
+        """Returns the number of devices in alarm, by behavior name"""
+        count = len(self.names)
+        return dict((behavior.name, int(self.in_alarm[behavior.index, :count].sum())) for behavior in self.behaviors)
+
+
+def load_security_profile(path):
+    with open(path, "r") as profile_file:
+        return json.load(profile_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a security profile locally over a stream of metrics reports")
+    parser.add_argument("profile", help="Security profile, as JSON with securityProfileName and behaviors")
+    parser.add_argument("reports", nargs="?",
+                        help="JSON lines of {thingName, timestamp, report}, read from stdin if not given")
+    parser.add_argument("--tick", type=float, default=60.0,
+                        help="Seconds of report time between evaluations (default 60)")
+    args = parser.parse_args()
+
+    profile = load_security_profile(args.profile)
+    engine = BehaviorEngine(profile["securityProfileName"], profile["behaviors"])
+    reports = open(args.reports, "r") if args.reports else sys.stdin
+    batch = []
+    next_tick = None
+
+    def tick(now):
+        engine.ingest(batch)
+        del batch[:]
+        for event in engine.evaluate(now):
+            print(json.dumps(event, sort_keys=True))
+
+    for line in reports:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        timestamp = record["timestamp"]
+        if next_tick is None:
+            next_tick = timestamp + args.tick
+        while timestamp >= next_tick:
+            tick(next_tick)
+            next_tick += args.tick
+        batch.append((record["thingName"], record["report"], timestamp))
+    if next_tick is not None:
+        tick(next_tick)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Provisions many things with one AWS IoT bulk registration task.
+
+Rather than several API calls per thing, each thing gets a line of template parameters
+in an input file in S3, and start_thing_registration_task provisions them all. Keys are
+generated here and certificates issued from CSRs, so private keys never leave this
+machine. The input file is streamed: keys and CSRs are generated in worker processes a
+batch at a time and each line goes straight into a multipart upload, so however many
+things there are, only a few batches and parts are held in memory. The task's reports
+are read a line at a time too:
+
+    with MultipartWriter(s3_client, bucket, key) as upload:
+        for thing_name, csr_pem, private_key_pem in generate_credentials(thing_names):
+            upload.write(parameter_line(thing_name, csr_pem))
+    task_id = iot_client.start_thing_registration_task(
+        templateBody=json.dumps(registration_template(policy_name, group_name)),
+        inputFileBucket=bucket, inputFileKey=key, roleArn=role_arn)['taskId']
+    wait_for_task(iot_client, task_id)
+    for result in read_reports(iot_client, task_id, "RESULTS"):
+        thing_name, certificate_id, certificate_arn, certificate_pem = parse_result(result)
+"""
+
+import collections
+import json
+import multiprocessing
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+# S3 allows 10000 parts, each but the last at least 5 MiB, so this uploads up to 80 GiB
+PART_SIZE = 8 * 1024 * 1024
+
+FINISHED = ("Completed", "Failed", "Cancelled")
+
+
+def registration_template(policy_name, group_name):
+    """A template creating a thing in group_name, with an active certificate issued from
+    its CSR and policy_name attached to the certificate"""
+    return {
+        "Parameters": {
+            "ThingName": {"Type": "String"},
+            "CSR": {"Type": "String"},
+        },
+        "Resources": {
+            "thing": {
+                "Type": "AWS::IoT::Thing",
+                "Properties": {"ThingName": {"Ref": "ThingName"}, "ThingGroups": [group_name]},
+            },
+            "certificate": {
+                "Type": "AWS::IoT::Certificate",
+                "Properties": {"CertificateSigningRequest": {"Ref": "CSR"}, "Status": "ACTIVE"},
+            },
+            "policy": {
+                "Type": "AWS::IoT::Policy",
+                "Properties": {"PolicyName": policy_name},
+            },
+        },
+    }
+
+
+def parameter_line(thing_name, csr_pem):
+    return json.dumps({"ThingName": thing_name, "CSR": csr_pem}, separators=(",", ":")) + "\n"
+
+
+def generate_keys_and_csrs(thing_names):
+    """Returns a new P-256 private key and a CSR for it, both PEM, for each name"""
+    backend = default_backend()
+    generated = []
+    for thing_name in thing_names:
+        private_key = ec.generate_private_key(ec.SECP256R1(), backend)
+        csr = x509.CertificateSigningRequestBuilder().subject_name(x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, u"%s" % thing_name)])).sign(
+            private_key, hashes.SHA256(), backend)
+        generated.append((
+            thing_name,
+            csr.public_bytes(serialization.Encoding.PEM).decode("ascii"),
+            private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                      serialization.NoEncryption()).decode("ascii")))
+    return generated
+
+
+def generate_credentials(thing_names, pool=None, processes=None, batch_size=256, max_in_flight=None):
+    """Yields (name, CSR PEM, private key PEM) for every name, in order. Names are handed to
+    a process pool a batch at a time, and only max_in_flight batches are ever outstanding,
+    so neither names nor keys pile up however far ahead of the consumer the pool gets.
+    The pool is pool, left open for its owner, or else one of processes processes started
+    here. Forking while other threads hold locks can deadlock the children, so a process
+    running threads should start the pool before them and pass it in"""
+    max_in_flight = max_in_flight or 2 * (processes or multiprocessing.cpu_count())
+    own_pool = pool is None
+    if own_pool:
+        pool = multiprocessing.Pool(processes)
+    in_flight = collections.deque()
+    try:
+        batch = []
+        for thing_name in thing_names:
+            batch.append(thing_name)
+            if len(batch) < batch_size:
+                continue
+            in_flight.append(pool.apply_async(generate_keys_and_csrs, (batch,)))
+            batch = []
+            if len(in_flight) >= max_in_flight:
+                for generated in in_flight.popleft().get():
+                    yield generated
+
+        if batch:
+            in_flight.append(pool.apply_async(generate_keys_and_csrs, (batch,)))
+        while in_flight:
+            for generated in in_flight.popleft().get():
+                yield generated
+    finally:
+        # Everything has been collected, unless the consumer gave up early
+        if own_pool:
+            pool.terminate()
+            pool.join()
+
+
+class MultipartWriter(object):
+    """Writes an S3 object a part at a time. Parts are uploaded on worker threads while the
+    next one is written, and at most workers of them are held in memory waiting"""
+
+    def __init__(self, s3_client, bucket, key, part_size=PART_SIZE, workers=4):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+        self.buffer = []
+        self.buffered = 0
+        self.size = 0
+        # One per part, in part number order
+        self.parts = []
+        self.in_flight = threading.BoundedSemaphore(workers)
+        self.pool = ThreadPool(workers)
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.size += len(data)
+        if self.buffered >= self.part_size:
+            self._flush()
+
+    def _flush(self):
+        body = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        # A failed part fails the upload, so stop as soon as one has
+        for part in self.parts:
+            if part.ready() and not part.successful():
+                part.get()
+        self.in_flight.acquire()
+        self.parts.append(self.pool.apply_async(self._upload_part, (len(self.parts) + 1, body)))
+
+    def _upload_part(self, part_number, body):
+        try:
+            response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  PartNumber=part_number, Body=body)
+            return {"ETag": response["ETag"], "PartNumber": part_number}
+        finally:
+            self.in_flight.release()
+
+    def close(self):
+        """Uploads what is left and completes the upload"""
+        # An empty object is still one part
+        if self.buffered or not self.parts:
+            self._flush()
+        self.pool.close()
+        self.pool.join()
+        self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                 MultipartUpload={"Parts": [part.get() for part in self.parts]})
+
+    def abort(self):
+        self.pool.close()
+        self.pool.join()
+        self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+            return
+        try:
+            self.close()
+        except Exception:
+            self.abort()
+            raise
+
+
+def wait_for_task(iot_client, task_id, poll_interval=10.0, max_poll_interval=60.0, on_progress=None):
+    """Polls a registration task until it has finished, and returns its last description.
+    Polls back off, up to max_poll_interval, while the task makes no progress, and
+    on_progress(description) is called whenever it does"""
+    interval = poll_interval
+    last_progress = None
+    while True:
+        task = iot_client.describe_thing_registration_task(taskId=task_id)
+        progress = (task.get("percentageProgress"), task.get("successCount"), task.get("failureCount"))
+        if progress != last_progress:
+            last_progress = progress
+            interval = poll_interval
+            if on_progress:
+                on_progress(task)
+        else:
+            interval = min(2 * interval, max_poll_interval)
+        if task["status"] in FINISHED:
+            return task
+        time.sleep(interval)
+
+
+def read_reports(iot_client, task_id, report_type, open_url=urlopen):
+    """Yields every line of a task's RESULTS or ERRORS reports, parsed, reading one report
+    file at a time"""
+    kwargs = {"taskId": task_id, "reportType": report_type}
+    while True:
+        page = iot_client.list_thing_registration_task_reports(**kwargs)
+        for url in page.get("resourceLinks", []):
+            report = open_url(url)
+            try:
+                for line in report:
+                    line = line.strip()
+                    if line:
+                        yield json.loads(line.decode("utf-8"))
+            finally:
+                report.close()
+        if not page.get("nextToken"):
+            return
+        kwargs["nextToken"] = page["nextToken"]
+
+
+def parse_result(result):
+    """Returns the thing name, certificate id, certificate ARN and certificate PEM from a
+    line of a RESULTS report"""
+    response = result["response"]
+    resource_arns = response["ResourceArns"]
+    certificate_arn = resource_arns["certificate"]
+    return (resource_arns["thing"].split("/")[-1], certificate_arn.split("/")[-1], certificate_arn,
+            response["CertificatePem"])
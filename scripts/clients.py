@@ -0,0 +1,147 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Pooled boto3 clients, one per service and region, and running the same work in many
+regions at once.
+
+Creating a client loads the service's model, and each client keeps its own pool of
+keep-alive connections to its region's endpoint. So each client is created once and
+shared by every thread working in its region, with a connection for each of them.
+IoT limits API calls per region, so each region also gets its own rate limiter:
+
+    client_factory = ClientFactory(max_pool_connections=workers, rate_limits=["10"])
+    results = fan_out(["us-east-1", "eu-west-1"], provision)
+
+fan_out() calls provision() once per region, each on its own thread with that region
+made current, so client_factory.client("iot") called from there is that region's client.
+Threads the work starts itself don't inherit the region, so hand them their clients.
+"""
+
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+current = threading.local()
+
+
+def current_region():
+    """The region fan_out() is running the calling thread's work in, or None"""
+    return getattr(current, "region", None)
+
+
+def in_region(region, function, *args):
+    previous = current_region()
+    current.region = region
+    try:
+        return function(*args)
+    finally:
+        current.region = previous
+
+
+def parse_regions(values):
+    """Returns the regions named in values, each a region or a comma separated list of
+    them, in order and without repeats"""
+    regions = []
+    for value in values or []:
+        for region in value.split(","):
+            region = region.strip()
+            if region and region not in regions:
+                regions.append(region)
+    return regions
+
+
+def client_config(max_pool_connections):
+    from botocore.config import Config
+
+    options = {"max_pool_connections": max_pool_connections}
+    # Older botocore has no TCP keep-alive option, but still reuses pooled connections
+    if "tcp_keepalive" in Config.OPTION_DEFAULTS:
+        options["tcp_keepalive"] = True
+    return Config(**options)
+
+
+class ClientFactory(object):
+
+    def __init__(self, max_pool_connections=10, rate_limits=None, api_stats=None, endpoint_urls=None,
+                 profiler=None):
+        """rate_limits are RateLimiter specs, applied to IoT clients. endpoint_urls, by service,
+        point clients at a stand-in instead of AWS. profiler times API calls as phases"""
+        self.max_pool_connections = max_pool_connections
+        self.rate_limits = rate_limits
+        self.api_stats = api_stats
+        self.endpoint_urls = endpoint_urls or {}
+        self.profiler = profiler
+        self.lock = threading.Lock()
+        # Clients by service and region, None being the configured default region
+        self.clients = {}
+        self.rate_limiters = {}
+
+    def client(self, service, region=None):
+        """Returns the client for service in region, by default the current one"""
+        key = (service, region or current_region())
+        with self.lock:
+            client = self.clients.get(key)
+            if client is None:
+                import boto3
+
+                client = boto3.client(service, region_name=key[1], endpoint_url=self.endpoint_urls.get(service),
+                                      config=client_config(self.max_pool_connections))
+                if service == "iot" and self.rate_limits:
+                    self.rate_limiter(key[1]).install(client)
+                if self.api_stats:
+                    self.api_stats.instrument(client)
+                if self.profiler:
+                    self.profiler.instrument(client)
+                self.clients[key] = client
+            return client
+
+    def rate_limiter(self, region):
+        # Called with the lock held
+        if region not in self.rate_limiters:
+            from ratelimit import RateLimiter
+
+            self.rate_limiters[region] = RateLimiter.from_specs(self.rate_limits)
+        return self.rate_limiters[region]
+
+
+def fan_out(regions, function, *args):
+    """Calls function(*args) in every region at once, each on its own thread with that
+    region current. Returns an OrderedDict of region to (result, seconds, error), in the
+    order of regions. A region that fails doesn't stop the others, and its traceback is
+    written to stderr. A single region runs on the calling thread, and its errors are raised"""
+    def run(region):
+        start = time.time()
+        try:
+            return region, in_region(region, function, *args), time.time() - start, None
+        except Exception as e:
+            # In one write, so tracebacks of regions failing at once don't interleave
+            sys.stderr.write("%s: %s" % (region, traceback.format_exc()))
+            return region, None, time.time() - start, e
+
+    if len(regions) == 1:
+        start = time.time()
+        runs = [(regions[0], in_region(regions[0], function, *args), time.time() - start, None)]
+    else:
+        pool = ThreadPool(len(regions))
+        try:
+            runs = pool.map(run, regions)
+        finally:
+            pool.close()
+            pool.join()
+
+    return OrderedDict((region, (result, seconds, error)) for region, result, seconds, error in runs)
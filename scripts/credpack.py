@@ -0,0 +1,211 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Packs the credentials of many devices into one file, instead of several small files each.
+
+A pack is the devices' records, appended one after another as they are added, then an
+index sorted by a hash of the device name, then a fixed size footer locating the index:
+
+    record record ... record | index | footer
+
+The index is written when the writer is closed. Reopening a pack to add to it drops the
+old index and writes a new one, and a pack whose index never got written, because the
+writer was killed, is indexed again by scanning its records. Readers mmap the pack and
+binary search the index, so pulling out one device only touches a few pages of it:
+
+    with PackWriter("fleet.pack") as pack:
+        pack.add(thing_name, certificatePem=..., privateKey=...)
+    with PackReader("fleet.pack") as pack:
+        credentials = pack.get(thing_name)
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = b'CPK1'
+
+# Each record is its length then the device's credentials as JSON
+RECORD_HEADER = struct.Struct('>I')
+# Name hash, record offset and record length
+INDEX_ENTRY = struct.Struct('>16sQI')
+# Magic, index offset and number of index entries
+FOOTER = struct.Struct('>4sQQ')
+
+
+def name_hash(name):
+    return hashlib.sha256(name.encode('utf-8')).digest()[:16]
+
+
+def read_footer(data, size):
+    """Returns the index offset and entry count of a closed pack, or None"""
+    if size < FOOTER.size:
+        return None
+    magic, index_offset, count = FOOTER.unpack(data[size - FOOTER.size:size])
+    if magic != MAGIC or index_offset + count * INDEX_ENTRY.size + FOOTER.size != size:
+        return None
+    return index_offset, count
+
+
+class PackWriter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Where each device's record is, by name hash
+        self.index = {}
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        end = self._load() if os.path.exists(path) else 0
+        self.file = open(path, 'ab')
+        self.file.truncate(end)
+        self.offset = end
+
+    def _load(self):
+        """Indexes the records already in the pack, returning where they end"""
+        with open(self.path, 'rb') as pack_file:
+            size = os.fstat(pack_file.fileno()).st_size
+            if size == 0:
+                return 0
+            data = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            footer = read_footer(data, size)
+            if footer:
+                index_offset, count = footer
+                for i in range(count):
+                    digest, offset, length = INDEX_ENTRY.unpack_from(data, index_offset + i * INDEX_ENTRY.size)
+                    self.index[digest] = (offset, length)
+                return index_offset
+
+            # Never closed, so scan the records, dropping one cut short
+            offset = 0
+            while offset + RECORD_HEADER.size <= size:
+                length = RECORD_HEADER.unpack_from(data, offset)[0]
+                start = offset + RECORD_HEADER.size
+                if start + length > size:
+                    break
+                try:
+                    record = json.loads(data[start:start + length].decode('utf-8'))
+                except ValueError:
+                    break
+                self.index[name_hash(record['name'])] = (start, length)
+                offset = start + length
+            return offset
+        finally:
+            data.close()
+
+    def add(self, name, **credentials):
+        """Adds a device, replacing any earlier record for the same name. The record is
+        handed to the OS with a single write, so it survives the process being killed"""
+        data = json.dumps(dict(credentials, name=name), sort_keys=True, separators=(',', ':')).encode('utf-8')
+        with self.lock:
+            self.file.write(RECORD_HEADER.pack(len(data)) + data)
+            self.file.flush()
+            self.index[name_hash(name)] = (self.offset + RECORD_HEADER.size, len(data))
+            self.offset += RECORD_HEADER.size + len(data)
+
+    def remove(self, name):
+        """Drops a device from the index. Its record stays in the pack, unreachable"""
+        with self.lock:
+            self.index.pop(name_hash(name), None)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.index)
+
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            entries = [INDEX_ENTRY.pack(digest, offset, length)
+                       for digest, (offset, length) in sorted(self.index.items())]
+            self.file.write(b''.join(entries) + FOOTER.pack(MAGIC, self.offset, len(entries)))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class PackReader(object):
+
+    def __init__(self, path):
+        with open(path, 'rb') as pack_file:
+            size = os.fstat(pack_file.fileno()).st_size
+            if size == 0:
+                raise ValueError(path + " is empty")
+            self.data = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        footer = read_footer(self.data, size)
+        if footer is None:
+            self.data.close()
+            raise ValueError(path + " is not a credential pack, or was not closed after writing")
+        self.index_offset, self.count = footer
+
+    def _entry(self, i):
+        return INDEX_ENTRY.unpack_from(self.data, self.index_offset + i * INDEX_ENTRY.size)
+
+    def get(self, name):
+        """Returns the credentials added for name, or None"""
+        digest = name_hash(name)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._entry(middle)[0] < digest:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count:
+            return None
+
+        entry_digest, offset, length = self._entry(low)
+        if entry_digest != digest:
+            return None
+        record = json.loads(self.data[offset:offset + length].decode('utf-8'))
+        if record.pop('name') != name:
+            return None
+        return record
+
+    def records(self, start=0, stop=None):
+        """Yields the records of index entries start to stop, name included, in index order
+        rather than the order they were added. Ranges let separate processes share a pack"""
+        for i in range(start, self.count if stop is None else min(stop, self.count)):
+            offset, length = self._entry(i)[1:]
+            yield json.loads(self.data[offset:offset + length].decode('utf-8'))
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,227 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Per API operation call counts, latencies, retries and throttling for boto3 clients.
+
+Hooks into a client's event system, so it sees every call made through the client
+without the calling code changing:
+
+    api_stats = ApiCallStats()
+    api_stats.instrument(client)
+    ...
+    api_stats.print_summary()
+    api_stats.write_report("api_calls.prom")
+
+Time a call spent waiting for a client side rate limiter, as reported through
+record_rate_limit_wait(), is counted apart from its latency.
+"""
+
+import json
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf")]
+
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+                     'RequestLimitExceeded', 'RequestThrottled', 'SlowDown')
+
+START_KEY = 'api_call_stats_start'
+OPERATION_KEY = 'api_call_stats_operation'
+WAIT_KEY = 'api_call_stats_wait'
+
+# botocore runs every hook of a call on the thread making it, so waits are
+# summed per thread, and a call's share is the difference over the call
+rate_limit_waits = threading.local()
+
+
+def record_rate_limit_wait(seconds):
+    """Adds time the current thread waited for a rate limiter before sending a request"""
+    rate_limit_waits.total = rate_limit_wait_total() + seconds
+
+
+def rate_limit_wait_total():
+    return getattr(rate_limit_waits, 'total', 0.0)
+
+
+class OperationStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.throttled = 0
+        self.retries = 0
+        self.throttled_attempts = 0
+        self.latency_sum = 0.0
+        self.rate_limit_wait_sum = 0.0
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+
+    def observe(self, latency, rate_limit_wait=0.0):
+        self.calls += 1
+        self.latency_sum += latency
+        self.rate_limit_wait_sum += rate_limit_wait
+        for i, upper_bound in enumerate(LATENCY_BUCKETS):
+            if latency <= upper_bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def latency_percentile(self, pct):
+        """Upper bound of the bucket the percentile falls in"""
+        rank = pct / 100.0 * self.calls
+        seen = 0
+        for upper_bound, count in zip(LATENCY_BUCKETS, self.bucket_counts):
+            seen += count
+            if seen >= rank:
+                return upper_bound
+        return LATENCY_BUCKETS[-1]
+
+    def as_dict(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'throttled': self.throttled,
+            'retries': self.retries,
+            'throttled_attempts': self.throttled_attempts,
+            'latency_sum_seconds': self.latency_sum,
+            'rate_limit_wait_sum_seconds': self.rate_limit_wait_sum,
+            'latency_buckets': dict(zip([str(b) for b in LATENCY_BUCKETS], self.bucket_counts)),
+        }
+
+
+class ApiCallStats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def instrument(self, client):
+        service = client.meta.service_model.service_name
+        events = client.meta.events
+        events.register('before-parameter-build.*.*', self._before_call)
+        events.register('needs-retry.*.*', self._needs_retry)
+        events.register('after-call.*.*', lambda **kwargs: self._after_call(service, **kwargs))
+        events.register('after-call-error.*.*', lambda **kwargs: self._after_call_error(service, **kwargs))
+        return client
+
+    def _stats(self, service, operation):
+        key = (service, operation)
+        if key not in self.operations:
+            self.operations[key] = OperationStats()
+        return self.operations[key]
+
+    def _before_call(self, model, context, **kwargs):
+        context[START_KEY] = time.time()
+        context[OPERATION_KEY] = model.name
+        context[WAIT_KEY] = rate_limit_wait_total()
+
+    def _timing(self, context):
+        """A call's latency, less its rate limiter waits, and those waits"""
+        waited = rate_limit_wait_total() - context[WAIT_KEY]
+        return time.time() - context[START_KEY] - waited, waited
+
+    def _needs_retry(self, response=None, operation=None, **kwargs):
+        # Fires once per attempt; count the attempts that came back throttled,
+        # including the ones the client went on to retry successfully
+        if response is None or operation is None:
+            return
+        error_code = response[1].get('Error', {}).get('Code')
+        if error_code in THROTTLING_ERRORS:
+            with self.lock:
+                self._stats(operation.service_model.service_name, operation.name).throttled_attempts += 1
+
+    def _after_call(self, service, parsed, context, **kwargs):
+        if START_KEY not in context:
+            return
+        latency, waited = self._timing(context)
+        error_code = parsed.get('Error', {}).get('Code')
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        with self.lock:
+            stats = self._stats(service, context[OPERATION_KEY])
+            stats.observe(latency, waited)
+            stats.retries += retries
+            if error_code:
+                stats.errors += 1
+            if error_code in THROTTLING_ERRORS:
+                stats.throttled += 1
+
+    def _after_call_error(self, service, context, **kwargs):
+        # The request never got a response, e.g. the connection failed
+        if START_KEY not in context:
+            return
+        latency, waited = self._timing(context)
+        with self.lock:
+            stats = self._stats(service, context[OPERATION_KEY])
+            stats.observe(latency, waited)
+            stats.errors += 1
+
+    def print_summary(self):
+        if not self.operations:
+            return
+        print("%-36s %8s %8s %8s %8s %10s %10s %10s %10s" % (
+            "operation", "calls", "errors", "throttle", "retries", "mean ms", "p50 ms<=", "p99 ms<=",
+            "wait ms"))
+        with self.lock:
+            for (service, operation), stats in sorted(self.operations.items()):
+                print("%-36s %8d %8d %8d %8d %10.1f %10s %10s %10.1f" % (
+                    service + ":" + operation, stats.calls, stats.errors, stats.throttled, stats.retries,
+                    1000 * stats.latency_sum / stats.calls if stats.calls else 0.0,
+                    format_bound(stats.latency_percentile(50)), format_bound(stats.latency_percentile(99)),
+                    1000 * stats.rate_limit_wait_sum / stats.calls if stats.calls else 0.0))
+
+    def write_report(self, path):
+        """Writes JSON if path ends in .json, Prometheus text exposition format otherwise"""
+        with self.lock:
+            if path.endswith(".json"):
+                report = json.dumps(dict((service + ":" + operation, stats.as_dict())
+                                         for (service, operation), stats in self.operations.items()),
+                                    indent=2, sort_keys=True)
+            else:
+                report = self.prometheus_text()
+        with open(path, "w") as report_file:
+            report_file.write(report)
+
+    def prometheus_text(self):
+        lines = []
+        counters = [("aws_api_calls_total", "calls"), ("aws_api_errors_total", "errors"),
+                    ("aws_api_throttled_total", "throttled"), ("aws_api_retries_total", "retries"),
+                    ("aws_api_throttled_attempts_total", "throttled_attempts")]
+        for metric, attribute in counters:
+            lines.append("# TYPE %s counter" % metric)
+            for (service, operation), stats in sorted(self.operations.items()):
+                lines.append('%s{service="%s",operation="%s"} %d' % (
+                    metric, service, operation, getattr(stats, attribute)))
+
+        lines.append("# TYPE aws_api_call_duration_seconds histogram")
+        for (service, operation), stats in sorted(self.operations.items()):
+            labels = 'service="%s",operation="%s"' % (service, operation)
+            cumulative = 0
+            for upper_bound, count in zip(LATENCY_BUCKETS, stats.bucket_counts):
+                cumulative += count
+                le = "+Inf" if upper_bound == float("inf") else repr(upper_bound)
+                lines.append('aws_api_call_duration_seconds_bucket{%s,le="%s"} %d' % (labels, le, cumulative))
+            lines.append('aws_api_call_duration_seconds_sum{%s} %f' % (labels, stats.latency_sum))
+            lines.append('aws_api_call_duration_seconds_count{%s} %d' % (labels, stats.calls))
+
+        lines.append("# TYPE aws_api_rate_limit_wait_seconds_total counter")
+        for (service, operation), stats in sorted(self.operations.items()):
+            lines.append('aws_api_rate_limit_wait_seconds_total{service="%s",operation="%s"} %f' % (
+                service, operation, stats.rate_limit_wait_sum))
+        return "\n".join(lines) + "\n"
+
+
+def format_bound(upper_bound):
+    if upper_bound == float("inf"):
+        return "inf"
+    return "%g" % (1000 * upper_bound)
@@ -0,0 +1,245 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Crash-safe, append-only journal of the AWS resources a script creates.
+
+Every create is journaled twice: before the API call, with whatever identifies the
+resource up front, and after it, with what the call returned. Cleanup replays the
+journal and records each delete as it succeeds, so an interrupted cleanup resumes
+where it stopped instead of scanning the account:
+
+    journal = Journal("resources.journal")
+    key = journal.creating("thing", thing_name)
+    response = client.create_thing(thingName=thing_name)
+    journal.created(key, thingArn=response['thingArn'])
+    ...
+    for entry in journal.live("thing"):
+        ...
+        journal.deleted("thing", entry["id"])
+
+Every record is flushed to the OS as it is written, which survives the process being
+killed. fsync, which also survives the host going down, is batched.
+
+Opening a Journal repairs and may compact the file, so tools only reading a journal,
+possibly while a script is writing it, replay it instead:
+
+    resources = index(replay("resources.journal"))
+"""
+
+import json
+import os
+import threading
+import time
+
+CREATING = 'creating'
+CREATED = 'created'
+DELETED = 'deleted'
+
+
+def read_records(journal_file):
+    """Yields each whole record of an open journal file with its length in bytes. A
+    record cut short, by a crash or because it is being written, ends the journal"""
+    for line in journal_file:
+        if not line.endswith(b'\n'):
+            return
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError:
+            return
+        yield record, len(line)
+
+
+def replay(path):
+    """Yields the records of the journal at path, in order, without changing the file"""
+    with open(path, 'rb') as journal_file:
+        for record, _ in read_records(journal_file):
+            yield record
+
+
+def apply_record(resources, record):
+    """Applies a record to an index of the live resources, by type and then id"""
+    by_id = resources.setdefault(record['type'], {})
+    if record['state'] == DELETED:
+        by_id.pop(record['id'], None)
+        return
+
+    entry = by_id.pop(record.get('was', record['id']), None) or {}
+    entry.update(record)
+    entry.pop('was', None)
+    by_id[record['id']] = entry
+
+
+def index(records):
+    """Returns the live resources the records leave, by type and then id"""
+    resources = {}
+    for record in records:
+        apply_record(resources, record)
+    return resources
+
+
+class Journal(object):
+
+    def __init__(self, path, sync_every=256, sync_interval=1.0, **defaults):
+        """defaults, e.g. run=run_id, are added to every resource created from here on"""
+        self.path = path
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.defaults = defaults
+        self.lock = threading.Lock()
+        # Index of the live resources, by type and then id
+        self.resources = {}
+        self.records = 0
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.next_pending = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._replay()
+        self.file = open(path, 'ab')
+        # Left alone, a journal reused across many runs is mostly deleted resources
+        if self.records > 1024 and self.records > 4 * len(self):
+            self.compact()
+
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+
+        good_length = 0
+        with open(self.path, 'rb') as journal_file:
+            # A record cut short by a crash is dropped, along with anything after it
+            for record, length in read_records(journal_file):
+                self._apply(record)
+                self.records += 1
+                good_length += length
+
+        if good_length < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as journal_file:
+                journal_file.truncate(good_length)
+
+    def _apply(self, record):
+        apply_record(self.resources, record)
+        if record['state'] != DELETED and record['id'].startswith('#'):
+            self.next_pending = max(self.next_pending, int(record['id'][1:]) + 1)
+
+    def _append(self, record):
+        # Called with the lock held
+        self._apply(record)
+        self.file.write(json.dumps(record, sort_keys=True, separators=(',', ':')).encode('utf-8') + b'\n')
+        self.file.flush()
+        self.records += 1
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every or time.time() - self.last_sync >= self.sync_interval:
+            self._sync()
+
+    def _sync(self):
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def creating(self, resource_type, resource_id=None, **attributes):
+        """Journals a create about to be attempted, and returns the key to pass to
+        created(). Without an id, the resource gets a placeholder until created()"""
+        with self.lock:
+            if resource_id is None:
+                resource_id = '#%d' % self.next_pending
+                self.next_pending += 1
+            record = dict(self.defaults, **attributes)
+            record.update(type=resource_type, id=resource_id, state=CREATING)
+            self._append(record)
+        return resource_type, resource_id
+
+    def created(self, key, resource_id=None, **attributes):
+        """Journals that the create started by creating() succeeded, with the id the
+        API returned if it wasn't known up front"""
+        resource_type, provisional_id = key
+        record = dict(attributes, type=resource_type, id=resource_id or provisional_id, state=CREATED)
+        if record['id'] != provisional_id:
+            record['was'] = provisional_id
+        with self.lock:
+            self._append(record)
+        return resource_type, record['id']
+
+    def annotate(self, resource_type, resource_id, **attributes):
+        """Records more about a journaled resource, e.g. what it was attached to"""
+        with self.lock:
+            entry = self.resources.get(resource_type, {}).get(resource_id)
+            if entry:
+                self._append(dict(attributes, type=resource_type, id=resource_id, state=entry['state']))
+
+    def deleted(self, resource_type, resource_id):
+        with self.lock:
+            if resource_id in self.resources.get(resource_type, {}):
+                self._append({'type': resource_type, 'id': resource_id, 'state': DELETED})
+
+    def get(self, resource_type, resource_id):
+        with self.lock:
+            return self.resources.get(resource_type, {}).get(resource_id)
+
+    def live(self, resource_type, **match):
+        """Returns every resource of resource_type not yet deleted, optionally only
+        those whose attributes match, e.g. run=run_id. Resources still in the
+        creating state may or may not exist"""
+        with self.lock:
+            return [dict(entry) for entry in self.resources.get(resource_type, {}).values()
+                    if all(entry.get(name) == value for name, value in match.items())]
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(resources) for resources in self.resources.values())
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            self._sync()
+
+    def compact(self):
+        """Rewrites the journal with one record per live resource"""
+        with self.lock:
+            self.file.close()
+            with open(self.path + '.tmp', 'wb') as compacted:
+                for resources in self.resources.values():
+                    for entry in resources.values():
+                        compacted.write(json.dumps(entry, sort_keys=True, separators=(',', ':')).encode('utf-8') + b'\n')
+                compacted.flush()
+                os.fsync(compacted.fileno())
+            os.rename(self.path + '.tmp', self.path)
+            self.records = sum(len(resources) for resources in self.resources.values())
+            self.file = open(self.path, 'ab')
+            self.unsynced = 0
+
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.flush()
+            self._sync()
+            self.file.close()
+
+
+class ScopedJournal(object):
+    """A view of a journal adding defaults of its own, e.g. region=region, to every
+    resource created through it. Everything else goes straight to the journal"""
+
+    def __init__(self, journal, **defaults):
+        self.journal = journal
+        self.defaults = defaults
+
+    def creating(self, resource_type, resource_id=None, **attributes):
+        return self.journal.creating(resource_type, resource_id, **dict(self.defaults, **attributes))
+
+    def __getattr__(self, name):
+        return getattr(self.journal, name)
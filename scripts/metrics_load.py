@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Load tests security profiles with many virtual devices publishing Device Defender metrics.
+
+Each virtual device holds its own MQTT connection, as the thing, and publishes a JSON
+metrics report to its reserved Device Defender topic every --interval seconds, the way
+the agent does. All of them run on one asyncio event loop, so a single process can keep
+thousands of devices connected. Needs Python 3.5 or later.
+
+Against AWS IoT, each device connects with its credentials from the pack written by
+provision_thing.py --count or --manifest. Against a local broker, e.g. mosquitto, use
+--no-tls and any thing names:
+
+    python3 ./metrics_load.py --count 1000 --interval 60 --duration 600
+    python3 ./metrics_load.py --count 5000 --interval 10 --endpoint localhost --no-tls
+
+Latency is from publishing a report to the broker acknowledging it or, with
+--wait-accepted, to Device Defender accepting or rejecting it.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import ssl
+import struct
+import tempfile
+import time
+
+from credpack import PackReader
+
+AMAZON_ROOT_CA__FILE = "../certificates/AmazonRootCA1.pem"
+FLEET_PACK_FILE = "../certificates/fleet.pack"
+THING_NAME = "DefenderWorkshopThing"
+
+METRICS_TOPIC = "$aws/things/%s/defender/metrics/json"
+
+# MQTT 3.1.1 control packet types, shifted into the first byte of the fixed header
+CONNECT = 0x10
+CONNACK = 0x20
+PUBLISH = 0x30
+PUBACK = 0x40
+SUBSCRIBE = 0x82
+SUBACK = 0x90
+DISCONNECT = 0xe0
+
+# AWS IoT disconnects clients idle for longer than this, in seconds
+KEEP_ALIVE = 1200
+
+
+def encode_string(value):
+    data = value.encode('utf-8')
+    return struct.pack('>H', len(data)) + data
+
+
+def encode_packet(packet_type, body):
+    remaining = len(body)
+    header = bytearray([packet_type])
+    while True:
+        byte, remaining = remaining % 128, remaining // 128
+        header.append(byte | 0x80 if remaining else byte)
+        if not remaining:
+            return bytes(header) + body
+
+
+class MqttError(Exception):
+    pass
+
+
+class MqttClient(object):
+    """Just enough of an MQTT 3.1.1 client to publish at QoS 1 and receive at QoS 0"""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.reader = None
+        self.writer = None
+        self.packet_ids = 0
+        # Futures completed by the broker's PUBACK or SUBACK, by packet id
+        self.pending = {}
+        self.on_message = None
+        self.receiving = None
+        self.lost = None
+
+    async def connect(self, host, port, ssl_context=None):
+        self.reader, self.writer = await asyncio.open_connection(
+            host, port, ssl=ssl_context, server_hostname=host if ssl_context else None)
+        body = (encode_string("MQTT") + bytes(bytearray([4, 0x02])) + struct.pack('>H', KEEP_ALIVE) +
+                encode_string(self.client_id))
+        self.writer.write(encode_packet(CONNECT, body))
+        packet_type, body = await self._read_packet()
+        if packet_type != CONNACK or bytearray(body)[1] != 0:
+            raise MqttError("%s: connection refused (%r)" % (self.client_id, body))
+        self.receiving = asyncio.ensure_future(self._receive())
+
+    async def _read_packet(self):
+        first = await self.reader.readexactly(1)
+        length, shift = 0, 0
+        while True:
+            byte = bytearray(await self.reader.readexactly(1))[0]
+            length += (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        body = await self.reader.readexactly(length)
+        return bytearray(first)[0] & 0xf0, body
+
+    async def _receive(self):
+        try:
+            while True:
+                packet_type, body = await self._read_packet()
+                if packet_type in (PUBACK, SUBACK):
+                    future = self.pending.pop(struct.unpack('>H', body[:2])[0], None)
+                    if future and not future.done():
+                        future.set_result(None)
+                elif packet_type == PUBLISH and self.on_message:
+                    topic_length = struct.unpack('>H', body[:2])[0]
+                    self.on_message(body[2:2 + topic_length].decode('utf-8'), body[2 + topic_length:])
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self.lost = MqttError("%s: connection lost (%s)" % (self.client_id, e))
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(self.lost)
+            self.pending.clear()
+
+    async def _acknowledged(self, packet_type, before_id, after_id):
+        """Sends a packet with a packet id between before_id and after_id, and waits for
+        the broker to acknowledge it"""
+        if self.lost:
+            raise self.lost
+        self.packet_ids = self.packet_ids % 0xffff + 1
+        future = asyncio.get_event_loop().create_future()
+        self.pending[self.packet_ids] = future
+        self.writer.write(encode_packet(packet_type, before_id + struct.pack('>H', self.packet_ids) + after_id))
+        # Waits for the socket to drain if the broker falls behind, rather than buffering without bound
+        await self.writer.drain()
+        await future
+
+    async def publish(self, topic, payload):
+        """Publishes at QoS 1, returning once the broker's PUBACK arrives"""
+        await self._acknowledged(PUBLISH | 0x02, encode_string(topic), payload)
+
+    async def subscribe(self, topic):
+        """Subscribes at QoS 0, returning once the broker's SUBACK arrives"""
+        await self._acknowledged(SUBSCRIBE, b'', encode_string(topic) + b'\x00')
+
+    async def close(self):
+        if self.writer is None:
+            return
+        if self.receiving:
+            self.receiving.cancel()
+        try:
+            self.writer.write(encode_packet(DISCONNECT, b''))
+            await self.writer.drain()
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+class VirtualDevice(object):
+    """Makes up a thing's metrics reports. Like the agent's, the network stats are what
+    was sent and received since the last report, which for one of the --violators is far
+    more packets out than the workshop security profile allows"""
+
+    def __init__(self, thing_name, violating=False):
+        self.thing_name = thing_name
+        self.violating = violating
+        self.last_report_id = 0
+
+    def report(self):
+        packets_out = random.randint(20000, 40000) if self.violating else random.randint(10, 1000)
+        packets_in = random.randint(10, 1000)
+        # Report ids have to increase, and two reports can land in the same millisecond
+        self.last_report_id = max(self.last_report_id + 1, int(time.time() * 1000))
+
+        return self.last_report_id, json.dumps({
+            "header": {"report_id": self.last_report_id, "version": "1.0"},
+            "metrics": {
+                "listening_tcp_ports": {"ports": [{"interface": "eth0", "port": 22}], "total": 1},
+                "listening_udp_ports": {"ports": [{"interface": "eth0", "port": 68}], "total": 1},
+                "network_stats": {"bytes_in": packets_in * random.randint(64, 1500),
+                                  "bytes_out": packets_out * random.randint(64, 1500),
+                                  "packets_in": packets_in, "packets_out": packets_out},
+                "tcp_connections": {"established_connections": {
+                    "connections": [{"local_interface": "eth0", "local_port": 22,
+                                     "remote_addr": "10.0.0.%d:%d" % (random.randint(1, 254),
+                                                                      random.randint(1024, 65535))}],
+                    "total": 1}},
+            },
+        }, separators=(',', ':')).encode('utf-8')
+
+
+class LoadStats(object):
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.connected = 0
+        self.connect_failures = 0
+        self.sent = 0
+        self.rejected = 0
+        self.failed = 0
+        self.latencies = []
+        self.start = time.time()
+
+    def window(self):
+        """Returns the latencies since the last call, for periodic reporting"""
+        latencies, self.latencies = self.latencies, []
+        return latencies
+
+    def print_progress(self, latencies, elapsed):
+        latencies.sort()
+        print("%8.0fs %7d connected %10.0f reports/min %9.1f p50 ms %9.1f p99 ms %6d rejected %6d failed" % (
+            time.time() - self.start, self.connected, 60.0 * len(latencies) / elapsed,
+            1000 * percentile(latencies, 50) if latencies else 0.0,
+            1000 * percentile(latencies, 99) if latencies else 0.0,
+            self.rejected, self.failed))
+
+
+def percentile(sorted_samples, pct):
+    index = int(round((pct / 100.0) * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+
+async def run_device(device, connect, stats, interval, end_time, wait_accepted, record=None):
+    client = MqttClient(device.thing_name)
+    topic = METRICS_TOPIC % device.thing_name
+    responses = {}
+
+    def on_message(response_topic, payload):
+        report_id = json.loads(payload.decode('utf-8')).get("reportId")
+        future = responses.pop(report_id, None)
+        if future and not future.done():
+            future.set_result(response_topic.endswith("/rejected"))
+
+    try:
+        await connect(client)
+    except (OSError, MqttError, asyncio.IncompleteReadError) as e:
+        stats.connect_failures += 1
+        print("Failed connecting %s: %s" % (device.thing_name, e))
+        return
+    stats.connected += 1
+
+    try:
+        if wait_accepted:
+            client.on_message = on_message
+            await client.subscribe(topic + "/accepted")
+            await client.subscribe(topic + "/rejected")
+
+        # Spread the devices evenly over the interval, rather than all reporting at once
+        next_report = time.time() + random.uniform(0, interval)
+        while True:
+            await asyncio.sleep(max(0, min(next_report, end_time) - time.time()))
+            if time.time() >= end_time:
+                break
+            report_id, payload = device.report()
+            if wait_accepted:
+                response = responses[report_id] = asyncio.get_event_loop().create_future()
+            start = time.time()
+            try:
+                await client.publish(topic, payload)
+                rejected = False
+                if wait_accepted:
+                    rejected = await asyncio.wait_for(response, interval)
+                stats.latencies.append(time.time() - start)
+                stats.sent += 1
+                if record:
+                    record(device.thing_name, start, payload)
+                if rejected:
+                    stats.rejected += 1
+            except (MqttError, asyncio.TimeoutError):
+                stats.failed += 1
+                responses.pop(report_id, None)
+            next_report += interval
+    finally:
+        stats.connected -= 1
+        await client.close()
+
+
+async def run_load(devices, connect, interval, duration, wait_accepted=False, progress_interval=10.0,
+                   max_connecting=100, record=None):
+    """Runs every device for duration seconds, printing throughput and latency every
+    progress_interval seconds, and returns the stats. record, if given, is called with
+    the thing name, time and payload of every report the broker acknowledged"""
+    stats = LoadStats(len(devices))
+    end_time = time.time() + duration
+    # TLS handshakes are expensive on both ends, so only so many happen at once
+    connecting = asyncio.Semaphore(max_connecting)
+
+    async def limited_connect(client):
+        async with connecting:
+            await connect(client)
+
+    tasks = [asyncio.ensure_future(run_device(device, limited_connect, stats, interval, end_time,
+                                              wait_accepted, record))
+             for device in devices]
+    all_latencies = []
+    last_progress = time.time()
+    while not all(task.done() for task in tasks):
+        await asyncio.sleep(min(progress_interval, max(0.1, end_time - time.time())))
+        now = time.time()
+        if progress_interval and now - last_progress >= progress_interval:
+            latencies = stats.window()
+            stats.print_progress(latencies, now - last_progress)
+            all_latencies += latencies
+            last_progress = now
+        if now > end_time + interval:
+            for task in tasks:
+                task.cancel()
+    await asyncio.wait(tasks)
+
+    stats.latencies = all_latencies + stats.window()
+    stats.elapsed = time.time() - stats.start
+    return stats
+
+
+def print_summary(stats):
+    latencies = sorted(stats.latencies)
+    print("Sent %d reports from %d devices in %.1fs (%.0f reports/min), %d rejected, %d failed, "
+          "%d devices failed to connect" % (
+              stats.sent, stats.devices, stats.elapsed, 60.0 * stats.sent / stats.elapsed,
+              stats.rejected, stats.failed, stats.connect_failures))
+    if latencies:
+        print("Latency ms: mean %.1f, p50 %.1f, p99 %.1f, max %.1f" % (
+            1000 * sum(latencies) / len(latencies), 1000 * percentile(latencies, 50),
+            1000 * percentile(latencies, 99), 1000 * latencies[-1]))
+
+
+def tls_connector(endpoint, port, pack_path, root_ca_path):
+    """Returns a coroutine function connecting a client with its thing's credentials from
+    the fleet pack. ssl only loads certificates from files, so each is written out to a
+    private directory just long enough to load it"""
+    pack = PackReader(pack_path)
+    directory = tempfile.mkdtemp(prefix="metrics-load-")
+
+    def ssl_context(thing_name):
+        credentials = pack.get(thing_name)
+        if credentials is None:
+            raise MqttError("no credentials for %s in %s" % (thing_name, pack_path))
+        certificate_path = os.path.join(directory, "certificate.pem")
+        private_key_path = os.path.join(directory, "private.key")
+        with open(certificate_path, "w") as certificate_file:
+            certificate_file.write(credentials['certificatePem'])
+        with open(private_key_path, "w") as private_key:
+            private_key.write(credentials['privateKey'])
+        try:
+            context = ssl.create_default_context(cafile=root_ca_path)
+            context.load_cert_chain(certificate_path, private_key_path)
+        finally:
+            os.remove(private_key_path)
+        return context, credentials.get('endpoint')
+
+    async def connect(client):
+        context, pack_endpoint = ssl_context(client.client_id)
+        await client.connect(endpoint or pack_endpoint, port, context)
+
+    def close():
+        pack.close()
+        shutil.rmtree(directory)
+
+    return connect, close
+
+
+def plain_connector(endpoint, port):
+    async def connect(client):
+        await client.connect(endpoint, port)
+    return connect
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Publish Device Defender metrics reports from many virtual devices at once")
+    parser.add_argument("-n", "--count", type=int, dest="count",
+                        help="Run COUNT devices named " + THING_NAME + "-<n>, as provision_thing.py --count names them")
+    parser.add_argument("-m", "--manifest", dest="manifest",
+                        help="Run a device for every thing named in MANIFEST, one thing name per line")
+    parser.add_argument("-i", "--interval", type=float, default=300.0,
+                        help="Seconds between each device's reports (default 300, the agent's)")
+    parser.add_argument("-d", "--duration", type=float, default=600.0,
+                        help="Seconds to run for (default 600)")
+    parser.add_argument("--violators", type=float, default=0.0, metavar="PERCENT",
+                        help="Percentage of devices reporting far more packets out than the workshop "
+                             "security profile allows")
+    parser.add_argument("-e", "--endpoint",
+                        help="MQTT endpoint. Defaults to the endpoint the devices were provisioned against")
+    parser.add_argument("-p", "--port", type=int,
+                        help="MQTT port (default 8883, or 1883 with --no-tls)")
+    parser.add_argument("--no-tls", action="store_true", dest="no_tls",
+                        help="Connect without TLS or credentials, e.g. to a local broker")
+    parser.add_argument("--pack", default=FLEET_PACK_FILE,
+                        help="Credential pack written by provision_thing.py (default " + FLEET_PACK_FILE + ")")
+    parser.add_argument("-r", "--root-ca", default=AMAZON_ROOT_CA__FILE, dest="root_ca",
+                        help="CA certificate to verify the endpoint with (default " + AMAZON_ROOT_CA__FILE + ")")
+    parser.add_argument("--wait-accepted", action="store_true", dest="wait_accepted",
+                        help="Measure latency to Device Defender accepting each report, instead of to "
+                             "the broker acknowledging it")
+    parser.add_argument("--max-connecting", type=int, default=100, dest="max_connecting",
+                        help="Number of devices connecting at once while ramping up (default 100)")
+    parser.add_argument("--record", dest="record",
+                        help="Also write every report published to RECORD, as JSON lines that behaviors.py "
+                             "can evaluate a security profile over")
+    parser.add_argument("--progress-interval", type=float, default=10.0, dest="progress_interval",
+                        help="Seconds between progress lines (default 10)")
+    args = parser.parse_args()
+
+    if args.manifest:
+        with open(args.manifest, "r") as manifest:
+            thing_names = [line.strip() for line in manifest if line.strip()]
+    elif args.count:
+        thing_names = ["%s-%d" % (THING_NAME, i) for i in range(args.count)]
+    else:
+        parser.error("one of --count or --manifest is required")
+    if args.interval > KEEP_ALIVE:
+        parser.error("--interval can be at most %d, or devices are disconnected between reports" % KEEP_ALIVE)
+    if args.no_tls and not args.endpoint:
+        parser.error("--no-tls needs an --endpoint")
+    if not args.no_tls and not os.path.exists(args.pack):
+        parser.error("no credential pack at %s, provision the things with provision_thing.py --count or "
+                     "--manifest first" % args.pack)
+
+    violators = set(random.sample(range(len(thing_names)), int(len(thing_names) * args.violators / 100.0)))
+    devices = [VirtualDevice(thing_name, i in violators) for i, thing_name in enumerate(thing_names)]
+
+    close = None
+    if args.no_tls:
+        connect = plain_connector(args.endpoint, args.port or 1883)
+    else:
+        connect, close = tls_connector(args.endpoint, args.port or 8883, args.pack, args.root_ca)
+
+    print("Running %d devices (%d violating), one report every %.0fs each: %.0f reports/min for %.0fs" % (
+        len(devices), len(violators), args.interval, 60.0 * len(devices) / args.interval, args.duration))
+    record = None
+    record_file = None
+    if args.record:
+        record_file = open(args.record, "w")
+
+        def record(thing_name, timestamp, payload):
+            record_file.write('{"thingName":%s,"timestamp":%.3f,"report":%s}\n' % (
+                json.dumps(thing_name), timestamp, payload.decode('utf-8')))
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        stats = loop.run_until_complete(run_load(devices, connect, args.interval, args.duration,
+                                                 args.wait_accepted, args.progress_interval,
+                                                 args.max_connecting, record))
+    finally:
+        if close:
+            close()
+        if record_file:
+            record_file.close()
+    print_summary(stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Wall and CPU time by named phase, such as a scenario, a provisioning stage or
+signing a certificate, for telling where a run's time goes.
+
+Code marks its phases, which cost nothing until a profiler is enabled:
+
+    with phase("create_thing"):
+        client.create_thing(thingName=thing_name)
+
+    profiler = enable(PhaseProfiler(mode="sample"))
+    profiler.wrap_crypto()
+    profiler.instrument(client)
+    ...
+    profiler.print_summary()
+    profiler.write_report("profile")
+
+Phases nest, and each is reported under the phases of its thread it ran in, e.g.
+"scenario:demo_x/crypto:x509_sign", with how much of its time no nested phase
+accounts for. API calls of instrumented clients are phases of their own, "api:<Operation>".
+Timing a phase reads two clocks at each end, so even key generation and signing
+can be timed one by one. On top of the timers, "cprofile" mode runs cProfile in
+each outermost phase, one at a time, and "sample" mode samples every thread's
+stack, writing them collapsed, as flame graph tools take them.
+"""
+
+import cProfile
+import collections
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+MODES = ("timers", "cprofile", "sample")
+
+# Per thread CPU time is only available from Python 3.7
+thread_time = getattr(time, "thread_time", None)
+
+current = threading.local()
+active = None
+
+
+class NoPhase(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NO_PHASE = NoPhase()
+
+
+def enable(profiler):
+    """Makes phase() time phases with profiler, and returns it"""
+    global active
+    active = profiler
+    return profiler
+
+
+def phase(name):
+    return NO_PHASE if active is None else Phase(active, name)
+
+
+class Phase(object):
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.enter(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.exit()
+
+
+class PhaseStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        # Time spent in phases nested in this one
+        self.nested = 0.0
+
+    def as_dict(self):
+        return {"calls": self.calls, "wall_seconds": self.wall, "self_seconds": self.wall - self.nested,
+                "cpu_seconds": self.cpu if thread_time else None}
+
+
+class PhaseProfiler(object):
+
+    def __init__(self, mode="timers", sample_interval=0.005):
+        if mode not in MODES:
+            raise ValueError("Unknown profiling mode " + mode)
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # Stats by phase path, e.g. ("scenario:demo_x", "crypto:x509_sign")
+        self.phases = {}
+        # Each thread's open phases as [name, wall start, cpu start, nested time, cProfile]
+        self.stacks = {}
+        # cProfile statistics by outermost phase name
+        self.cprofile_stats = {}
+        self.cprofile_lock = threading.Lock()
+        # Sampled stacks, collapsed, and how often each was seen
+        self.samples = collections.Counter()
+        self.sampler = None
+        self.stopped = threading.Event()
+        if mode == "sample":
+            self.sampler = threading.Thread(target=self._sample)
+            self.sampler.daemon = True
+            self.sampler.start()
+
+    def _stack(self):
+        stack = getattr(current, "stack", None)
+        if stack is None:
+            stack = current.stack = []
+            with self.lock:
+                self.stacks[threading.current_thread().ident] = stack
+        return stack
+
+    def enter(self, name):
+        stack = self._stack()
+        profile = None
+        # Only one profiler can be active at a time, so phases running while another
+        # thread's phase is being profiled go without. From Python 3.12 a profiler sees
+        # every thread, so threads running alongside show up in the profiled phase
+        if self.mode == "cprofile" and not stack and self.cprofile_lock.acquire(False):
+            profile = cProfile.Profile()
+        stack.append([name, time.time(), thread_time() if thread_time else 0.0, 0.0, profile])
+        if profile:
+            profile.enable()
+
+    def exit(self):
+        stack = current.stack
+        name, wall_start, cpu_start, nested, profile = stack[-1]
+        if profile:
+            profile.disable()
+            self.cprofile_lock.release()
+        wall = time.time() - wall_start
+        cpu = thread_time() - cpu_start if thread_time else 0.0
+        path = tuple(entry[0] for entry in stack)
+        stack.pop()
+        if stack:
+            stack[-1][3] += wall
+        self.record(path, wall, cpu, nested)
+        if profile:
+            with self.lock:
+                if name in self.cprofile_stats:
+                    self.cprofile_stats[name].add(profile)
+                else:
+                    self.cprofile_stats[name] = pstats.Stats(profile)
+
+    def record(self, path, wall, cpu=0.0, nested=0.0):
+        with self.lock:
+            stats = self.phases.get(path)
+            if stats is None:
+                stats = self.phases[path] = PhaseStats()
+            stats.calls += 1
+            stats.wall += wall
+            stats.cpu += cpu
+            stats.nested += nested
+
+    def instrument(self, client):
+        """Times every API call made through client as an "api:<Operation>" phase of
+        whatever phase made it"""
+        events = client.meta.events
+        events.register('before-parameter-build.*.*', self._before_call)
+        events.register('after-call.*.*', self._after_call)
+        events.register('after-call-error.*.*', self._after_call)
+        return client
+
+    def _before_call(self, model, context, **kwargs):
+        context['phase_profiler_start'] = (model.name, time.time())
+
+    def _after_call(self, context, **kwargs):
+        if 'phase_profiler_start' not in context:
+            return
+        operation, start = context.pop('phase_profiler_start')
+        wall = time.time() - start
+        stack = self._stack()
+        if stack:
+            stack[-1][3] += wall
+        self.record(tuple(entry[0] for entry in stack) + ("api:" + operation,), wall)
+
+    def wrap(self, owner, attribute, name):
+        """Replaces owner.attribute, a function or method, with one timing each call as
+        phase name. Modules that imported the function by name get the wrapper too"""
+        original = getattr(owner, attribute)
+        profiler = self
+
+        def wrapper(*args, **kwargs):
+            profiler.enter(name)
+            try:
+                return original(*args, **kwargs)
+            finally:
+                profiler.exit()
+
+        wrapper.__name__ = attribute
+        setattr(owner, attribute, wrapper)
+        for module in list(sys.modules.values()):
+            # Looked up in the module's dict, as some modules import lazily on attribute access
+            if module is not owner and getattr(module, "__dict__", {}).get(attribute) is original:
+                setattr(module, attribute, wrapper)
+
+    def wrap_crypto(self):
+        """Times key generation, signing and serialization wherever they happen"""
+        from cryptography import x509
+        from cryptography.hazmat.primitives.asymmetric import ec, rsa
+
+        self.wrap(rsa, "generate_private_key", "crypto:rsa_keygen")
+        self.wrap(ec, "generate_private_key", "crypto:ec_keygen")
+        self.wrap(x509.CertificateBuilder, "sign", "crypto:x509_sign")
+        self.wrap(x509.CertificateSigningRequestBuilder, "sign", "crypto:csr_sign")
+        self.wrap(x509.CertificateRevocationListBuilder, "sign", "crypto:crl_sign")
+        # The audit scripts' PEM helpers and key pool, when they are loaded. Pooled keys are
+        # generated in other processes, so what shows here is the wait for one
+        pki = sys.modules.get("pki")
+        if pki is not None:
+            self.wrap(pki, "cert_to_pem", "crypto:pem_serialize")
+            self.wrap(pki, "privkey_to_pem", "crypto:pem_serialize")
+        keypool = sys.modules.get("keypool")
+        if keypool is not None:
+            self.wrap(keypool.KeyPool, "get", "crypto:key_pool_wait")
+
+    def _sample(self):
+        sampler = threading.current_thread().ident
+        while not self.stopped.wait(self.sample_interval):
+            frames = sys._current_frames()
+            with self.lock:
+                stacks = [(ident, [entry[0] for entry in stack]) for ident, stack in self.stacks.items()]
+            for ident, phases in stacks:
+                frame = frames.get(ident)
+                # Threads outside any phase, e.g. pool workers waiting for work, aren't sampled
+                if frame is None or ident == sampler or not phases:
+                    continue
+                functions = []
+                while frame is not None:
+                    code = frame.f_code
+                    functions.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                self.samples[";".join(phases + functions[::-1])] += 1
+
+    def stop(self):
+        if self.sampler:
+            self.stopped.set()
+            self.sampler.join()
+            self.sampler = None
+
+    def print_summary(self):
+        self.stop()
+        if not self.phases:
+            return
+        elapsed = time.time() - self.started
+        print("%-56s %8s %10s %10s %10s %10s" % ("phase", "calls", "total s", "self s", "mean ms", "cpu s"))
+        with self.lock:
+            # Each phase right after the phase it ran in, the slowest first
+            totals = dict((path, stats.wall) for path, stats in self.phases.items())
+            for path in sorted(self.phases, key=lambda path: [-totals.get(path[:i + 1], 0.0) for i in range(len(path))]):
+                stats = self.phases[path]
+                print("%-56s %8d %10.3f %10.3f %10.2f %10s" % (
+                    "  " * (len(path) - 1) + path[-1], stats.calls, stats.wall, stats.wall - stats.nested,
+                    1000 * stats.wall / stats.calls, "%.3f" % stats.cpu if thread_time else "-"))
+        print("%.2fs elapsed" % elapsed)
+
+    def write_report(self, prefix):
+        """Writes the phases to PREFIX.json and, depending on the mode, collapsed stacks
+        to PREFIX.folded or cProfile statistics to PREFIX.<phase>.pstats. Returns the paths"""
+        self.stop()
+        paths = [prefix + ".json"]
+        with self.lock:
+            report = dict(("/".join(path), stats.as_dict()) for path, stats in self.phases.items())
+            with open(paths[0], "w") as report_file:
+                json.dump(report, report_file, indent=2, sort_keys=True)
+
+            if self.mode == "sample":
+                paths.append(prefix + ".folded")
+                with open(paths[-1], "w") as folded_file:
+                    for stack, count in sorted(self.samples.items()):
+                        folded_file.write("%s %d\n" % (stack, count))
+
+            for name, stats in sorted(self.cprofile_stats.items()):
+                paths.append("%s.%s.pstats" % (prefix, name.replace(":", "-").replace("/", "-")))
+                stats.dump_stats(paths[-1])
+        return paths
@@ -14,154 +14,930 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-import boto3
 from botocore.exceptions import ClientError
+from multiprocessing.pool import ThreadPool
+from clients import ClientFactory, current_region, fan_out, parse_regions
+from credpack import PackReader, PackWriter
+from instrumentation import ApiCallStats
+from journal import CREATING, Journal
+from profiling import MODES, PhaseProfiler, enable, phase
+from reconcile import ALL_STAGES, ATTACH_POLICY, ATTACH_PRINCIPAL, ADD_TO_GROUP, CREATE_CERTIFICATE, \
+    CREATE_THING, FleetSnapshot, plan_fleet
+from teardown import TeardownPlan
 import json
 import os
 import argparse
+import atexit
+import itertools
+import multiprocessing
+import shutil
+import sys
+import threading
+import time
+import uuid
 
 IOT_POLICY_FILE = "iot_policy.json"
 
 AMAZON_ROOT_CA__FILE = "../certificates/AmazonRootCA1.pem"
 PRIVATE_KEY_FILE = "../certificates/private_key.key"
 CERTIFICATE_PEM_FILE = "../certificates/certificate.pem"
-CERTIFICATE_ID_FILE = "../certificates/certificate_id.txt"
+
+# Everything created is journaled before and after the call creating it, so --cleanup
+# can find it again, even after a crash or an interrupted cleanup. Like the credentials,
+# the journal of a region named with --region is kept under ../certificates/<region>
+JOURNAL_FILE = "../certificates/resources.journal"
+
+# Fleet mode packs every thing's credentials into one file, and --extract writes out
+# the credentials of the things to be run
+FLEET_PACK_FILE = "../certificates/fleet.pack"
+# Bulk mode packs the private keys it generates here, until the certificates are issued
+BULK_KEYS_PACK_FILE = "../certificates/bulk-keys.pack"
+FLEET_CERTIFICATES_DIR = "../certificates/fleet"
+FLEET_STAGES = ALL_STAGES
 
 THING_NAME = "DefenderWorkshopThing"
 POLICY_NAME = "DefenderWorkshopPolicy"
 GROUP_NAME = "DefenderWorkshopGroup"
 
-client = boto3.client('iot')
-
+AGENT_ARGS_FILE = "agent_args.txt"
 
-def generate_agent_args_file(agent_args_map):
-    with open(AMAZON_ROOT_CA__FILE, "r") as ca_file:
-        agent_args_map += ["-r", os.path.realpath(ca_file.name)]
+# Replaced by main() with one sized for --workers and set up for --rate-limit
+client_factory = ClientFactory()
+# Journals by region, None being the default region
+journals = {}
+journals_lock = threading.Lock()
 
-    agent_args_map += ["-f", "json"]
+# Journaled resource type removed by each kind of teardown call
+DELETE_CALLS = {"delete_thing": "thing", "delete_certificate": "certificate",
+                "delete_thing_group": "thing_group", "delete_policy": "policy"}
 
-    with open("agent_args.txt", "w") as agent_args_file:
-        agent_args_file.writelines('\n'.join(agent_args_map) + '\n')
 
+def get_client():
+    return client_factory.client('iot')
 
-def cleanup_things():
-    with open(CERTIFICATE_ID_FILE, "r") as id_file:
-        cert_id = id_file.read()
-        descr_response = client.describe_certificate(certificateId=cert_id)
-        cert_arn = descr_response['certificateDescription']['certificateArn']
-
-    if cert_arn and cert_id:
-        print("Detaching Policy")
-        client.detach_policy(policyName=POLICY_NAME, target=cert_arn)
-        print("Deactivating Certificate")
-        client.update_certificate(certificateId=cert_id,
-                                  newStatus="INACTIVE")
-        print("Detaching Cert from Thing")
-        client.detach_thing_principal(thingName=THING_NAME, principal=cert_arn)
-        print("Deleting Certificate")
-        client.delete_certificate(certificateId=cert_id)
-        print("Removing Thing from Thing Group")
-        client.remove_thing_from_thing_group(thingGroupName=GROUP_NAME, thingName=THING_NAME)
-        print("Deleting Thing")
-        client.delete_thing(thingName=THING_NAME)
-        print("Deleting Thing Group")
-        client.delete_thing_group(thingGroupName=GROUP_NAME)
-        print("Deleting Policy")
-        client.delete_policy(policyName=POLICY_NAME)
-    else:
-        print("Unable to find certificate id")
 
-    if os.path.exists(CERTIFICATE_ID_FILE):
-        os.remove(CERTIFICATE_ID_FILE)
+def get_journal():
+    region = current_region()
+    with journals_lock:
+        if region not in journals:
+            journals[region] = Journal(region_path(JOURNAL_FILE))
+        return journals[region]
 
-    if os.path.exists(PRIVATE_KEY_FILE):
-        os.remove(PRIVATE_KEY_FILE)
 
-    if os.path.exists(CERTIFICATE_PEM_FILE):
-        os.remove(CERTIFICATE_PEM_FILE)
+def close_journals():
+    with journals_lock:
+        for journal in journals.values():
+            journal.close()
 
 
-if __name__ == '__main__':
+def region_path(path):
+    """Where the current region keeps the file at path, when it was named with --region"""
+    region = current_region()
+    if region is None:
+        return path
+    return os.path.join(os.path.dirname(path), region, os.path.basename(path))
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-c", "--cleanup", required=False, action="store_true", dest="cleanup",
-                        help="Cleanup resources created by previous invocations of this script")
 
-    args = parser.parse_args()
+def log(message):
+    region = current_region()
+    # One write per line, so lines printed by regions at once don't run into each other
+    sys.stdout.write((message if region is None else "[" + region + "] " + message) + "\n")
 
-    if args.cleanup:
-        cleanup_things()
-    else:
-        try:
-            agent_args = []
-            if not client.list_things(attributeName=THING_NAME, attributeValue=THING_NAME)['things']:
-                response = client.create_thing(thingName=THING_NAME)
-                thingArn = response['thingArn']
-                thingId = response['thingId']
-                print("Created Thing: " + thingId)
-            else:
-                print("Thing Already Exists, please choose another name, or delete existing thing")
-                exit(1)
 
-            agent_args += ["-id", THING_NAME]
+def generate_agent_args_file(agent_args_map, agent_args_path=None):
+    agent_args_path = agent_args_path or region_path(AGENT_ARGS_FILE)
+    directory = os.path.dirname(agent_args_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
 
-            response = client.create_keys_and_certificate(setAsActive=True)
-            certificatePem = response['certificatePem']
-            certificateArn = response['certificateArn']
-            keyPair = response['keyPair']
-            print("Created Certificate  arn:" + certificateArn + "\n id:" + response['certificateArn'])
+    with open(AMAZON_ROOT_CA__FILE, "r") as ca_file:
+        agent_args_map += ["-r", os.path.realpath(ca_file.name)]
 
-            with open(CERTIFICATE_PEM_FILE, "w") as certificateFile:
-                certificateFile.write(certificatePem)
-                agent_args += ["-c", os.path.realpath(certificateFile.name)]
+    agent_args_map += ["-f", "json"]
 
-            # Save the certificate id to a file so we can easily cleanup later
-            with open(CERTIFICATE_ID_FILE, "w") as certificateIdFile:
-                certificateIdFile.write(response['certificateId'])
+    with open(agent_args_path, "w") as agent_args_file:
+        agent_args_file.writelines('\n'.join(agent_args_map) + '\n')
 
-            with open(PRIVATE_KEY_FILE, "w") as private_key:
-                private_key.write(keyPair["PrivateKey"])
-                private_key
-                agent_args += ["-k", os.path.realpath(private_key.name)]
 
-            response = client.attach_thing_principal(thingName=THING_NAME, principal=certificateArn)
-            print("Attached Certificate to Thing: " + THING_NAME)
+def get_or_create_policy():
+    with open(IOT_POLICY_FILE, "r") as policyFile:
+        policy = json.load(policyFile)
 
-            with open(IOT_POLICY_FILE, "r") as policyFile:
-                policy = json.load(policyFile)
+    for page in get_client().get_paginator('list_policies').paginate():
+        for p in page['policies']:
+            if p['policyName'] == POLICY_NAME:
+                log("Using Existing Policy")
+                return p['policyArn']
 
-            policies = client.list_policies()['policies']
+    return create_policy(policy)
 
-            policyArn = ""
-            for p in policies:
-                if p['policyName'] == POLICY_NAME:
-                    policyArn = p['policyArn']
-                    policyName = POLICY_NAME
-                    print("Using Existing Policy")
 
-            if not policyArn:
-                response = client.create_policy(policyName=POLICY_NAME, policyDocument=json.dumps(policy))
-                policyArn = response['policyArn']
-                print("Created Policy: " + POLICY_NAME)
+def create_policy(policy=None):
+    if policy is None:
+        with open(IOT_POLICY_FILE, "r") as policyFile:
+            policy = json.load(policyFile)
 
-            response = client.attach_policy(policyName=POLICY_NAME, target=certificateArn)
-            print("Attached Policy to Certificate")
+    key = get_journal().creating("policy", POLICY_NAME)
+    response = get_client().create_policy(policyName=POLICY_NAME, policyDocument=json.dumps(policy))
+    get_journal().created(key)
+    log("Created Policy: " + POLICY_NAME)
+    return response['policyArn']
 
-            response = client.describe_endpoint(endpointType='iot:Data-ATS')
-            agent_args += ["-e", response['endpointAddress']]
 
-            # Create a Thing Group to put our new thing into
-            response = client.create_thing_group(
-                thingGroupName=GROUP_NAME
-            )
-            thingGroupArn = response['thingGroupArn']
+class FleetStats(object):
+    """Thread safe collector for per stage latencies of a fleet provisioning run"""
 
-            # Add our workshop thing to the new group
-            response = client.add_thing_to_thing_group(
-                thingGroupArn=thingGroupArn,
-                thingArn=thingArn
-            )
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = dict((stage, []) for stage in FLEET_STAGES)
+        self.succeeded = 0
+        self.failed = 0
 
-            generate_agent_args_file(agent_args)
+    def timed(self, stage, api_call, **kwargs):
+        start = time.time()
+        try:
+            with phase("stage:" + stage):
+                return api_call(**kwargs)
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                self.latencies[stage].append(elapsed)
+
+    def record_result(self, success):
+        with self.lock:
+            if success:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+
+    def report(self, elapsed):
+        total = self.succeeded + self.failed
+        log("Provisioned %d of %d things in %.2fs (%.1f things/sec)" %
+            (self.succeeded, total, elapsed, self.succeeded / elapsed if elapsed else 0.0))
+        log("%-28s %8s %10s %10s %10s %10s" % ("stage", "calls", "mean ms", "p50 ms", "p99 ms", "max ms"))
+        for stage in FLEET_STAGES:
+            samples = sorted(self.latencies[stage])
+            if not samples:
+                continue
+            log("%-28s %8d %10.1f %10.1f %10.1f %10.1f" % (
+                stage, len(samples),
+                1000 * sum(samples) / len(samples),
+                1000 * percentile(samples, 50),
+                1000 * percentile(samples, 99),
+                1000 * samples[-1]))
+
+
+def percentile(sorted_samples, pct):
+    index = int(round((pct / 100.0) * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+
+def read_manifest(manifest_path):
+    """Returns the thing names listed in a manifest, one per line, '#' starts a comment"""
+    return list(iter_manifest(manifest_path))
+
+
+def iter_manifest(manifest_path):
+    with open(manifest_path, "r") as manifest:
+        for line in manifest:
+            name = line.split('#', 1)[0].strip()
+            if name:
+                yield name
+
+
+def iter_fleet_names(count):
+    return ("%s-%d" % (THING_NAME, i) for i in itertools.islice(itertools.count(), count))
+
+
+def provision_fleet_thing(client, thing_name, endpoint, stats, journal, pack, stages=FLEET_STAGES,
+                          certificate_arn=None):
+    """Runs the given provisioning stages for one thing. certificate_arn is the certificate
+    it already has, when the stages don't include creating one"""
+    try:
+        if CREATE_THING in stages:
+            key = journal.creating("thing", thing_name)
+            response = stats.timed("create_thing", client.create_thing, thingName=thing_name)
+            journal.created(key, thingArn=response['thingArn'])
+
+        certificate_key = None
+        if certificate_arn:
+            certificate_key = ("certificate", certificate_arn.split("/")[-1])
+
+        if CREATE_CERTIFICATE in stages:
+            # The certificate id is only known once it exists, so until then it is
+            # journaled against the thing it is for
+            key = journal.creating("certificate", thing=thing_name)
+            response = stats.timed("create_keys_and_certificate", client.create_keys_and_certificate,
+                                   setAsActive=True)
+            certificate_arn = response['certificateArn']
+            certificate_key = journal.created(key, response['certificateId'], certificateArn=certificate_arn)
+            pack.add(thing_name, certificateId=response['certificateId'],
+                     certificatePem=response['certificatePem'],
+                     privateKey=response['keyPair']['PrivateKey'], endpoint=endpoint)
+
+        if ATTACH_PRINCIPAL in stages:
+            stats.timed("attach_thing_principal", client.attach_thing_principal,
+                        thingName=thing_name, principal=certificate_arn)
+            # No list call maps things to their certificates, so a later plan relies on this
+            journal.annotate(*certificate_key, principalAttached=True)
+        if ATTACH_POLICY in stages:
+            stats.timed("attach_policy", client.attach_policy,
+                        policyName=POLICY_NAME, target=certificate_arn)
+        if ADD_TO_GROUP in stages:
+            stats.timed("add_thing_to_thing_group", client.add_thing_to_thing_group,
+                        thingGroupName=GROUP_NAME, thingName=thing_name)
+
+        stats.record_result(True)
+    except ClientError as e:
+        log("Failed provisioning " + thing_name + ": " + str(e))
+        stats.record_result(False)
+
+
+def reconcile_fleet(thing_names, workers, apply=True, prune=False):
+    """Diffs the account against the things wanted and, if apply, makes only the calls
+    that are missing. Re-running against a provisioned fleet just reads the list pages"""
+    journal = get_journal()
+    start = time.time()
+    snapshot = FleetSnapshot(get_client(), journal, POLICY_NAME, GROUP_NAME)
+    # The single workshop thing is never part of a fleet, so is left alone by prune
+    fleet_things = [entry["id"] for entry in journal.live("thing") if entry["id"] != THING_NAME]
+    plan = plan_fleet(thing_names, snapshot, fleet_things, prune)
+    log("Read %d list pages in %.2fs" % (snapshot.pages, time.time() - start))
+    plan.print_summary()
+
+    if apply and not plan.is_empty():
+        provision_fleet(plan, workers)
+    return plan
+
+
+def provision_fleet(plan, workers):
+    """Applies a fleet plan, provisioning many things at once and sharing the policy,
+    thing group and client between them"""
+    if plan.create_policy:
+        create_policy()
+    if plan.create_group:
+        create_thing_group()
+    # Worker threads don't know the region, so are handed its client
+    client = get_client()
+    endpoint = None
+    if any(CREATE_CERTIFICATE in stages for stages in plan.things.values()):
+        endpoint = client.describe_endpoint(endpointType='iot:Data-ATS')['endpointAddress']
+
+    stats = FleetStats()
+    pack = PackWriter(region_path(FLEET_PACK_FILE))
+    pool = ThreadPool(workers)
+    start = time.time()
+    results = []
+    try:
+        results = [pool.apply_async(provision_fleet_thing,
+                                    (client, thing_name, endpoint, stats, get_journal(), pack, stages,
+                                     plan.certificate_arns.get(thing_name)))
+                   for thing_name, stages in plan.things.items()]
+    finally:
+        pool.close()
+        pool.join()
+        pack.close()
+    if results:
+        stats.report(time.time() - start)
+
+    # Surface anything other than an API error, e.g. failing to write credentials to disk
+    for result in results:
+        result.get()
+
+    if plan.prune:
+        cleanup_things(workers, only=set(plan.prune))
+    return stats
+
+
+def ensure_thing_group():
+    try:
+        get_client().describe_thing_group(thingGroupName=GROUP_NAME)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        create_thing_group()
+
+
+def bulk_provision(thing_names, bucket, role_arn, prefix="", poll_interval=10.0, upload_workers=4,
+                   key_pool=None):
+    """Provisions thing_names with one bulk registration task, generating their keys and
+    streaming CSRs for them into the task's input file in S3, then packs each thing's key
+    with the certificate issued for it. Unlike --count and --manifest on their own, the
+    account isn't diffed first, so this is for things that don't exist yet. Keys are
+    generated in key_pool, a multiprocessing.Pool started before any threads, if given"""
+    from bulkreg import MultipartWriter, generate_credentials, parameter_line, registration_template
+
+    journal = get_journal()
+    # A task an earlier run started is finished before anything else
+    tasks = journal.live("registration_task")
+    if tasks:
+        for task in tasks:
+            if task["state"] == CREATING:
+                log("A registration task reading s3://%s/%s may have been started without being journaled" % (
+                    task["inputFileBucket"], task["inputFileKey"]))
+                journal.deleted("registration_task", task["id"])
+            else:
+                log("Finishing registration task %s left by an earlier run" % task["id"])
+                finish_registration_task(task, poll_interval)
+        log("Run again to provision more things")
+        return
+
+    get_or_create_policy()
+    ensure_thing_group()
+
+    region = current_region()
+    bucket = bucket.replace("{region}", region) if region else bucket
+    key = "%s%s.jsonl" % (prefix, uuid.uuid4())
+    start = time.time()
+    count = 0
+    with phase("bulk:generate_and_upload"), PackWriter(region_path(BULK_KEYS_PACK_FILE)) as keys:
+        with MultipartWriter(client_factory.client('s3'), bucket, key, workers=upload_workers) as upload:
+            for thing_name, csr_pem, private_key_pem in generate_credentials(thing_names, key_pool):
+                keys.add(thing_name, privateKey=private_key_pem)
+                upload.write(parameter_line(thing_name, csr_pem))
+                count += 1
+    log("Generated keys for %d things and uploaded their parameters (%.1f MB) to s3://%s/%s in %.2fs" % (
+        count, upload.size / 1e6, bucket, key, time.time() - start))
+
+    task_key = journal.creating("registration_task", inputFileBucket=bucket, inputFileKey=key)
+    task_id = get_client().start_thing_registration_task(
+        templateBody=json.dumps(registration_template(POLICY_NAME, GROUP_NAME)),
+        inputFileBucket=bucket, inputFileKey=key, roleArn=role_arn)['taskId']
+    journal.created(task_key, task_id)
+    log("Started registration task " + task_id)
+    finish_registration_task(journal.get("registration_task", task_id), poll_interval)
+
+
+def finish_registration_task(task, poll_interval=10.0):
+    """Waits for a registration task, then journals what it created and packs the credentials
+    of each thing it provisioned"""
+    from bulkreg import parse_result, read_reports, wait_for_task
+
+    client = get_client()
+    journal = get_journal()
+    start = time.time()
+    with phase("bulk:wait_for_task"):
+        description = wait_for_task(client, task["id"], poll_interval, on_progress=lambda description: log(
+            "Registration task %s: %s, %s%% (%s succeeded, %s failed)" % (
+                task["id"], description["status"], description.get("percentageProgress", 0),
+                description.get("successCount", 0), description.get("failureCount", 0))))
+    if description["status"] != "Completed":
+        log("Registration task %s %s: %s" % (task["id"], description["status"].lower(), description.get("message")))
+
+    endpoint = client.describe_endpoint(endpointType='iot:Data-ATS')['endpointAddress']
+    keys_path = region_path(BULK_KEYS_PACK_FILE)
+    provisioned = 0
+    # Whatever the task got done is journaled, even if it didn't complete
+    with phase("bulk:read_results"), PackReader(keys_path) as keys, PackWriter(region_path(FLEET_PACK_FILE)) as pack:
+        for result in read_reports(client, task["id"], "RESULTS"):
+            thing_name, certificate_id, certificate_arn, certificate_pem = parse_result(result)
+            journal.created(journal.creating("thing", thing_name),
+                            thingArn=result["response"]["ResourceArns"]["thing"])
+            journal.created(journal.creating("certificate", certificate_id, thing=thing_name,
+                                             certificateArn=certificate_arn, principalAttached=True))
+            credentials = keys.get(thing_name)
+            if credentials is None:
+                log("No private key for " + thing_name + " in " + keys_path)
+                continue
+            pack.add(thing_name, certificateId=certificate_id, certificatePem=certificate_pem,
+                     privateKey=credentials['privateKey'], endpoint=endpoint)
+            provisioned += 1
+
+    failed = 0
+    for error in read_reports(client, task["id"], "ERRORS"):
+        failed += 1
+        if failed <= 10:
+            log("Failed provisioning line %s: %s" % (error.get("referenceId"), error.get("errorMessage")))
+    if failed > 10:
+        log("... and %d more" % (failed - 10))
+
+    log("Provisioned %d things, %d failed, in %.2fs after the task started" % (
+        provisioned, failed, time.time() - start))
+    client_factory.client('s3').delete_object(Bucket=task["inputFileBucket"], Key=task["inputFileKey"])
+    os.remove(keys_path)
+    journal.deleted("registration_task", task["id"])
+
+
+def extract_fleet_credentials(thing_names):
+    """Writes out the certificate, private key and agent arguments of each thing from the
+    fleet pack, for running the agent as that thing"""
+    pack_path = region_path(FLEET_PACK_FILE)
+    certificates_dir = region_path(FLEET_CERTIFICATES_DIR)
+    if not os.path.exists(certificates_dir):
+        os.makedirs(certificates_dir)
+
+    with PackReader(pack_path) as pack:
+        for thing_name in thing_names:
+            credentials = pack.get(thing_name)
+            if credentials is None:
+                log("No credentials for " + thing_name + " in " + pack_path)
+                continue
+
+            certificate_path = os.path.join(certificates_dir, thing_name + ".pem")
+            private_key_path = os.path.join(certificates_dir, thing_name + ".key")
+            with open(certificate_path, "w") as certificate_file:
+                certificate_file.write(credentials['certificatePem'])
+            with open(private_key_path, "w") as private_key:
+                private_key.write(credentials['privateKey'])
+
+            agent_args_path = os.path.join(certificates_dir, thing_name + ".agent_args.txt")
+            generate_agent_args_file(["-id", thing_name,
+                                      "-c", os.path.realpath(certificate_path),
+                                      "-k", os.path.realpath(private_key_path),
+                                      "-e", credentials['endpoint']],
+                                     agent_args_path)
+            log("Wrote credentials and agent arguments for " + thing_name + " to " + agent_args_path)
+
+
+def read_certificate_pem(pack, thing_name, certificate_id):
+    """Returns the PEM of a journaled certificate from the thing's credentials, or None"""
+    if thing_name == THING_NAME:
+        path = region_path(CERTIFICATE_PEM_FILE)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as certificate_file:
+            return certificate_file.read()
+    credentials = pack.get(thing_name) if pack else None
+    if credentials is None or credentials['certificateId'] != certificate_id:
+        return None
+    return credentials['certificatePem']
+
+
+def load_rotation_schedule():
+    """Schedules every active certificate journaled in the current region by its expiry.
+    The expiry of a certificate journaled without one is read from its credentials, and
+    journaled, so each certificate is only ever parsed once"""
+    from rotation import RotationSchedule, not_valid_after
+
+    journal = get_journal()
+    certificates = []
+    unscheduled = []
+    for entry in journal.live("certificate"):
+        if entry["state"] == CREATING or entry.get("status") == "INACTIVE":
+            continue
+        if "notAfter" in entry:
+            certificates.append((entry["notAfter"], entry["id"], entry["thing"]))
+        else:
+            unscheduled.append(entry)
+
+    if unscheduled:
+        pack_path = region_path(FLEET_PACK_FILE)
+        pack = PackReader(pack_path) if os.path.exists(pack_path) else None
+        try:
+            for entry in unscheduled:
+                certificate_pem = read_certificate_pem(pack, entry["thing"], entry["id"])
+                try:
+                    not_after = not_valid_after(certificate_pem) if certificate_pem else None
+                except ValueError:
+                    not_after = None
+                if not_after is None:
+                    log("Can't schedule certificate %s of %s, its credentials are missing or unreadable" % (
+                        entry["id"], entry["thing"]))
+                    continue
+                journal.annotate("certificate", entry["id"], notAfter=not_after)
+                certificates.append((not_after, entry["id"], entry["thing"]))
+        finally:
+            if pack:
+                pack.close()
+    return RotationSchedule(certificates)
+
+
+def rotate_certificate(client, thing_name, certificate_id, endpoint, journal, pack):
+    """Replaces a thing's certificate with one issued from a CSR for a new key, then
+    deactivates the old one. Returns the new certificate's id and expiry"""
+    from bulkreg import generate_keys_and_csrs
+    from rotation import not_valid_after
+
+    csr_pem, private_key_pem = generate_keys_and_csrs([thing_name])[0][1:]
+    key = journal.creating("certificate", thing=thing_name)
+    response = client.create_certificate_from_csr(certificateSigningRequest=csr_pem, setAsActive=True)
+    new_certificate_arn = response['certificateArn']
+    not_after = not_valid_after(response['certificatePem'])
+    key = journal.created(key, response['certificateId'], certificateArn=new_certificate_arn, notAfter=not_after)
+
+    client.attach_policy(policyName=POLICY_NAME, target=new_certificate_arn)
+    client.attach_thing_principal(thingName=thing_name, principal=new_certificate_arn)
+    journal.annotate(*key, principalAttached=True)
+
+    # The new credentials are saved before the old certificate stops working
+    if thing_name == THING_NAME:
+        for path, content in [(region_path(CERTIFICATE_PEM_FILE), response['certificatePem']),
+                              (region_path(PRIVATE_KEY_FILE), private_key_pem)]:
+            with open(path + ".tmp", "w") as credentials_file:
+                credentials_file.write(content)
+            os.rename(path + ".tmp", path)
+    else:
+        pack.add(thing_name, certificateId=response['certificateId'], certificatePem=response['certificatePem'],
+                 privateKey=private_key_pem, endpoint=endpoint)
+
+    # Left attached, so cleanup deletes it along with the thing
+    client.update_certificate(certificateId=certificate_id, newStatus="INACTIVE")
+    journal.annotate("certificate", certificate_id, status="INACTIVE")
+    return response['certificateId'], not_after
+
+
+def rotate_certificates(days, workers, rate, interval=None):
+    """Rotates every certificate expiring within days, soonest expiring first, starting at
+    most rate rotations a second. With interval, keeps checking every interval seconds for
+    as long as it runs. Returns False if any rotation failed"""
+    from ratelimit import TokenBucket
+
+    start = time.time()
+    schedule = load_rotation_schedule()
+    log("Scheduled %d certificates for rotation in %.2fs" % (len(schedule), time.time() - start))
+    bucket = TokenBucket(rate)
+    succeeded = True
+    while True:
+        due = schedule.due(time.time() + days * 24 * 60 * 60)
+        if due:
+            succeeded = rotate_due(schedule, due, workers, bucket) and succeeded
+        if interval is None:
+            return succeeded
+        next_expiry = schedule.next_expiry()
+        if next_expiry is not None:
+            log("Next certificate due for rotation on " + time.strftime(
+                "%Y-%m-%d %H:%M:%S UTC", time.gmtime(next_expiry - days * 24 * 60 * 60)))
+        time.sleep(interval)
+
+
+def rotate_due(schedule, due, workers, bucket):
+    """Rotates the certificates taken out of the schedule, putting each replacement in,
+    or the certificate itself back when its rotation failed"""
+    client = get_client()
+    journal = get_journal()
+    packed = [entry for entry in due if entry[2] != THING_NAME]
+    endpoint = pack = None
+    if packed:
+        endpoint = client.describe_endpoint(endpointType='iot:Data-ATS')['endpointAddress']
+        pack = PackWriter(region_path(FLEET_PACK_FILE))
+
+    def rotate(entry):
+        not_after, certificate_id, thing_name = entry
+        bucket.acquire()
+        try:
+            with phase("rotate_certificate"):
+                return rotate_certificate(client, thing_name, certificate_id, endpoint, journal, pack)
         except ClientError as e:
-            print(e)
+            log("Failed rotating certificate %s of %s: %s" % (certificate_id, thing_name, e))
+            return None
+
+    start = time.time()
+    pool = ThreadPool(workers)
+    try:
+        results = pool.map(rotate, due)
+    finally:
+        pool.close()
+        pool.join()
+        if pack:
+            pack.close()
+
+    failed = 0
+    for (not_after, certificate_id, thing_name), result in zip(due, results):
+        if result is None:
+            failed += 1
+            schedule.add(certificate_id, thing_name, not_after)
+        else:
+            schedule.add(result[0], thing_name, result[1])
+    log("Rotated %d of %d certificates due in %.2fs" % (len(due) - failed, len(due), time.time() - start))
+
+    # Extracted credentials are brought up to date too
+    extracted = [entry[2] for entry in packed
+                 if os.path.exists(os.path.join(region_path(FLEET_CERTIFICATES_DIR), entry[2] + ".pem"))]
+    if extracted:
+        extract_fleet_credentials(extracted)
+    return failed == 0
+
+
+def create_thing_group():
+    key = get_journal().creating("thing_group", GROUP_NAME)
+    thing_group_arn = get_client().create_thing_group(thingGroupName=GROUP_NAME)['thingGroupArn']
+    get_journal().created(key)
+    return thing_group_arn
+
+
+def provision_thing():
+    """Provisions the workshop thing, returning False if it already exists"""
+    client = get_client()
+    agent_args = []
+    try:
+        client.describe_thing(thingName=THING_NAME)
+        exists = True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundException':
+            raise
+        exists = False
+
+    if not exists:
+        key = get_journal().creating("thing", THING_NAME)
+        response = client.create_thing(thingName=THING_NAME)
+        thingArn = response['thingArn']
+        thingId = response['thingId']
+        get_journal().created(key, thingArn=thingArn)
+        log("Created Thing: " + thingId)
+    else:
+        log("Thing Already Exists, please choose another name, or delete existing thing")
+        return False
+
+    agent_args += ["-id", THING_NAME]
+
+    key = get_journal().creating("certificate", thing=THING_NAME)
+    response = client.create_keys_and_certificate(setAsActive=True)
+    certificatePem = response['certificatePem']
+    certificateArn = response['certificateArn']
+    get_journal().created(key, response['certificateId'], certificateArn=certificateArn)
+    keyPair = response['keyPair']
+    log("Created Certificate  arn:" + certificateArn + "\n id:" + response['certificateArn'])
+
+    # The journal has already made the region's directory
+    with open(region_path(CERTIFICATE_PEM_FILE), "w") as certificateFile:
+        certificateFile.write(certificatePem)
+        agent_args += ["-c", os.path.realpath(certificateFile.name)]
+
+    with open(region_path(PRIVATE_KEY_FILE), "w") as private_key:
+        private_key.write(keyPair["PrivateKey"])
+        private_key
+        agent_args += ["-k", os.path.realpath(private_key.name)]
+
+    response = client.attach_thing_principal(thingName=THING_NAME, principal=certificateArn)
+    get_journal().annotate("certificate", certificateArn.split("/")[-1], principalAttached=True)
+    log("Attached Certificate to Thing: " + THING_NAME)
+
+    policyArn = get_or_create_policy()
+
+    response = client.attach_policy(policyName=POLICY_NAME, target=certificateArn)
+    log("Attached Policy to Certificate")
+
+    response = client.describe_endpoint(endpointType='iot:Data-ATS')
+    agent_args += ["-e", response['endpointAddress']]
+
+    # Create a Thing Group to put our new thing into
+    thingGroupArn = create_thing_group()
+
+    # Add our workshop thing to the new group
+    response = client.add_thing_to_thing_group(
+        thingGroupArn=thingGroupArn,
+        thingArn=thingArn
+    )
+
+    generate_agent_args_file(agent_args)
+    return True
+
+
+def plan_certificate_teardown(plan, thing_name, cert_id, cert_arn):
+    """Adds the calls removing one certificate, returning the keys that the shared policy
+    delete and the delete of the thing it is attached to have to wait for"""
+    client = get_client()
+    detach_policy = plan.add(("detach_policy", cert_arn), client.detach_policy,
+                             policyName=POLICY_NAME, target=cert_arn)
+    deactivate = plan.add(("update_certificate", cert_id), client.update_certificate,
+                          certificateId=cert_id, newStatus="INACTIVE")
+    detach_principal = plan.add(("detach_thing_principal", thing_name, cert_arn), client.detach_thing_principal,
+                                thingName=thing_name, principal=cert_arn)
+    plan.add(("delete_certificate", cert_id), client.delete_certificate,
+             after=[detach_policy, deactivate, detach_principal], certificateId=cert_id)
+    return detach_policy, detach_principal
+
+
+def plan_thing_teardown(plan, thing_name, detach_principals):
+    """Adds the calls removing one thing, returning the key that the thing group delete
+    has to wait for"""
+    client = get_client()
+    remove_from_group = plan.add(("remove_thing_from_thing_group", thing_name), client.remove_thing_from_thing_group,
+                                 thingGroupName=GROUP_NAME, thingName=thing_name)
+    plan.add(("delete_thing", thing_name), client.delete_thing,
+             after=list(detach_principals) + [remove_from_group], thingName=thing_name)
+    return remove_from_group
+
+
+def cleanup_things(workers=16, only=None):
+    """Deletes everything journaled, or with only, just those things and their certificates"""
+    journal = get_journal()
+
+    certificates = []
+    for entry in journal.live("certificate"):
+        if only is not None and entry["thing"] not in only:
+            continue
+        if entry["state"] == CREATING:
+            # Interrupted between creating the certificate and journaling its id
+            log("A certificate for %s may have been created without being journaled" % entry["thing"])
+            continue
+        certificates.append(entry)
+    things = [entry["id"] for entry in journal.live("thing") if only is None or entry["id"] in only]
+    shared = only is None and (journal.live("thing_group") or journal.live("policy"))
+
+    if not certificates and not things and not shared:
+        log("No resources to clean up")
+        return
+
+    def on_done(key):
+        if key[0] in DELETE_CALLS:
+            journal.deleted(DELETE_CALLS[key[0]], key[1])
+
+    plan = TeardownPlan(on_done)
+    policy_detaches = []
+    detach_principals = {}
+    for entry in certificates:
+        detach_policy, detach_principal = plan_certificate_teardown(
+            plan, entry["thing"], entry["id"], entry["certificateArn"])
+        policy_detaches.append(detach_policy)
+        detach_principals.setdefault(entry["thing"], []).append(detach_principal)
+    group_removes = [plan_thing_teardown(plan, thing_name, detach_principals.get(thing_name, []))
+                     for thing_name in things]
+    if shared and journal.live("thing_group"):
+        plan.add(("delete_thing_group", GROUP_NAME), get_client().delete_thing_group,
+                 after=group_removes, thingGroupName=GROUP_NAME)
+    if shared and journal.live("policy"):
+        plan.add(("delete_policy", POLICY_NAME), get_client().delete_policy,
+                 after=policy_detaches, policyName=POLICY_NAME)
+
+    log("Deleting %d things and %d certificates%s" % (
+        len(things), len(certificates), ", the thing group and policy" if shared else ""))
+    start = time.time()
+    failures = plan.run(workers)
+    log("Ran %d cleanup calls in %.2fs" % (len(plan.tasks), time.time() - start))
+
+    if failures:
+        # Whatever was deleted is journaled, so running cleanup again picks up from here
+        for key, error in failures:
+            log("Failed " + " ".join(key) + ": " + str(error))
+        journal.sync()
+        return
+
+    pack_path = region_path(FLEET_PACK_FILE)
+    certificates_dir = region_path(FLEET_CERTIFICATES_DIR)
+    if only is not None:
+        if os.path.exists(pack_path):
+            with PackWriter(pack_path) as pack:
+                for thing_name in things:
+                    pack.remove(thing_name)
+        for thing_name in things:
+            for suffix in [".pem", ".key", ".agent_args.txt"]:
+                path = os.path.join(certificates_dir, thing_name + suffix)
+                if os.path.exists(path):
+                    os.remove(path)
+        return
+
+    for path in [region_path(PRIVATE_KEY_FILE), region_path(CERTIFICATE_PEM_FILE), pack_path]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    if os.path.exists(certificates_dir):
+        shutil.rmtree(certificates_dir)
+
+    with journals_lock:
+        del journals[current_region()]
+    if len(journal):
+        journal.compact()
+        journal.close()
+    else:
+        journal.close()
+        os.remove(journal.path)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--cleanup", required=False, action="store_true", dest="cleanup",
+                        help="Cleanup resources created by previous invocations of this script")
+    parser.add_argument("-n", "--count", required=False, type=int, dest="count",
+                        help="Provision COUNT things named " + THING_NAME + "-<n> instead of a single thing")
+    parser.add_argument("-m", "--manifest", required=False, dest="manifest",
+                        help="Provision every thing named in MANIFEST, one thing name per line, "
+                             "making only the changes the account is missing")
+    parser.add_argument("-p", "--plan", required=False, action="store_true", dest="plan",
+                        help="With --count or --manifest, only print what would change")
+    parser.add_argument("--prune", required=False, action="store_true", dest="prune",
+                        help="With --count or --manifest, also remove things this script created that are "
+                             "no longer wanted")
+    parser.add_argument("-x", "--extract", required=False, action="append", dest="extract", metavar="THING",
+                        help="Write out the certificate, private key and agent arguments of a fleet THING under "
+                             + FLEET_CERTIFICATES_DIR + ". May be repeated")
+    parser.add_argument("-b", "--bulk", required=False, action="store_true", dest="bulk",
+                        help="With --count or --manifest, provision the things with one AWS IoT bulk registration "
+                             "task instead of API calls per thing. Keys are generated locally and certificates "
+                             "issued from CSRs. Things are not checked for existing already")
+    parser.add_argument("--bulk-bucket", required=False, dest="bulk_bucket", metavar="BUCKET",
+                        help="S3 bucket, in the region provisioned, the bulk registration input file is uploaded "
+                             "to. {region} is replaced by the region")
+    parser.add_argument("--bulk-role-arn", required=False, dest="bulk_role_arn", metavar="ARN",
+                        help="Role AWS IoT assumes to read the input file and provision the things")
+    parser.add_argument("--bulk-prefix", required=False, default="", dest="bulk_prefix",
+                        help="Key prefix of the bulk registration input file")
+    parser.add_argument("--poll-interval", required=False, type=float, default=10.0, dest="poll_interval",
+                        help="Seconds between checks on a bulk registration task, backing off while it makes "
+                             "no progress")
+    parser.add_argument("-r", "--rotate", required=False, action="store_true", dest="rotate",
+                        help="Replace the certificates journaled here that expire within --rotate-days with ones "
+                             "for new keys, soonest expiring first, then deactivate the old ones")
+    parser.add_argument("--rotate-days", required=False, type=float, default=30.0, dest="rotate_days",
+                        help="With --rotate, rotate certificates expiring within this many days")
+    parser.add_argument("--rotation-rate", required=False, type=float, default=5.0, dest="rotation_rate",
+                        help="With --rotate, start at most this many rotations a second in each region")
+    parser.add_argument("--watch", required=False, type=float, dest="watch", metavar="SECONDS",
+                        help="With --rotate, keep running, checking for certificates due every SECONDS")
+    parser.add_argument("--endpoint-url", required=False, action="append", default=[], dest="endpoint_urls",
+                        metavar="SERVICE=URL",
+                        help="Send SERVICE (iot or s3) API calls to URL, e.g. a local stand-in, instead of AWS")
+    parser.add_argument("--region", required=False, action="append", dest="regions", metavar="REGION",
+                        help="Work in REGION instead of the default region. May be repeated, or a comma separated "
+                             "list, to work in every region at once. Each region keeps its journal and credentials "
+                             "under ../certificates/REGION")
+    parser.add_argument("-w", "--workers", required=False, type=int, default=16, dest="workers",
+                        help="Number of things provisioned, or API calls made during cleanup, concurrently in each region")
+
+    parser.add_argument("--api-stats", required=False, action="store_true", dest="api_stats",
+                        help="Print call counts, latencies, retries and throttling per IoT API operation at exit")
+    parser.add_argument("--api-report", required=False, dest="api_report",
+                        help="Also write the API call stats to this file, as JSON if it ends in .json, "
+                             "Prometheus text otherwise")
+
+    parser.add_argument("--rate-limit", required=False, action="append", default=[], dest="rate_limits",
+                        metavar="[OPERATION=]RATE",
+                        help="Limit IoT API calls to RATE per second, for every operation or just OPERATION "
+                             "(e.g. CreateThing=50). May be repeated. Rates back off when calls are throttled")
+
+    parser.add_argument("--profile", required=False, nargs="?", const="timers", choices=MODES, dest="profile",
+                        help="Print how wall and CPU time split between provisioning and cleanup stages, key "
+                             "generation, signing and API calls at exit. cprofile also runs cProfile in each stage, "
+                             "sample also samples stacks for flame graphs")
+    parser.add_argument("--profile-output", required=False, dest="profile_output", metavar="PREFIX",
+                        help="Also write the profile to PREFIX.json, and the cProfile statistics or sampled stacks "
+                             "next to it")
+
+    args = parser.parse_args()
+    if args.bulk and not (args.bulk_bucket and args.bulk_role_arn and (args.count or args.manifest)):
+        parser.error("--bulk needs --count or --manifest, --bulk-bucket and --bulk-role-arn")
+    regions = parse_regions(args.regions) or [None]
+
+    api_stats = None
+    if args.api_stats or args.api_report:
+        api_stats = ApiCallStats()
+        atexit.register(api_stats.print_summary)
+        if args.api_report:
+            atexit.register(api_stats.write_report, args.api_report)
+
+    profiler = None
+    if args.profile or args.profile_output:
+        profiler = enable(PhaseProfiler(args.profile or "timers"))
+        profiler.wrap_crypto()
+        atexit.register(profiler.print_summary)
+        if args.profile_output:
+            atexit.register(profiler.write_report, args.profile_output)
+
+    # A region's client is shared by all of its workers, so give it enough connections for all of them
+    client_factory = ClientFactory(max_pool_connections=args.workers, rate_limits=args.rate_limits,
+                                   api_stats=api_stats,
+                                   endpoint_urls=dict(url.split("=", 1) for url in args.endpoint_urls),
+                                   profiler=profiler)
+
+    atexit.register(close_journals)
+
+    # The phase a region's whole run is profiled as
+    if args.cleanup or args.extract or args.rotate:
+        run_phase = "cleanup" if args.cleanup else "extract" if args.extract else "rotate"
+    elif args.count or args.manifest:
+        run_phase = "bulk" if args.bulk else "fleet"
+    else:
+        run_phase = "provision_thing"
+
+    key_pool = None
+    if run_phase == "bulk":
+        # Forked here, before the upload and region threads start, and shared by every region
+        key_pool = multiprocessing.Pool()
+        atexit.register(key_pool.terminate)
+
+    def run():
+        with phase(run_phase):
+            return run_mode()
+
+    def run_mode():
+        if args.cleanup:
+            return cleanup_things(args.workers)
+        elif args.extract:
+            return extract_fleet_credentials(args.extract)
+        elif args.rotate:
+            return rotate_certificates(args.rotate_days, args.workers, args.rotation_rate, args.watch)
+        elif args.count or args.manifest:
+            if args.bulk:
+                # Streamed, so the names are never all in memory at once
+                thing_names = iter_manifest(args.manifest) if args.manifest else iter_fleet_names(args.count)
+                return bulk_provision(thing_names, args.bulk_bucket, args.bulk_role_arn, args.bulk_prefix,
+                                      args.poll_interval, key_pool=key_pool)
+            if args.manifest:
+                thing_names = read_manifest(args.manifest)
+            else:
+                thing_names = ["%s-%d" % (THING_NAME, i) for i in range(args.count)]
+            return reconcile_fleet(thing_names, args.workers, apply=not args.plan, prune=args.prune)
+        else:
+            return provision_thing()
+
+    failed = False
+    for region, (result, seconds, error) in fan_out(regions, run).items():
+        if error is not None or result is False:
+            failed = True
+        if error is not None:
+            print("%s: failed after %.2fs: %s" % (region, seconds, error))
+        elif len(regions) > 1:
+            print("%s: done in %.2fs" % (region, seconds))
+    if failed:
+        exit(1)
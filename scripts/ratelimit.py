@@ -0,0 +1,142 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Client side rate limiting of AWS API calls, with one token bucket per operation.
+
+AWS IoT enforces a separate TPS limit on each control plane API, so each operation
+gets its own bucket. A token is taken for every attempt botocore sends, so its
+retries of a throttled call are paced too. Buckets live in shared memory, so worker
+threads and worker processes forked after a bucket was created all draw from the same
+one. Buckets of operations given a rate of their own are created up front; those of
+the default rate only on an operation's first call, so processes forked before that
+each pace it on their own. When a call is throttled, or only succeeded after retries,
+that operation's rate is halved; every clean success then adds back a little, up to
+the configured rate.
+
+    rate_limiter = RateLimiter.from_specs(["10", "CreateThing=50"])
+    rate_limiter.install(client)
+"""
+
+import multiprocessing
+import threading
+import time
+
+from instrumentation import THROTTLING_ERRORS, record_rate_limit_wait
+
+TOKENS = 0
+LAST_REFILL = 1
+RATE = 2
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None, min_rate=0.1):
+        self.max_rate = float(rate)
+        self.min_rate = min(min_rate, self.max_rate)
+        # Service limits are enforced over short windows, so by default calls are
+        # paced evenly rather than let through in bursts
+        self.burst = float(burst or 1.0)
+        self.lock = multiprocessing.Lock()
+        self.state = multiprocessing.RawArray('d', [self.burst, time.time(), self.max_rate])
+
+    @property
+    def rate(self):
+        return self.state[RATE]
+
+    def _refill(self, now):
+        tokens = self.state[TOKENS] + (now - self.state[LAST_REFILL]) * self.state[RATE]
+        self.state[TOKENS] = min(self.burst, tokens)
+        self.state[LAST_REFILL] = now
+
+    def acquire(self):
+        """Blocks until a token is available and takes it"""
+        while True:
+            with self.lock:
+                self._refill(time.time())
+                if self.state[TOKENS] >= 1:
+                    self.state[TOKENS] -= 1
+                    return
+                wait = (1 - self.state[TOKENS]) / self.state[RATE]
+            time.sleep(wait)
+
+    def on_throttle(self):
+        with self.lock:
+            self._refill(time.time())
+            self.state[RATE] = max(self.min_rate, self.state[RATE] / 2)
+            self.state[TOKENS] = min(self.state[TOKENS], 0)
+
+    def on_success(self):
+        with self.lock:
+            self.state[RATE] = min(self.max_rate, self.state[RATE] + self.max_rate / 100)
+
+
+class RateLimiter(object):
+
+    def __init__(self, default_rate, rates=None):
+        self.default_rate = default_rate
+        self.lock = threading.Lock()
+        # Buckets for explicitly configured operations are created up front, so they
+        # are shared with any process forked from here on
+        self.buckets = dict((operation, TokenBucket(rate)) for operation, rate in (rates or {}).items())
+
+    @classmethod
+    def from_specs(cls, specs):
+        """Builds a limiter from "RATE" (the default for every operation) and
+        "Operation=RATE" (e.g. "CreateThing=50") strings, in calls per second"""
+        default_rate = None
+        rates = {}
+        for spec in specs:
+            if "=" in spec:
+                operation, rate = spec.split("=", 1)
+                rates[operation] = float(rate)
+            else:
+                default_rate = float(spec)
+        return cls(default_rate, rates)
+
+    def bucket(self, operation):
+        with self.lock:
+            if operation not in self.buckets:
+                if not self.default_rate:
+                    return None
+                self.buckets[operation] = TokenBucket(self.default_rate)
+            return self.buckets[operation]
+
+    def install(self, client):
+        events = client.meta.events
+        # Emitted for every attempt, retries included, where before-call is only emitted
+        # once per call. First, so the attempt waits for a token before anything answers it
+        events.register_first('before-send.*.*', self._before_send)
+        events.register('after-call.*.*', self._after_call)
+        return client
+
+    def _before_send(self, event_name, **kwargs):
+        # before-send.<service>.<Operation>
+        bucket = self.bucket(event_name.rsplit('.', 1)[-1])
+        if bucket:
+            start = time.time()
+            bucket.acquire()
+            # So API latency stats can leave out the time spent here
+            record_rate_limit_wait(time.time() - start)
+
+    def _after_call(self, model, parsed, **kwargs):
+        bucket = self.bucket(model.name)
+        if not bucket:
+            return
+        error_code = parsed.get('Error', {}).get('Code')
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if error_code in THROTTLING_ERRORS or retries:
+            bucket.on_throttle()
+        elif not error_code:
+            bucket.on_success()
@@ -0,0 +1,145 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Works out what it takes to bring an account in line with a fleet manifest.
+
+A FleetSnapshot reads what already exists with one paginated sweep per resource type,
+rather than a describe call per thing, and plan_fleet() diffs it against the manifest.
+The certificate each thing uses is only known to the journal the provisioning script
+keeps, since no list call maps things to their principals in bulk.
+
+    snapshot = FleetSnapshot(client, journal, POLICY_NAME, GROUP_NAME)
+    plan = plan_fleet(thing_names, snapshot)
+    plan.print_summary()
+"""
+
+from collections import OrderedDict
+
+from journal import CREATED
+
+CREATE_THING = "create_thing"
+CREATE_CERTIFICATE = "create_keys_and_certificate"
+ATTACH_PRINCIPAL = "attach_thing_principal"
+ATTACH_POLICY = "attach_policy"
+ADD_TO_GROUP = "add_thing_to_thing_group"
+
+ALL_STAGES = [CREATE_THING, CREATE_CERTIFICATE, ATTACH_PRINCIPAL, ATTACH_POLICY, ADD_TO_GROUP]
+
+
+class FleetSnapshot(object):
+
+    def __init__(self, client, journal, policy_name, group_name):
+        self.client = client
+        self.pages = 0
+
+        self.things = set(thing['thingName'] for thing in self._sweep('list_things', 'things'))
+        self.policy_exists = any(policy['policyName'] == policy_name
+                                 for policy in self._sweep('list_policies', 'policies'))
+        self.group_exists = any(group['groupName'] == group_name
+                                for group in self._sweep('list_thing_groups', 'thingGroups',
+                                                         namePrefixFilter=group_name))
+        self.group_members = set()
+        if self.group_exists:
+            self.group_members = set(self._sweep('list_things_in_thing_group', 'things',
+                                                 thingGroupName=group_name))
+        self.policy_targets = set()
+        if self.policy_exists:
+            self.policy_targets = set(self._sweep('list_targets_for_policy', 'targets',
+                                                  policyName=policy_name))
+        active = set(certificate['certificateId'] for certificate in self._sweep('list_certificates', 'certificates')
+                     if certificate['status'] == 'ACTIVE')
+
+        # The journaled certificate of each thing, if it is still active in the account
+        self.certificates = {}
+        for entry in journal.live("certificate"):
+            if entry["state"] == CREATED and entry["id"] in active:
+                self.certificates[entry["thing"]] = entry
+
+    def _sweep(self, operation, result_key, **kwargs):
+        for page in self.client.get_paginator(operation).paginate(**kwargs):
+            self.pages += 1
+            for item in page[result_key]:
+                yield item
+
+
+class FleetPlan(object):
+
+    def __init__(self):
+        self.create_policy = False
+        self.create_group = False
+        # Stages still to run for each thing, and the certificate to attach the policy
+        # to when the thing keeps the one it has
+        self.things = OrderedDict()
+        self.certificate_arns = {}
+        self.unchanged = 0
+        self.prune = []
+
+    def stage_counts(self):
+        counts = OrderedDict((stage, 0) for stage in ALL_STAGES)
+        for stages in self.things.values():
+            for stage in stages:
+                counts[stage] += 1
+        return counts
+
+    def is_empty(self):
+        return not (self.create_policy or self.create_group or self.things or self.prune)
+
+    def print_summary(self):
+        print("%d things already match the manifest, %d need changes, %d not in it are to be removed" %
+              (self.unchanged, len(self.things), len(self.prune)))
+        if self.create_policy:
+            print("  create policy")
+        if self.create_group:
+            print("  create thing group")
+        for stage, count in self.stage_counts().items():
+            if count:
+                print("  %-28s %8d" % (stage, count))
+
+
+def plan_fleet(thing_names, snapshot, journaled_things=(), prune=False):
+    """Returns the smallest set of calls that gives every thing in thing_names a certificate
+    with the policy attached, in the group. With prune, journaled_things (things this
+    script created) missing from the manifest are removed"""
+    plan = FleetPlan()
+    plan.create_policy = not snapshot.policy_exists
+    plan.create_group = not snapshot.group_exists
+
+    for thing_name in thing_names:
+        stages = []
+        certificate = snapshot.certificates.get(thing_name)
+        if thing_name not in snapshot.things:
+            stages = list(ALL_STAGES)
+        elif certificate is None:
+            stages = [CREATE_CERTIFICATE, ATTACH_PRINCIPAL, ATTACH_POLICY]
+        else:
+            if not certificate.get("principalAttached"):
+                stages.append(ATTACH_PRINCIPAL)
+            if certificate["certificateArn"] not in snapshot.policy_targets:
+                stages.append(ATTACH_POLICY)
+            if stages:
+                plan.certificate_arns[thing_name] = certificate["certificateArn"]
+        if thing_name not in snapshot.group_members and ADD_TO_GROUP not in stages:
+            stages.append(ADD_TO_GROUP)
+
+        if stages:
+            plan.things[thing_name] = stages
+        else:
+            plan.unchanged += 1
+
+    if prune:
+        wanted = set(thing_names)
+        plan.prune = [thing_name for thing_name in journaled_things if thing_name not in wanted]
+
+    return plan
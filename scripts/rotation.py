@@ -0,0 +1,77 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Schedules device certificate rotation, soonest expiring first.
+
+Every certificate in use goes into a min-heap keyed on when it expires, so finding the
+ones due for rotation only looks at those, however large the fleet is. Rotating one
+takes it out and puts its replacement in, expiring much later:
+
+    schedule = RotationSchedule((not_after, certificate_id, thing_name) for ...)
+    for not_after, certificate_id, thing_name in schedule.due(time.time() + 30 * 24 * 60 * 60):
+        ...
+        schedule.add(new_certificate_id, thing_name, not_valid_after(new_certificate_pem))
+
+Nothing is parsed to fill the schedule: provision_thing.py journals each certificate's
+expiry with the certificate, and the journal is replayed anyway.
+"""
+
+import calendar
+import heapq
+import sys
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+
+if sys.version_info[0] == 2:
+    # cryptography's Python 2 backend reads certificate dates with datetime.strptime, whose
+    # first call imports _strptime, and that import fails in threads racing to make it
+    import _strptime
+
+
+def not_valid_after(certificate_pem):
+    """When a PEM certificate expires, in seconds since the epoch"""
+    if not isinstance(certificate_pem, bytes):
+        certificate_pem = certificate_pem.encode("ascii")
+    certificate = x509.load_pem_x509_certificate(certificate_pem, default_backend())
+    # Newer cryptography releases deprecate the naive UTC datetime for an aware one
+    expiry = getattr(certificate, "not_valid_after_utc", None) or certificate.not_valid_after
+    return calendar.timegm(expiry.utctimetuple())
+
+
+class RotationSchedule(object):
+    """Certificates by expiry. Adding one and taking each due one out are O(log n)"""
+
+    def __init__(self, certificates=()):
+        """certificates are (not after, certificate id, thing name), heapified in O(n)"""
+        self.heap = list(certificates)
+        heapq.heapify(self.heap)
+
+    def add(self, certificate_id, thing_name, not_after):
+        heapq.heappush(self.heap, (not_after, certificate_id, thing_name))
+
+    def next_expiry(self):
+        """When the soonest expiring certificate expires, or None"""
+        return self.heap[0][0] if self.heap else None
+
+    def due(self, before):
+        """Takes out and returns every certificate expiring before before, soonest first"""
+        due = []
+        while self.heap and self.heap[0][0] < before:
+            due.append(heapq.heappop(self.heap))
+        return due
+
+    def __len__(self):
+        return len(self.heap)
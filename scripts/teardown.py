@@ -0,0 +1,159 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Concurrent teardown of AWS IoT resources that respects the order they must be removed in.
+
+Every API call is a task keyed by a tuple such as ("delete_certificate", cert_id). A task
+only runs once all the tasks it was added after have succeeded, and independent tasks run
+in parallel on a bounded thread pool. If a task fails, everything that depends on it is
+skipped rather than attempted against a resource that is still attached to something.
+"""
+
+import threading
+from multiprocessing.pool import ThreadPool
+
+from botocore.exceptions import ClientError
+
+from profiling import phase
+
+# The resource is already gone, which is what the task was trying to achieve
+ALREADY_DONE_ERRORS = ('ResourceNotFoundException',)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class TeardownTask(object):
+
+    def __init__(self, key, api_call, kwargs):
+        self.key = key
+        self.api_call = api_call
+        self.kwargs = kwargs
+        self.state = PENDING
+        self.waiting_on = set()
+        self.dependents = []
+
+
+class TeardownPlan(object):
+
+    def __init__(self, on_done=None):
+        """on_done(key), if given, is called from the worker thread as each task succeeds"""
+        self.on_done = on_done
+        self.lock = threading.RLock()
+        self.finished = threading.Condition(self.lock)
+        self.tasks = {}
+        self.outstanding = 0
+        self.failures = []
+        self.pool = None
+
+    def add(self, key, api_call, after=(), **kwargs):
+        """Adds api_call(**kwargs) to the plan, to run once every task in after has succeeded.
+
+        Tasks may be added while the plan is running, e.g. by a task that lists the targets
+        of a policy and adds one detach task per target.
+        """
+        with self.lock:
+            if key not in self.tasks:
+                self.tasks[key] = TeardownTask(key, api_call, kwargs)
+                self.outstanding += 1
+            task = self.tasks[key]
+            for dependency in after:
+                self._depend(task, dependency)
+            self._schedule_if_ready(task)
+        return key
+
+    def add_dependency(self, key, dependency):
+        """Makes a task that has not started yet also wait for dependency"""
+        with self.lock:
+            task = self.tasks[key]
+            if task.state != PENDING:
+                raise ValueError("Task %s has already started" % (key,))
+            self._depend(task, dependency)
+
+    def run(self, workers=16):
+        """Runs the plan to completion, returning (key, error) for every task that failed"""
+        with self.lock:
+            self.pool = ThreadPool(workers)
+            for task in list(self.tasks.values()):
+                self._schedule_if_ready(task)
+            while self.outstanding:
+                # Waiting with a timeout keeps the main thread responsive to Ctrl-C on python 2
+                self.finished.wait(1.0)
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+        return self.failures
+
+    def _depend(self, task, dependency_key):
+        dependency = self.tasks[dependency_key]
+        if dependency.state == DONE:
+            return
+        if dependency.state in (FAILED, SKIPPED):
+            self._skip(task)
+            return
+        task.waiting_on.add(dependency_key)
+        dependency.dependents.append(task)
+
+    def _schedule_if_ready(self, task):
+        if self.pool is None or task.state != PENDING or task.waiting_on:
+            return
+        task.state = RUNNING
+        self.pool.apply_async(self._run_task, (task,))
+
+    def _run_task(self, task):
+        error = None
+        try:
+            with phase("cleanup:" + task.key[0]):
+                task.api_call(**task.kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ALREADY_DONE_ERRORS:
+                error = e
+        except Exception as e:
+            error = e
+
+        if error is None and self.on_done:
+            try:
+                self.on_done(task.key)
+            except Exception as e:
+                error = e
+
+        with self.lock:
+            if error is None:
+                task.state = DONE
+                for dependent in task.dependents:
+                    dependent.waiting_on.discard(task.key)
+                    self._schedule_if_ready(dependent)
+            else:
+                task.state = FAILED
+                self.failures.append((task.key, error))
+                for dependent in task.dependents:
+                    self._skip(dependent)
+            self._finish_one()
+
+    def _skip(self, task):
+        if task.state != PENDING:
+            return
+        task.state = SKIPPED
+        for dependent in task.dependents:
+            self._skip(dependent)
+        self._finish_one()
+
+    def _finish_one(self):
+        self.outstanding -= 1
+        if not self.outstanding:
+            self.finished.notify_all()
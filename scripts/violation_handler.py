@@ -0,0 +1,161 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Lambda handler summarizing batches of Device Defender SNS notifications.
+
+Takes the SNS records Lambda delivers, as in lambda-test-event.json, carrying either
+metrics report acknowledgements or violation events. Each batch is handled in one pass:
+every message is parsed once, duplicates are dropped, and what is left is counted per
+thing and security profile. Each summary is printed as one compact JSON line, and the
+handler returns the batch totals.
+
+SNS delivers at least once, so the same notification can arrive more than once, in the
+same batch or a later one. Violation events are deduplicated by violationId and event
+type, and report acknowledgements by thing and reportId. The ids seen are kept in a
+bounded LRU, which lives as long as the Lambda container does.
+
+To try it locally:
+
+    python ./violation_handler.py lambda-test-event.json
+"""
+
+import json
+import sys
+from collections import OrderedDict
+
+# orjson parses several times faster, when it is packaged with the function
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+SEEN_IDS_SIZE = 100000
+
+
+class SeenIds(object):
+    """The most recently seen maxsize ids"""
+
+    def __init__(self, maxsize=SEEN_IDS_SIZE):
+        self.maxsize = maxsize
+        self.ids = OrderedDict()
+
+    def seen(self, key):
+        """Returns whether key was seen before, and remembers it was seen now"""
+        if key in self.ids:
+            # Moves it to the most recent end
+            self.ids[key] = self.ids.pop(key)
+            return True
+        self.ids[key] = None
+        if len(self.ids) > self.maxsize:
+            self.ids.popitem(last=False)
+        return False
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class Summary(object):
+    __slots__ = ('thing_name', 'profile_name', 'reports_accepted', 'reports_rejected', 'in_alarm',
+                 'alarm_cleared', 'behaviors', 'last_event_time')
+
+    def __init__(self, thing_name, profile_name):
+        self.thing_name = thing_name
+        self.profile_name = profile_name
+        self.reports_accepted = 0
+        self.reports_rejected = 0
+        self.in_alarm = 0
+        self.alarm_cleared = 0
+        self.behaviors = set()
+        self.last_event_time = 0
+
+    def to_dict(self):
+        summary = OrderedDict([("thingName", self.thing_name)])
+        if self.profile_name:
+            summary["securityProfileName"] = self.profile_name
+            summary["inAlarm"] = self.in_alarm
+            summary["alarmCleared"] = self.alarm_cleared
+            summary["behaviors"] = sorted(self.behaviors)
+        else:
+            summary["reportsAccepted"] = self.reports_accepted
+            summary["reportsRejected"] = self.reports_rejected
+        summary["lastEventTime"] = self.last_event_time
+        return summary
+
+
+def summarize(records, seen_ids):
+    """Returns the summaries of a batch of SNS records, and how many records were
+    duplicates and how many were not notifications this understands"""
+    summaries = {}
+    duplicates = 0
+    invalid = 0
+
+    for record in records:
+        try:
+            message = loads(record["Sns"]["Message"])
+            thing_name = message["thingName"]
+            violation_id = message.get("violationId")
+            if violation_id is not None:
+                event_type = message["violationEventType"]
+                key = (violation_id, event_type)
+                profile_name = message["securityProfileName"]
+                event_time = message["violationEventTime"]
+            else:
+                key = (thing_name, message["reportId"])
+                profile_name = None
+                event_time = message["timestamp"]
+        except (KeyError, TypeError, ValueError):
+            invalid += 1
+            continue
+
+        if seen_ids.seen(key):
+            duplicates += 1
+            continue
+
+        summary = summaries.get((thing_name, profile_name))
+        if summary is None:
+            summary = summaries[(thing_name, profile_name)] = Summary(thing_name, profile_name)
+        if profile_name is None:
+            if message.get("status") == "ACCEPTED":
+                summary.reports_accepted += 1
+            else:
+                summary.reports_rejected += 1
+        elif event_type == "in-alarm":
+            summary.in_alarm += 1
+            behavior_name = message.get("behavior", {}).get("name")
+            if behavior_name:
+                summary.behaviors.add(behavior_name)
+        elif event_type == "alarm-cleared":
+            summary.alarm_cleared += 1
+        summary.last_event_time = max(summary.last_event_time, event_time)
+
+    return list(summaries.values()), duplicates, invalid
+
+
+seen_ids = SeenIds()
+
+
+def lambda_handler(event, context):
+    records = event.get("Records", [])
+    summaries, duplicates, invalid = summarize(records, seen_ids)
+    if summaries:
+        # One write for the batch, rather than one per summary
+        sys.stdout.write("".join(json.dumps(summary.to_dict(), separators=(',', ':')) + "\n"
+                                 for summary in summaries))
+    return {"records": len(records), "duplicates": duplicates, "invalid": invalid, "summaries": len(summaries)}
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1], "r") as event_file:
+        print(lambda_handler(json.load(event_file), None))